@@ -0,0 +1,159 @@
+from functools import wraps
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import AnonymousUser
+from django.http.response import JsonResponse
+from django.utils.dateparse import parse_datetime
+from django.utils.timezone import is_naive, make_aware
+from rest_framework import status
+from rest_framework.exceptions import APIException, AuthenticationFailed, PermissionDenied
+from rest_framework.views import exception_handler
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from knowledge.models import Path, Subject, Topic, TopicProgress
+from knowledge.tree import ROOT_SUBJECT_ID
+from knowledge.versions import PATH, SUBJECT, TOPIC, TOPIC_PROGRESS
+from . import views
+from .cache import JSONResponse, cache_response, conditional
+from .serializers import requested_fields, PathDetailRetrieveSerializer, PathListSerializer, SubjectSerializer, TopicDetailSerializer, TopicProgressSerializer, TopicProgressSyncSerializer
+from .views import SYNC_WATERMARK_HEADER, PathDetailQuery, PathValidators, PublishedPathsQuery, SubjectChildIds, SyncWatermark, TopicDetailQuery, TopicValidators, TopLevelSubjects
+
+# Async versions of the hot read views, routed instead of the sync ones in
+# views when ASYNC_API is on (see captain/settings.py). Under ASGI a request
+# that waits on the database then doesn't hold up a worker. Only reads are
+# async; every other method is handed to the sync view. They answer with the
+# same JSON as the sync views, without DRF's browsable API.
+
+READ_METHODS = ('GET', 'HEAD')
+
+
+def read_only(sync_view, paginated=False):
+    # Hands everything but reads to sync_view, and so do paginated views
+    # with requests for a page (DRF's cursor pagination is sync). Turns DRF
+    # exceptions into the responses DRF would send.
+    def decorator(view):
+        @wraps(view)
+        async def wrapped(request, *args, **kwargs):
+            if request.method not in READ_METHODS or (paginated and (
+                    'cursor' in request.GET or 'page_size' in request.GET)):
+                return await sync_to_async(sync_view)(request, *args, **kwargs)
+            try:
+                return await view(request, *args, **kwargs)
+            except APIException as error:
+                response = exception_handler(error, {})
+                headers = {header: value for header, value in response.items() if header != 'Content-Type'}
+                return JSONResponse(response.data, status=response.status_code, headers=headers)
+        # Like every DRF view, these take tokens rather than CSRF cookies
+        wrapped.csrf_exempt = True
+        return wrapped
+    return decorator
+
+
+def authenticated(view):
+    # Sets request.user from the JWT as DRF would, for views that use it
+    @wraps(view)
+    async def wrapped(request, *args, **kwargs):
+        # Like DRF's Request, take the user APIClient.force_authenticate gives
+        if getattr(request, '_force_auth_user', None) is not None:
+            request.user = request._force_auth_user
+            return await view(request, *args, **kwargs)
+        authentication = JWTAuthentication()
+        try:
+            found = await sync_to_async(authentication.authenticate)(request)
+        except AuthenticationFailed as error:
+            error.auth_header = authentication.authenticate_header(request)
+            raise
+        request.user = found[0] if found else AnonymousUser()
+        return await view(request, *args, **kwargs)
+    return wrapped
+
+
+async def serialize(serializer_class, instance, **kwargs):
+    # Serializers read breadcrumbs and version counters, which may mean a
+    # query, so they run in a thread
+    return await sync_to_async(lambda: serializer_class(instance, **kwargs).data)()
+
+
+@read_only(views.subjects)
+@cache_response(SUBJECT)
+async def subjects(request):
+    # To get list of subjects (who are children of root)
+    fields = requested_fields(request)
+    queryset = SubjectSerializer.project(TopLevelSubjects(), fields).prefetch_related(SubjectChildIds())
+    return JSONResponse(await serialize(SubjectSerializer, [subject async for subject in queryset], many=True, fields=fields))
+
+
+@read_only(views.subjectChildren)
+async def subjectChildren(request, pk):
+    if pk == ROOT_SUBJECT_ID:
+        queryset = TopLevelSubjects()
+    else:
+        try:
+            queryset = (await Subject.objects.aget(id=pk)).get_children()
+        except Subject.DoesNotExist:
+            return JSONResponse(None, status=status.HTTP_404_NOT_FOUND)
+
+    fields = requested_fields(request)
+    queryset = SubjectSerializer.project(queryset, fields).prefetch_related(SubjectChildIds())
+    return JSONResponse(await serialize(SubjectSerializer, [subject async for subject in queryset], many=True, fields=fields))
+
+
+@read_only(views.topic)
+@cache_response(SUBJECT, TOPIC, TOPIC_PROGRESS)
+@conditional(lambda request, pk: TopicValidators(pk))
+async def topic(request, pk):
+    # To get detail of a particular topic
+    fields = requested_fields(request)
+    try:
+        thisTopic = await TopicDetailQuery(fields).aget(id=pk)
+    except Topic.DoesNotExist:
+        return JSONResponse(None, status=status.HTTP_404_NOT_FOUND)
+    return JSONResponse(await serialize(TopicDetailSerializer, thisTopic, fields=fields))
+
+
+@read_only(views.pathDetail)
+@authenticated
+@conditional(lambda request, pk: PathValidators(pk, request.user))
+async def pathDetail(request, pk):
+    # To get detail of a particular path
+    try:
+        thisPath = await Path.objects.only('published').aget(id=pk)
+    except Path.DoesNotExist:
+        return JSONResponse(None, status=status.HTTP_404_NOT_FOUND)
+    # If non-staff user has requested, only send if its a published path
+    if not thisPath.published and not request.user.is_staff:
+        raise PermissionDenied()
+
+    fields = requested_fields(request)
+    thisPath = await PathDetailQuery(fields, request.user).aget(id=pk)
+    return JSONResponse(await serialize(PathDetailRetrieveSerializer, thisPath, fields=fields))
+
+
+@read_only(views.publishedPaths, paginated=True)
+@cache_response(PATH)
+async def publishedPaths(request):
+    # To get list of paths
+    fields = requested_fields(request)
+    queryset = PublishedPathsQuery(request, fields)
+    return JSONResponse(await serialize(PathListSerializer, [path async for path in queryset], many=True, fields=fields))
+
+
+@read_only(views.Progresses)
+async def Progresses(request):
+    # List path detail in which topics' progresses are included. The user
+    # comes from the session, which may have to be loaded.
+    user = await sync_to_async(lambda: request.user.id)()
+    progresses = TopicProgress.objects.filter(student=user)
+    watermark = {SYNC_WATERMARK_HEADER: SyncWatermark()}
+    # With ?since=<timestamp>, only send the rows that changed after it
+    since = request.GET.get('since')
+    if since is not None:
+        try:
+            since = parse_datetime(since)
+        except ValueError:
+            since = None
+        if since is None:
+            return JsonResponse({'since': "Invalid timestamp."}, status=status.HTTP_400_BAD_REQUEST)
+        if is_naive(since):
+            since = make_aware(since)
+        progresses = progresses.filter(updated_at__gt=since)
+        return JsonResponse(await serialize(TopicProgressSyncSerializer, [progress async for progress in progresses], many=True), safe=False, headers=watermark)
+    return JsonResponse(await serialize(TopicProgressSerializer, [progress async for progress in progresses], many=True), safe=False, headers=watermark)
@@ -0,0 +1,54 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from django.conf import settings
+from django.db.backends.signals import connection_created
+
+# Load generation for comparing the ways of serving the API (see the
+# benchmark command), and a stand-in for a slow database to run it against.
+
+
+def slow_database(execute, sql, params, many, context):
+    # Holds every query up by DB_QUERY_DELAY milliseconds, the way a loaded
+    # database would: the calling thread just waits
+    time.sleep(settings.DB_QUERY_DELAY / 1000)
+    return execute(sql, params, many, context)
+
+
+def _slow_down(sender, connection, **kwargs):
+    if slow_database not in connection.execute_wrappers:
+        connection.execute_wrappers.append(slow_database)
+
+
+def install_slow_database():
+    connection_created.connect(_slow_down)
+
+
+def run(urls, concurrency, total, headers=None, timeout=30):
+    # Sends total GET requests spread over the urls from concurrency threads,
+    # each with its own keep-alive session. Returns the wall time and, per
+    # request, (status or None on a network error, latency in seconds).
+    def worker(count):
+        results = []
+        with requests.Session() as session:
+            session.headers.update(headers or {})
+            for i in range(count):
+                url = urls[i % len(urls)]
+                started = time.perf_counter()
+                try:
+                    status = session.get(url, timeout=timeout).status_code
+                except requests.RequestException:
+                    status = None
+                results.append((status, time.perf_counter() - started))
+        return results
+
+    counts = [total // concurrency + (i < total % concurrency) for i in range(concurrency)]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = [result for results in executor.map(worker, counts) for result in results]
+    return time.perf_counter() - started, results
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)] if values else 0.0
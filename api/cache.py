@@ -0,0 +1,147 @@
+import asyncio
+import hashlib
+from datetime import datetime
+from functools import wraps
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe, quote_etag
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+from knowledge.versions import get_changed_at, get_version
+from .replicas import reading_from_replica
+
+# Headers a cached response is stored with, so that hits can still be
+# answered with a 304
+VALIDATOR_HEADERS = ('ETag', 'Last-Modified')
+
+
+class JSONResponse(HttpResponse):
+    # The response the async views send: the same bytes a DRF Response
+    # renders to as JSON, with the data kept for cache_response
+    def __init__(self, data, status=200, headers=None):
+        super().__init__(JSONRenderer().render(data), content_type='application/json', status=status, headers=headers)
+        self.data = data
+
+
+def cache_response(*version_names):
+    # Cache-aside for the GET branch of a view. Responses are stored under the
+    # full request URL together with the current value of every version
+    # counter the response is built from; a write to any of those models
+    # bumps its counter, so the next read misses and rebuilds.
+    # Only use for responses that are the same for every user. Works on
+    # async views too, which get their cache hits as a JSONResponse.
+    def decorator(view):
+        if asyncio.iscoroutinefunction(view):
+            @wraps(view)
+            async def wrapped_async(request, *args, **kwargs):
+                if request.method != 'GET':
+                    return await view(request, *args, **kwargs)
+                key, response = await sync_to_async(_cached_response)(request, version_names, JSONResponse)
+                if response is None:
+                    response = await view(request, *args, **kwargs)
+                    await sync_to_async(_store_response)(key, response)
+                return response
+            return wrapped_async
+
+        @wraps(view)
+        def wrapped(request, *args, **kwargs):
+            if request.method != 'GET':
+                return view(request, *args, **kwargs)
+            key, response = _cached_response(request, version_names, Response)
+            if response is None:
+                response = view(request, *args, **kwargs)
+                _store_response(key, response)
+            return response
+        return wrapped
+    return decorator
+
+
+def _cached_response(request, version_names, response_class):
+    # Returns the cache key and, on a hit, the response to send
+    versions = ':'.join(str(get_version(name)) for name in version_names)
+    key = 'response:' + hashlib.md5(
+        (request.build_absolute_uri() + '|' + versions).encode()).hexdigest()
+    cached = cache.get(key)
+    if cached is None:
+        return key, None
+    data, headers = cached
+    response = get_conditional_response(
+        request, etag=headers.get('ETag'),
+        last_modified=parse_http_date_safe(headers.get('Last-Modified', '')))
+    if response is None:
+        response = response_class(data)
+    for header, value in headers.items():
+        response[header] = value
+    return key, response
+
+
+def _store_response(key, response):
+    # A response read from a replica may predate the versions in its key
+    if response.status_code == 200 and not reading_from_replica():
+        headers = {header: response[header] for header in VALIDATOR_HEADERS if response.has_header(header)}
+        cache.set(key, (response.data, headers))
+
+
+def conditional(validators):
+    # Conditional GET for a view: sets a strong ETag and Last-Modified, and
+    # answers If-None-Match / If-Modified-Since with a 304 without running the
+    # view at all. validators(request, *args, **kwargs) returns the values the
+    # response is built from (counts, update times, version counters) and the
+    # names of the version counters it depends on, or None when the view
+    # should just run (e.g. the object does not exist). Works on async views
+    # too, the validators then run in a thread.
+    def decorator(view):
+        if asyncio.iscoroutinefunction(view):
+            @wraps(view)
+            async def wrapped_async(request, *args, **kwargs):
+                if request.method not in ('GET', 'HEAD'):
+                    return await view(request, *args, **kwargs)
+                found, response = await sync_to_async(_check_validators)(validators, request, args, kwargs)
+                if response is None:
+                    response = await view(request, *args, **kwargs)
+                return _set_validators(response, found)
+            return wrapped_async
+
+        @wraps(view)
+        def wrapped(request, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return view(request, *args, **kwargs)
+            found, response = _check_validators(validators, request, args, kwargs)
+            if response is None:
+                response = view(request, *args, **kwargs)
+            return _set_validators(response, found)
+        return wrapped
+    return decorator
+
+
+def _check_validators(validators, request, args, kwargs):
+    # Returns the (ETag, Last-Modified) pair, or None when the view should
+    # just run, and the 304 to send if the client's copy is current
+    found = validators(request, *args, **kwargs)
+    if found is None:
+        return None, None
+    row, version_names = found
+    found = make_validators(request, row, version_names)
+    return found, get_conditional_response(request, etag=found[0], last_modified=found[1])
+
+
+def _set_validators(response, found):
+    if found is not None and response.status_code in (200, 304):
+        response['ETag'] = found[0]
+        response['Last-Modified'] = http_date(found[1])
+    return response
+
+
+def make_validators(request, row, version_names):
+    # The ETag hashes every value together with the query string (each
+    # ?fields= projection is a different representation); Last-Modified is the
+    # latest of the update times and of the last bump of each counter.
+    values = [row[name] for name in sorted(row)]
+    values += [get_version(name) for name in version_names]
+    etag = quote_etag(hashlib.md5(
+        (request.GET.urlencode() + '|' + repr(values)).encode()).hexdigest())
+    times = [value.timestamp() for value in row.values() if isinstance(value, datetime)]
+    times += [get_changed_at(name) for name in version_names]
+    return etag, int(max(times, default=0))
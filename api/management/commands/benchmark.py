@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+from api.benchmark import percentile, run
+
+
+class Command(BaseCommand):
+    help = ("Measures the throughput of a running server under concurrent GET requests. Run it once "
+            "against each stack (see README) with the same DB_QUERY_DELAY to compare them")
+
+    def add_arguments(self, parser):
+        parser.add_argument('urls', nargs='+', help="URLs to request, in turn")
+        parser.add_argument('--concurrency', '-c', type=int, default=50, help="Requests in flight at once (default: 50)")
+        parser.add_argument('--requests', '-n', type=int, default=1000, help="Requests in all (default: 1000)")
+        parser.add_argument('--token', help="Access token to send as 'Authorization: JWT <token>'")
+
+    def handle(self, *args, **options):
+        if options['concurrency'] < 1 or options['requests'] < options['concurrency']:
+            raise CommandError("Need at least one request per concurrent client.")
+        headers = {'Authorization': 'JWT ' + options['token']} if options['token'] else None
+        elapsed, results = run(options['urls'], options['concurrency'], options['requests'], headers)
+
+        latencies = [latency for status, latency in results if status == 200]
+        failed = len(results) - len(latencies)
+        self.stdout.write("%d requests, %d concurrent, in %.2fs" % (len(results), options['concurrency'], elapsed))
+        self.stdout.write("Throughput: %.1f requests/s" % (len(latencies) / elapsed))
+        self.stdout.write("Latency: p50 %.0fms, p95 %.0fms, p99 %.0fms" % tuple(
+            percentile(latencies, fraction) * 1000 for fraction in (0.5, 0.95, 0.99)))
+        if failed:
+            self.stdout.write(self.style.WARNING("%d requests failed or did not return 200" % failed))
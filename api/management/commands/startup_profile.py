@@ -0,0 +1,79 @@
+import json
+import os
+import subprocess
+import sys
+from collections import Counter
+from django.core.management.base import BaseCommand, CommandError
+
+# Runs in a fresh interpreter under -X importtime, so that nothing is imported
+# yet: times each boot phase and the first two requests to each URL, noting
+# which packages the first request had to import. Prints the timings as JSON.
+PROFILE = '''
+import json, sys, time
+started = time.perf_counter()
+import django
+django.setup()
+setup = time.perf_counter()
+from django.urls import get_resolver
+get_resolver().url_patterns
+urls = time.perf_counter()
+from django.conf import settings
+from django.test import Client
+settings.ALLOWED_HOSTS = list(settings.ALLOWED_HOSTS) + ['testserver']
+client = Client(raise_request_exception=False)
+requests = []
+for url in sys.argv[1:]:
+    before = set(sys.modules)
+    started_request = time.perf_counter()
+    status = client.get(url).status_code
+    first = time.perf_counter() - started_request
+    imported = sorted({name.split('.')[0] for name in set(sys.modules) - before})
+    started_request = time.perf_counter()
+    client.get(url)
+    requests.append([url, status, first, time.perf_counter() - started_request, imported])
+print(json.dumps({'phases': [['django.setup()', setup - started], ['URL configuration', urls - setup]],
+                  'requests': requests}))
+'''
+
+DEFAULT_URLS = ['/api/subjects/', '/api/paths/published/', '/api/']
+
+
+class Command(BaseCommand):
+    help = ("Profiles a cold start: import time per package, the time of each boot phase, "
+            "and the latency of the first request to each URL compared with the second")
+
+    def add_arguments(self, parser):
+        parser.add_argument('urls', nargs='*', help="URLs to request (default: %s)" % ', '.join(DEFAULT_URLS))
+        parser.add_argument('--top', type=int, default=15, help="How many packages to list (default: 15)")
+
+    def handle(self, *args, **options):
+        process = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', PROFILE] + (options['urls'] or DEFAULT_URLS),
+            capture_output=True, text=True, env=os.environ)
+        if process.returncode:
+            raise CommandError("Profiling failed:\n" + process.stderr[-2000:])
+        timings = json.loads(process.stdout.strip().splitlines()[-1])
+
+        # "import time: <self us> | <cumulative us> | <module>", children first
+        packages = Counter()
+        for line in process.stderr.splitlines():
+            if not line.startswith('import time:'):
+                continue
+            own, _, name = line[len('import time:'):].split('|')
+            if own.strip().isdigit():
+                packages[name.strip().split('.')[0]] += int(own) / 1e6
+
+        self.stdout.write("Boot")
+        for phase, seconds in timings['phases']:
+            self.stdout.write("  %-30s %8.0fms" % (phase, seconds * 1000))
+        self.stdout.write("  %-30s %8.0fms" % ("of which imports", sum(packages.values()) * 1000))
+
+        self.stdout.write("Import time by package")
+        for package, seconds in packages.most_common(options['top']):
+            self.stdout.write("  %-30s %8.1fms" % (package, seconds * 1000))
+
+        self.stdout.write("First requests (first / second)")
+        for url, status, first, second, imported in timings['requests']:
+            self.stdout.write("  %-30s %8.0fms / %.0fms  [%d]" % (url, first * 1000, second * 1000, status))
+            if imported:
+                self.stdout.write("    imported " + ', '.join(imported))
@@ -0,0 +1,56 @@
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import CursorPagination, PageNumberPagination
+from rest_framework.response import Response
+
+
+class KeysetPagination(CursorPagination):
+    # Pages are cut on the primary key, so fetching a page costs the same
+    # however far into the table it is
+    ordering = 'id'
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 500
+
+
+class RankedPagination(PageNumberPagination):
+    # For results ordered by relevance, where there is no key to cut pages on
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+
+def paginated_response(request, queryset, serializer_class, **kwargs):
+    # Pagination is opt-in: clients that send neither cursor nor page_size
+    # keep getting the plain list they always got
+    if 'cursor' not in request.query_params and 'page_size' not in request.query_params:
+        return Response(serializer_class(queryset, many=True, **kwargs).data)
+    paginator = KeysetPagination()
+    page = paginator.paginate_queryset(queryset, request)
+    return paginator.get_paginated_response(serializer_class(page, many=True, **kwargs).data)
+
+
+def _boolean(value):
+    if value.lower() in ('true', '1'):
+        return True
+    if value.lower() in ('false', '0'):
+        return False
+    raise ValueError
+
+
+# Converters for the values of filter query parameters
+FILTER_TYPES = {int: int, bool: _boolean}
+
+
+def filter_queryset(request, queryset, filters):
+    # filters maps a query parameter to (model lookup, type), e.g.
+    # {'author': ('author_id', int)}; parameters that are absent are ignored.
+    # Takes DRF and plain Django requests alike.
+    for param, (lookup, kind) in filters.items():
+        value = request.GET.get(param)
+        if value is None:
+            continue
+        try:
+            queryset = queryset.filter(**{lookup: FILTER_TYPES[kind](value)})
+        except ValueError:
+            raise ValidationError({param: "Invalid value '" + value + "'."})
+    return queryset
@@ -0,0 +1,98 @@
+import random
+import time
+from asgiref.local import Local
+from django.conf import settings
+from django.core import signing
+from django.db import DEFAULT_DB_ALIAS
+
+# With REPLICA_READS on, sends the reads of learner-facing GET requests to
+# the read replicas in DATABASE_REPLICAS (see captain/settings.py);
+# everything else stays on the default database. A write that goes through
+# pins whoever sent it to the default database for REPLICA_PIN_SECONDS, so
+# they never read data older than their own write while the replicas catch
+# up. The pin is a signed token that travels with the client, as a cookie
+# and, for clients that keep no cookies, as a header to send back: it holds
+# whichever worker answers next, and for writes that have no user yet
+# (signing up, obtaining a token).
+
+# Views whose reads may be served by a replica, by URL name
+REPLICA_VIEWS = {
+    'api:topics',
+    'api:topicDetail',
+    'api:pathDetail',
+    'api:publishedPathsList',
+    'api:progresses',
+}
+
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+PIN_COOKIE = 'replica_pin'
+PIN_HEADER = 'X-Replica-Pin'
+
+_signer = signing.Signer(salt='api.replicas.pin')
+
+# The database the reads of the request being served go to; None for the
+# default one
+_local = Local()
+
+
+def reading_from_replica():
+    # Whether the request being served reads from a replica, which may be
+    # behind: what it reads must not be cached for others
+    return getattr(_local, 'database', None) is not None
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        return getattr(_local, 'database', None)
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same rows as the default database
+        return True
+
+    def allow_migrate(self, db, app_label, **hints):
+        # Replicas get their schema from the default database
+        return db not in settings.DATABASE_REPLICAS
+
+
+def pin_to_primary(response):
+    # The pin is the signed time it runs out
+    pin = _signer.sign(str(time.time() + settings.REPLICA_PIN_SECONDS))
+    response.set_cookie(PIN_COOKIE, pin, max_age=settings.REPLICA_PIN_SECONDS, httponly=True,
+                        secure=settings.SESSION_COOKIE_SECURE, samesite='Lax')
+    response[PIN_HEADER] = pin
+
+
+def is_pinned(request):
+    for pin in (request.COOKIES.get(PIN_COOKIE), request.headers.get(PIN_HEADER)):
+        if pin:
+            try:
+                if float(_signer.unsign(pin)) > time.time():
+                    return True
+            except (signing.BadSignature, ValueError):
+                pass
+    return False
+
+
+class ReplicaMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        _local.database = None
+        try:
+            response = self.get_response(request)
+        finally:
+            _local.database = None
+        # A write that went through pins its sender to the default database
+        if settings.REPLICA_READS and request.method not in READ_METHODS and response.status_code < 400:
+            pin_to_primary(response)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if (settings.REPLICA_READS and settings.DATABASE_REPLICAS and request.method in READ_METHODS
+                and request.resolver_match.view_name in REPLICA_VIEWS and not is_pinned(request)):
+            _local.database = random.choice(settings.DATABASE_REPLICAS)
@@ -2,8 +2,89 @@ from django.db.models import fields
 from django.db.models.fields.related import RelatedField
 from rest_framework import serializers
 from rest_framework.fields import BooleanField, CharField
-from rest_framework.relations import PrimaryKeyRelatedField
-from knowledge.models import Subject, Topic, Path, PathTopicSequence, TopicProgress
+from rest_framework.relations import PKOnlyObject, PrimaryKeyRelatedField
+from django.core.exceptions import FieldDoesNotExist
+from django.db import transaction
+from django.db.models import Prefetch
+from knowledge.models import Option, Question, Subject, Topic, Path, PathTopicSequence, TopicProgress
+from knowledge.tree import MOVE_POSITIONS, ROOT_SUBJECT_ID
+from knowledge.versions import PATH_TOPIC_SEQUENCE, bump_version_on_commit
+
+
+def requested_fields(request):
+    # The fields asked for with ?fields=a,b (None when not given); reads
+    # request.GET so that it works on plain Django requests too
+    fields = request.GET.get('fields')
+    if fields is None:
+        return None
+    return [field.strip() for field in fields.split(',') if field.strip()]
+
+
+class SparseFieldsetsMixin:
+    # Accepts fields=[...] to output only some of the declared fields, and
+    # works out which columns those fields need so that views can load just
+    # those with .only(). Fields whose columns can't be read off their source
+    # (model methods) list them in Meta.field_columns.
+
+    def __init__(self, *args, **kwargs):
+        fields = kwargs.pop('fields', None)
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+    @classmethod
+    def columns(cls, fields=None):
+        model = cls.Meta.model
+        field_columns = getattr(cls.Meta, 'field_columns', {})
+        columns = {model._meta.pk.name}
+        for name, field in cls(fields=fields).fields.items():
+            if name in field_columns:
+                columns.update(field_columns[name])
+                continue
+            try:
+                model_field = model._meta.get_field(field.source.split('.')[0])
+            except FieldDoesNotExist:
+                continue
+            if model_field.concrete and not model_field.many_to_many:
+                columns.add(model_field.name)
+        return columns
+
+    @classmethod
+    def project(cls, queryset, fields=None):
+        return queryset.only(*cls.columns(fields))
+
+# The root subject has no row (see knowledge.tree); clients may still send
+# its id, which means no subject / top level
+
+class SubjectField(PrimaryKeyRelatedField):
+    def to_internal_value(self, data):
+        if str(data) == str(ROOT_SUBJECT_ID):
+            return None
+        return super().to_internal_value(data)
+
+class SubjectParentField(SubjectField):
+    # Top-level subjects show the root subject as their parent
+    def get_attribute(self, instance):
+        if instance.parent_id is None:
+            return PKOnlyObject(pk=ROOT_SUBJECT_ID)
+        return super().get_attribute(instance)
+
+class TopicSubjectField(SubjectField):
+    # Topics filed under the root subject show it as their subject
+    def get_attribute(self, instance):
+        if instance.at_root:
+            return PKOnlyObject(pk=ROOT_SUBJECT_ID)
+        return super().get_attribute(instance)
+
+class TopicSubjectMixin:
+    # Files a topic sent with the root subject's id under it, rather than
+    # leaving it without a subject
+    def validate(self, data):
+        data = super().validate(data)
+        if 'subject' in data:
+            data['at_root'] = data['subject'] is None and str(self.initial_data.get('subject')) == str(ROOT_SUBJECT_ID)
+        return data
 
 class ChildrenSerializer(serializers.ModelSerializer):
     # d_count = serializers.IntegerField(source='get_descendant_count')
@@ -11,30 +92,57 @@ class ChildrenSerializer(serializers.ModelSerializer):
         model = Subject
         fields = ('id', 'name', 'display_name', 'children')
 
-class TopicListSerializer(serializers.ModelSerializer):
+class TopicListSerializer(TopicSubjectMixin, SparseFieldsetsMixin, serializers.ModelSerializer):
     authorName = serializers.CharField(source='author', read_only=True)
+    subject = TopicSubjectField(queryset=Subject.objects.all(), allow_null=True, required=False)
     class Meta:
         model = Topic
         fields = ('id', 'title', 'about', 'author', 'authorName', 'subject', 'requires', 'breadcrumbs')
+        field_columns = {'subject': ('subject', 'at_root'), 'breadcrumbs': ('subject', 'at_root')}
 
 class BreadcrumbSerializer(serializers.ModelSerializer):
     class Meta:
         model = Subject
         fields = ('id', 'name')
 
-class SubjectSerializer(serializers.ModelSerializer):
+class SubjectSerializer(SparseFieldsetsMixin, serializers.ModelSerializer):
     hasChildren = BooleanField(source='get_descendant_count', read_only=True)
     isChildrenLoading = BooleanField(default=False, read_only=True)
     isExpanded = BooleanField(default=False, read_only=True)
+    parent = SubjectParentField(queryset=Subject.objects.all(), allow_null=True)
     # breadcrumbs = BreadcrumbSerializer(many=True, source='get_ancestors(include_self=True)')
     class Meta:
         model = Subject
         fields = ('id', 'children', 'hasChildren', 'isExpanded', 'isChildrenLoading', 'name', 'display_name', 'breadcrumbs', 'parent')
         extra_kwargs = {'children': {'required':False}}
+        field_columns = {'hasChildren': ('lft', 'rght')}
         # depth = 1
 
-class SubjectDetailSerializer(serializers.ModelSerializer):
-    topics = TopicListSerializer(many=True, read_only=True)
+    def validate(self, data):
+        # unique_together leaves out top-level subjects, their parent is NULL
+        if 'parent' in data and data['parent'] is None:
+            siblings = Subject.objects.filter(parent=None, name=data.get('name'))
+            if self.instance is not None:
+                siblings = siblings.exclude(pk=self.instance.pk)
+            if siblings.exists():
+                raise serializers.ValidationError("The fields name, parent must make a unique set.", code='unique')
+        return data
+
+class SubjectMoveSerializer(serializers.Serializer):
+    id = serializers.IntegerField()
+    targetId = serializers.IntegerField()
+    position = serializers.ChoiceField(choices=MOVE_POSITIONS, default='last-child')
+
+class SubjectTopicsSerializer(serializers.ListSerializer):
+    # The root subject has no row, so its topics are looked up by Topic.at_root
+    def get_attribute(self, instance):
+        if instance.id == ROOT_SUBJECT_ID:
+            return Topic.objects.filter(at_root=True).prefetch_related(
+                Prefetch('requires', queryset=Topic.objects.only('id')))
+        return super().get_attribute(instance)
+
+class SubjectDetailSerializer(SparseFieldsetsMixin, serializers.ModelSerializer):
+    topics = SubjectTopicsSerializer(child=TopicListSerializer(), read_only=True)
     class Meta:
         model = Subject
         fields = ('id', 'name', 'about', 'topics', 'breadcrumbs')
@@ -64,12 +172,24 @@ class TopicProgressSerializer(serializers.ModelSerializer):
         model = TopicProgress
         fields = ('verifiable', 'completed')
 
-class TopicListProgressSerializer(serializers.ModelSerializer):
+# Progress rows as exchanged with offline clients
+class TopicProgressSyncSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = TopicProgress
+        fields = ('topic', 'verifiable', 'completed', 'updated_at')
+
+class TopicProgressEntrySerializer(serializers.Serializer):
+    topic = serializers.IntegerField()
+    completed = serializers.BooleanField()
+    verifiable = serializers.BooleanField()
+
+class TopicListProgressSerializer(SparseFieldsetsMixin, serializers.ModelSerializer):
     authorName = serializers.CharField(source='author', read_only=True)
     progress = TopicProgressSerializer(many=True, source='filtered_progress')
     class Meta:
         model = Topic
         fields = ('id', 'title', 'about', 'author', 'authorName', 'requires', 'breadcrumbs', 'progress')
+        field_columns = {'breadcrumbs': ('subject', 'at_root')}
 
 class TopicProgressMinSerializer(serializers.ModelSerializer):
     progress = TopicProgressSerializer(many=True)
@@ -77,12 +197,34 @@ class TopicProgressMinSerializer(serializers.ModelSerializer):
         model = Topic
         fields = ('id', 'title', 'requires', 'progress')
 
-class TopicDetailSerializer(serializers.ModelSerializer):
+# Quizzes are marked by the client, so the answers go out with the questions
+class QuizOptionSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Option
+        fields = ('id', 'option', 'correct')
+
+class QuizQuestionSerializer(serializers.ModelSerializer):
+    options = QuizOptionSerializer(many=True, source='option_set')
+    commonData = serializers.CharField(source='question_group.common_data', default=None)
+    class Meta:
+        model = Question
+        fields = ('id', 'question_text', 'difficulty', 'commonData', 'options', 'explanation')
+
+class TopicPrerequisiteSerializer(serializers.ModelSerializer):
+    depth = serializers.IntegerField(read_only=True)
+    progress = TopicProgressSerializer(many=True, source='filtered_progress')
+    class Meta:
+        model = Topic
+        fields = ('id', 'title', 'requires', 'depth', 'progress')
+
+class TopicDetailSerializer(TopicSubjectMixin, SparseFieldsetsMixin, serializers.ModelSerializer):
     authorName = serializers.CharField(source='author', read_only=True)
     requires = TopicProgressMinSerializer(many=True, read_only=True)
+    subject = TopicSubjectField(queryset=Subject.objects.all(), allow_null=True, required=False)
     class Meta:
         model = Topic
         fields = ('id', 'title', 'about', 'author', 'authorName', 'requires', 'subject', 'breadcrumbs', 'assessor', 'steps' )
+        field_columns = {'subject': ('subject', 'at_root'), 'breadcrumbs': ('subject', 'at_root')}
 
 class PathTopicSequenceProgressSerializer(serializers.ModelSerializer):
     topic = TopicListProgressSerializer()
@@ -90,7 +232,7 @@ class PathTopicSequenceProgressSerializer(serializers.ModelSerializer):
         model = PathTopicSequence
         fields = ('order', 'topic')
     
-class PathDetailRetrieveSerializer(serializers.ModelSerializer):
+class PathDetailRetrieveSerializer(SparseFieldsetsMixin, serializers.ModelSerializer):
     topic_sequence = PathTopicSequenceProgressSerializer(many=True)
     authorName = serializers.CharField(source='author', read_only=True)
     class Meta:
@@ -117,22 +259,44 @@ class PathDetailSerializer(serializers.ModelSerializer):
         instance.published = validated_data.get('published', instance.published)
         instance.author = validated_data.get('author', instance.author)
 
-        # First delete existing topic_sequence data for this path
-        instance.topic_sequence.all().delete()
-        instance.save()
-        
-        topic_seq_data = self.initial_data['topic_sequence']
-        for item in topic_seq_data:
-            order = item['order']
-            topic_id = item['topic']['id']
+        # Work out the wanted order -> topic mapping and check it before writing anything
+        wanted = {}
+        for item in self.initial_data['topic_sequence']:
+            order = item.get('order')
             try:
-                PathTopicSequence.objects.create(order=order, path=instance, topic_id=topic_id)
-            except:
+                topic_id = int(item['topic']['id'])
+                if int(order) < 0 or int(order) in wanted:
+                    raise ValueError
+            except (KeyError, TypeError, ValueError):
+                raise serializers.ValidationError("Error in given Topic Sequence: "+str(order))
+            wanted[int(order)] = topic_id
+        existing = set(Topic.objects.filter(id__in=wanted.values()).values_list('id', flat=True))
+        for order, topic_id in wanted.items():
+            if topic_id not in existing:
                 raise serializers.ValidationError("Error in given Topic Sequence: "+str(order))
 
+        # Rows are matched up by order, so only the difference is written and
+        # no two rows ever hold the same (path, order) at once
+        with transaction.atomic():
+            instance.save()
+            current = {item.order: item for item in instance.topic_sequence.select_for_update()}
+            removed = [order for order in current if order not in wanted]
+            if removed:
+                instance.topic_sequence.filter(order__in=removed).delete()
+            changed = []
+            for order, item in current.items():
+                if order in wanted and item.topic_id != wanted[order]:
+                    item.topic_id = wanted[order]
+                    changed.append(item)
+            PathTopicSequence.objects.bulk_update(changed, ['topic'])
+            PathTopicSequence.objects.bulk_create([PathTopicSequence(order=order, path=instance, topic_id=topic_id)
+                                                   for order, topic_id in wanted.items() if order not in current])
+            # The bulk writes send no post_save
+            bump_version_on_commit(PATH_TOPIC_SEQUENCE)
+
         return instance
 
-class PathListSerializer(serializers.ModelSerializer):
+class PathListSerializer(SparseFieldsetsMixin, serializers.ModelSerializer):
     authorName = serializers.CharField(source='author', read_only=True)
     class Meta:
         model = Path
@@ -0,0 +1,122 @@
+import asyncio
+import queue
+import threading
+from django.core.handlers.asgi import ASGIHandler
+from django.db import connections
+from django.http.response import StreamingHttpResponse
+
+# Under ASGI, Django 4.1 iterates a streaming response on the event loop,
+# where the database can't be used, and it takes no async iterators (4.2
+# does). So a streamed body that reads the database is produced on a thread
+# of its own (ThreadedIterator) and sent as a ThreadedStreamingHttpResponse,
+# whose chunks StreamingASGIHandler (captain.asgi) awaits from a worker
+# thread, rather than waiting for each of them on the loop.
+
+# Items produced ahead of the client
+QUEUE_SIZE = 16
+
+# Seconds between checks, while waiting, that the other side is still there
+POLL_INTERVAL = 0.1
+
+_DONE = object()
+
+
+class ThreadedIterator:
+    def __init__(self, iterable):
+        self._queue = queue.Queue(QUEUE_SIZE)
+        self._closed = threading.Event()
+        self._finished = False
+        threading.Thread(target=self._produce, args=(iterable,), daemon=True).start()
+
+    def _produce(self, iterable):
+        # Everything the iterable does, including leaving a transaction when
+        # it is closed early, happens on this thread and its connections
+        iterator = iter(iterable)
+        try:
+            for item in iterator:
+                if not self._put((item, None)):
+                    break
+            else:
+                self._put((_DONE, None))
+        except BaseException as error:
+            self._put((None, error))
+        finally:
+            if hasattr(iterator, 'close'):
+                iterator.close()
+            connections.close_all()
+
+    def _put(self, entry):
+        # False once the response was closed, when no one reads any more
+        while not self._closed.is_set():
+            try:
+                self._queue.put(entry, timeout=POLL_INTERVAL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get(self):
+        # The next (item, error) entry; the end once the response was closed
+        while not self._closed.is_set():
+            try:
+                return self._queue.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                pass
+        return _DONE, None
+
+    def _next(self, entry):
+        item, error = entry
+        if error is not None or item is _DONE:
+            self._finished = True
+        if error is not None:
+            raise error
+        return item
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._finished:
+            raise StopIteration
+        item = self._next(self._get())
+        if item is _DONE:
+            raise StopIteration
+        return item
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._finished:
+            raise StopAsyncIteration
+        item = self._next(await asyncio.get_running_loop().run_in_executor(None, self._get))
+        if item is _DONE:
+            raise StopAsyncIteration
+        return item
+
+    def close(self):
+        # Called by the response once sent, or when the client went away
+        self._finished = True
+        self._closed.set()
+
+
+class ThreadedStreamingHttpResponse(StreamingHttpResponse):
+    # Streams what a ThreadedIterator produces
+    def __init__(self, iterator, *args, **kwargs):
+        super().__init__(iterator, *args, **kwargs)
+        self.iterator = iterator
+
+
+class StreamingASGIHandler(ASGIHandler):
+    async def send_response(self, response, send):
+        if not isinstance(response, ThreadedStreamingHttpResponse):
+            return await super().send_response(response, send)
+        # Headers as the base class sends them, then each chunk as it comes
+        headers = [(str(header).encode('ascii'), str(value).encode('latin1')) for header, value in response.items()]
+        headers += [(b'Set-Cookie', cookie.output(header='').encode('ascii').strip())
+                    for cookie in response.cookies.values()]
+        await send({'type': 'http.response.start', 'status': response.status_code, 'headers': headers})
+        async for part in response.iterator:
+            for chunk, _ in self.chunk_bytes(response.make_bytes(part)):
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body'})
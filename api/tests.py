@@ -1,8 +1,37 @@
-from django.conf.urls import url
+import asyncio
+import io
+import os
+import sys
+import threading
+from importlib import import_module
+import time
+from datetime import timedelta
+from unittest import mock
+from asgiref.sync import async_to_sync
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import connection, connections, transaction
+from django.db.utils import OperationalError
+from django.test import RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
-from knowledge.models import Topic
+from django.utils import timezone
+from django.core.files.uploadedfile import SimpleUploadedFile
+from knowledge.models import Option, Path, PathTopicSequence, Question, Subject, Topic, TopicProgress, TopicRequirementClosure
+from knowledge.search import trigram_installed
+from knowledge.tree import MOVE_POSITIONS, ROOT_SUBJECT_ID
 from django.contrib.auth.models import User
-from rest_framework.test import APIClient, APITestCase
+from rest_framework.test import APIClient, APITestCase, APITransactionTestCase
+from rest_framework_simplejwt.tokens import AccessToken
+from api import async_views
+from api.serializers import TopicDetailSerializer
+from api.replicas import PIN_HEADER
+from captain import asgi
+from captain.pooled_postgres.base import DatabaseWrapper as PooledDatabaseWrapper
+from captain.pooled_postgres.pool import close_pools
+from users.models import CaptainUser
 
 
 class TopicTests(APITestCase):
@@ -30,3 +59,1077 @@ class TopicTests(APITestCase):
             }, format='json')
 
         print(response.data)
+
+
+class SubjectTreeTests(APITestCase):
+
+    def setUp(self):
+        self.maths = Subject.objects.create(name='Maths')
+        self.algebra = Subject.objects.create(name='Algebra', parent=self.maths)
+        self.physics = Subject.objects.create(name='Physics')
+
+    def test_tree_is_nested_under_root(self):
+        url = reverse('api:subjectTree')
+        with self.assertNumQueries(1):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([node['name'] for node in response.data], ['Maths', 'Physics'])
+        self.assertEqual(response.data[0]['children'][0]['id'], self.algebra.id)
+        # Served from the cache the second time round
+        with self.assertNumQueries(0):
+            self.client.get(url)
+
+    def test_etag_changes_when_tree_changes(self):
+        url = reverse('api:subjectTree')
+        etag = self.client.get(url)['ETag']
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        self.algebra.move_to(self.physics, position='last-child')
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.data[1]['children'][0]['id'], self.algebra.id)
+
+
+class TopicRequirementsTests(APITestCase):
+
+    def setUp(self):
+        self.admin = CaptainUser.objects.create_superuser('admin@example.com', 'Admin', '123456789')
+        self.client.force_authenticate(self.admin)
+        self.a, self.b, self.c, self.d = [Topic.objects.create(title=t, author=self.admin) for t in 'abcd']
+        with self.captureOnCommitCallbacks(execute=True):
+            self.a.requires.add(self.b)
+            self.d.requires.add(self.a)
+
+    def put(self, topic, requires):
+        return self.client.put(reverse('api:topicDetail', kwargs={'pk': topic.id}), {
+            'title': topic.title, 'about': '', 'author': self.admin.id, 'subject': None,
+            'steps': [], 'assessor': {},
+            'requires': [{'id': t.id, 'title': t.title} for t in requires],
+        }, format='json')
+
+    def test_put_replaces_requirements(self):
+        response = self.put(self.a, [self.b, self.c])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(self.a.requires.all()), {self.b, self.c})
+
+    def test_put_with_a_loop_changes_nothing(self):
+        response = self.put(self.a, [self.c, self.d])
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("d", response.data)
+        self.assertEqual(set(self.a.requires.all()), {self.b})
+
+    def test_put_with_missing_topic_changes_nothing(self):
+        missing = Topic(id=self.d.id + 100, title='missing')
+        response = self.put(self.a, [self.c, missing])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(set(self.a.requires.all()), {self.b})
+
+
+class ConcurrentRequirementsTests(APITransactionTestCase):
+
+    def setUp(self):
+        self.admin = CaptainUser.objects.create_superuser('admin@example.com', 'Admin', '123456789')
+        self.a, self.b = [Topic.objects.create(title=t, author=self.admin) for t in 'ab']
+
+    def test_opposite_requirements_at_once_make_no_loop(self):
+        # Each request runs in its own thread and connection, with every
+        # query slowed down so that both loop checks would run before either
+        # requirement is added if nothing kept them apart
+        barrier = threading.Barrier(2)
+        responses = []
+
+        def patch(topic, required):
+            client = APIClient()
+            client.force_authenticate(self.admin)
+            with connection.execute_wrapper(lambda execute, *args: time.sleep(0.02) or execute(*args)):
+                barrier.wait()
+                responses.append(client.patch(reverse('api:topicRequirement', kwargs={'pk': topic.id, 'rTopicId': required.id})))
+            connection.close()
+
+        threads = [threading.Thread(target=patch, args=pair) for pair in ((self.a, self.b), (self.b, self.a))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(response.status_code for response in responses), [200, 400])
+        closure = set(TopicRequirementClosure.objects.values_list('ancestor_id', 'descendant_id', 'depth'))
+        TopicRequirementClosure.objects.rebuild()
+        self.assertEqual(closure, set(TopicRequirementClosure.objects.values_list('ancestor_id', 'descendant_id', 'depth')))
+
+
+class TopicPrerequisitesTests(APITestCase):
+
+    def setUp(self):
+        self.user = CaptainUser.objects.create_user('learner@example.com', 'Learner', '123456789')
+        self.client.force_authenticate(self.user)
+        # e requires c and d, c requires b and d, b requires a
+        self.a, self.b, self.c, self.d, self.e = [Topic.objects.create(title=t) for t in 'abcde']
+        with self.captureOnCommitCallbacks(execute=True):
+            self.e.requires.add(self.c, self.d)
+            self.c.requires.add(self.b, self.d)
+            self.b.requires.add(self.a)
+        TopicProgress.objects.create(student=self.user, topic=self.a, completed=True)
+
+    def test_prerequisites_in_topological_order(self):
+        # b and c are required by others, but their lesson content is not read
+        Topic.objects.filter(id__in=(self.b.id, self.c.id)).update(steps=[{'text': 'x' * 100000}], assessor={'kind': 'quiz'})
+        url = reverse('api:topicPrerequisites', kwargs={'pk': self.e.id})
+        with self.assertNumQueries(4) as queries:
+            response = self.client.get(url)
+        for query in queries.captured_queries:
+            self.assertNotIn('"steps"', query['sql'])
+            self.assertNotIn('"assessor"', query['sql'])
+        self.assertEqual([t['id'] for t in response.data],
+                         [self.a.id, self.b.id, self.d.id, self.c.id])
+        self.assertEqual([t['depth'] for t in response.data], [3, 2, 1, 1])
+        self.assertEqual(response.data[0]['progress'], [{'verifiable': False, 'completed': True}])
+        self.assertEqual(response.data[1]['progress'], [])
+
+    def test_depth_limits_the_walk(self):
+        url = reverse('api:topicPrerequisites', kwargs={'pk': self.e.id})
+        response = self.client.get(url, {'depth': 1})
+        self.assertEqual([t['id'] for t in response.data], [self.d.id, self.c.id])
+        self.assertEqual(self.client.get(url, {'depth': 'x'}).status_code, 400)
+
+
+class KeysetPaginationTests(APITestCase):
+
+    def setUp(self):
+        self.subject = Subject.objects.create(name='Maths')
+        self.topics = [Topic.objects.create(title='Topic %d' % i, subject=self.subject if i % 2 else None)
+                       for i in range(5)]
+
+    def test_unpaginated_by_default(self):
+        response = self.client.get(reverse('api:topics'))
+        self.assertEqual(len(response.data), 5)
+
+    def test_pages_follow_the_cursor(self):
+        response = self.client.get(reverse('api:topics'), {'page_size': 2})
+        ids = [t['id'] for t in response.data['results']]
+        while response.data['next']:
+            response = self.client.get(response.data['next'])
+            ids += [t['id'] for t in response.data['results']]
+        self.assertEqual(ids, [t.id for t in self.topics])
+
+    def test_filters(self):
+        response = self.client.get(reverse('api:topics'), {'subject': self.subject.id, 'page_size': 10})
+        self.assertEqual([t['id'] for t in response.data['results']], [self.topics[1].id, self.topics[3].id])
+        self.assertEqual(self.client.get(reverse('api:topics'), {'subject': 'x'}).status_code, 400)
+
+
+class SparseFieldsetsTests(APITestCase):
+
+    def setUp(self):
+        self.subject = Subject.objects.create(name='Maths')
+        self.topic = Topic.objects.create(title='Sets', subject=self.subject, steps=[{'body': 'long lesson'}])
+        self.path = Path.objects.create(title='Start here', published=True)
+        PathTopicSequence.objects.create(path=self.path, topic=self.topic, order=1)
+
+    def get(self, url, params=None):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        return response, ' '.join(query['sql'] for query in queries)
+
+    def test_list_views_never_load_lesson_content(self):
+        response, sql = self.get(reverse('api:topics'))
+        self.assertNotIn('steps', sql)
+        self.assertEqual(response.data[0]['breadcrumbs'], [{'id': ROOT_SUBJECT_ID, 'name': 'root'}, {'id': self.subject.id, 'name': 'Maths'}])
+        response, sql = self.get(reverse('api:pathDetail', kwargs={'pk': self.path.id}))
+        self.assertNotIn('steps', sql)
+        self.assertEqual(response.data['topic_sequence'][0]['topic']['title'], 'Sets')
+
+    def test_fields_select_output_and_columns(self):
+        response, sql = self.get(reverse('api:topics'), {'fields': 'id,title'})
+        self.assertEqual(response.data, [{'id': self.topic.id, 'title': 'Sets'}])
+        self.assertNotIn('"about"', sql)
+        response, sql = self.get(reverse('api:topicDetail', kwargs={'pk': self.topic.id}), {'fields': 'title,breadcrumbs'})
+        self.assertEqual(set(response.data), {'title', 'breadcrumbs'})
+        self.assertNotIn('steps', sql)
+        response, sql = self.get(reverse('api:topicDetail', kwargs={'pk': self.topic.id}))
+        self.assertEqual(response.data['steps'], [{'body': 'long lesson'}])
+        response, sql = self.get(reverse('api:subjectDetail', kwargs={'pk': self.subject.id}))
+        self.assertEqual(response.data['topics'][0]['id'], self.topic.id)
+        self.assertNotIn('steps', sql)
+        Subject.objects.create(name='Algebra', parent=self.subject)
+        response, sql = self.get(reverse('api:subjectChildren', kwargs={'pk': self.subject.id}), {'fields': 'id,name,hasChildren'})
+        self.assertEqual(response.data[0]['name'], 'Algebra')
+        self.assertFalse(response.data[0]['hasChildren'])
+
+
+class PathSequenceUpdateTests(APITestCase):
+
+    def setUp(self):
+        self.admin = CaptainUser.objects.create_superuser('admin@example.com', 'Admin', '123456789')
+        self.client.force_authenticate(self.admin)
+        self.topics = [Topic.objects.create(title='Topic %d' % i) for i in range(4)]
+        self.path = Path.objects.create(title='Path', author=self.admin)
+        for order, topic in enumerate(self.topics[:3]):
+            PathTopicSequence.objects.create(path=self.path, topic=topic, order=order)
+
+    def put(self, sequence):
+        return self.client.put(reverse('api:pathDetail', kwargs={'pk': self.path.id}), {
+            'title': 'Path', 'about': '', 'published': False, 'author': self.admin.id,
+            'topic_sequence': [{'order': order, 'topic': {'id': topic.id, 'title': topic.title}}
+                               for order, topic in enumerate(sequence)],
+        }, format='json')
+
+    def sequence(self):
+        return list(self.path.topic_sequence.values_list('topic_id', flat=True))
+
+    def test_reorder_writes_only_the_difference(self):
+        t = self.topics
+        response = self.put([t[1], t[0], t[3]])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.sequence(), [t[1].id, t[0].id, t[3].id])
+        response = self.put([t[1], t[0]])
+        self.assertEqual(self.sequence(), [t[1].id, t[0].id])
+
+    def test_bad_sequence_leaves_path_untouched(self):
+        t = self.topics
+        missing = Topic(id=t[3].id + 100, title='missing')
+        response = self.put([t[2], missing])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.sequence(), [t[0].id, t[1].id, t[2].id])
+
+
+class PathsProgressTests(APITestCase):
+
+    def setUp(self):
+        self.user = CaptainUser.objects.create_user('learner@example.com', 'Learner', '123456789')
+        self.other = CaptainUser.objects.create_user('other@example.com', 'Other', '123456789')
+        self.topics = [Topic.objects.create(title='Topic %d' % i) for i in range(3)]
+        self.path = Path.objects.create(title='Path', published=True)
+        self.empty = Path.objects.create(title='Empty', published=True)
+        Path.objects.create(title='Draft', published=False)
+        for order, topic in enumerate(self.topics):
+            PathTopicSequence.objects.create(path=self.path, topic=topic, order=order)
+        TopicProgress.objects.create(student=self.user, topic=self.topics[0], completed=True, verifiable=True)
+        TopicProgress.objects.create(student=self.user, topic=self.topics[1], completed=True)
+        TopicProgress.objects.create(student=self.other, topic=self.topics[2], completed=True)
+
+    def test_counts_for_requesting_user(self):
+        self.client.force_authenticate(self.user)
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('api:pathsProgress'))
+        self.assertEqual(response.data, [
+            {'id': self.path.id, 'title': 'Path', 'completed': 2, 'verifiable': 1, 'total': 3},
+            {'id': self.empty.id, 'title': 'Empty', 'completed': 0, 'verifiable': 0, 'total': 0},
+        ])
+
+
+class ProgressSyncTests(APITestCase):
+
+    def setUp(self):
+        self.user = CaptainUser.objects.create_user('learner@example.com', 'Learner', '123456789')
+        self.topics = [Topic.objects.create(title='Topic %d' % i) for i in range(3)]
+        TopicProgress.objects.create(student=self.user, topic=self.topics[0], completed=False)
+
+    def test_batch_upserts_in_one_statement(self):
+        self.client.force_authenticate(self.user)
+        entries = [{'topic': t.id, 'completed': True, 'verifiable': i == 2} for i, t in enumerate(self.topics)]
+        with self.assertNumQueries(3):
+            response = self.client.post(reverse('api:progressBatch'), entries, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(TopicProgress.objects.filter(student=self.user, completed=True).count(), 3)
+        self.assertTrue(TopicProgress.objects.get(student=self.user, topic=self.topics[2]).verifiable)
+
+    def test_batch_with_unknown_topic_saves_nothing(self):
+        self.client.force_authenticate(self.user)
+        entries = [{'topic': self.topics[1].id, 'completed': True, 'verifiable': False},
+                   {'topic': self.topics[2].id + 100, 'completed': True, 'verifiable': False}]
+        response = self.client.post(reverse('api:progressBatch'), entries, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(TopicProgress.objects.count(), 1)
+
+    def test_since_returns_only_changed_rows(self):
+        self.client.force_login(self.user)
+        since = TopicProgress.objects.get().updated_at
+        TopicProgress.objects.create(student=self.user, topic=self.topics[1], completed=True)
+        response = self.client.get(reverse('api:progresses'), {'since': since.isoformat()})
+        self.assertEqual([row['topic'] for row in response.json()], [self.topics[1].id])
+        response = self.client.get(reverse('api:progresses'), {'since': 'yesterday'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_watermark_covers_rows_committed_late(self):
+        self.client.force_login(self.user)
+        watermark = self.client.get(reverse('api:progresses'))['X-Sync-Watermark']
+        # Written with a timestamp from before that read, committed after it
+        late = TopicProgress.objects.create(student=self.user, topic=self.topics[1], completed=True)
+        TopicProgress.objects.filter(id=late.id).update(updated_at=timezone.now() - timedelta(seconds=5))
+        response = self.client.get(reverse('api:progresses'), {'since': watermark})
+        self.assertIn(self.topics[1].id, [row['topic'] for row in response.json()])
+
+
+class ResponseCacheTests(APITestCase):
+
+    def setUp(self):
+        self.subject = Subject.objects.create(name='Maths')
+        self.topic = Topic.objects.create(title='Sets', subject=self.subject)
+
+    def test_repeated_reads_skip_the_database(self):
+        url = reverse('api:topicDetail', kwargs={'pk': self.topic.id})
+        self.client.get(url)
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+        self.assertEqual(response.data['title'], 'Sets')
+
+    def test_edits_show_up_immediately(self):
+        url = reverse('api:topicDetail', kwargs={'pk': self.topic.id})
+        self.client.get(url)
+        self.subject.name = 'Mathematics'
+        self.subject.save()
+        self.assertEqual(self.client.get(url).data['breadcrumbs'][-1]['name'], 'Mathematics')
+        self.topic.title = 'Set theory'
+        self.topic.save()
+        self.assertEqual(self.client.get(url).data['title'], 'Set theory')
+
+        url = reverse('api:publishedPathsList')
+        self.client.get(url)
+        Path.objects.create(title='New', published=True)
+        self.assertIn('New', [path['title'] for path in self.client.get(url).data])
+
+
+class ConditionalGetTests(APITestCase):
+
+    def setUp(self):
+        self.user = CaptainUser.objects.create_user('learner@example.com', 'Learner', '123456789')
+        self.other = CaptainUser.objects.create_user('other@example.com', 'Other', '123456789')
+        self.subject = Subject.objects.create(name='Maths')
+        self.sets = Topic.objects.create(title='Sets', subject=self.subject)
+        self.logic = Topic.objects.create(title='Logic', subject=self.subject)
+        self.path = Path.objects.create(title='Path', published=True)
+        PathTopicSequence.objects.create(path=self.path, topic=self.sets, order=0)
+
+    def revalidate(self, url):
+        etag = self.client.get(url)['ETag']
+        return self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code
+
+    def test_unchanged_detail_is_not_modified(self):
+        for url in (reverse('api:topicDetail', kwargs={'pk': self.sets.id}),
+                    reverse('api:subjectDetail', kwargs={'pk': self.subject.id}),
+                    reverse('api:pathDetail', kwargs={'pk': self.path.id})):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.has_header('Last-Modified'))
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.content, b'')
+
+    def test_not_modified_is_answered_without_the_view(self):
+        url = reverse('api:pathDetail', kwargs={'pk': self.path.id})
+        etag = self.client.get(url)['ETag']
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+    def test_requirement_changes_change_the_topic_etag(self):
+        url = reverse('api:topicDetail', kwargs={'pk': self.sets.id})
+        etag = self.client.get(url)['ETag']
+        self.sets.requires.add(self.logic)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        etag = self.client.get(url)['ETag']
+        self.logic.title = 'Propositional logic'
+        self.logic.save()
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_path_etag_follows_the_users_progress(self):
+        url = reverse('api:pathDetail', kwargs={'pk': self.path.id})
+        self.client.force_authenticate(self.user)
+        etag = self.client.get(url)['ETag']
+        TopicProgress.objects.create(student=self.other, topic=self.sets, completed=True)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        TopicProgress.objects.create(student=self.user, topic=self.sets, completed=True)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_missing_objects_are_still_not_found(self):
+        url = reverse('api:topicDetail', kwargs={'pk': self.logic.id + 100})
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH='"x"').status_code, 404)
+
+
+class SearchTests(APITestCase):
+
+    def setUp(self):
+        self.subject = Subject.objects.create(name='Algebra', about='Groups and rings')
+        self.groups = Topic.objects.create(title='Groups', about='Sets with one operation', subject=self.subject)
+        self.lesson = Topic.objects.create(title='Cosets', steps=[{'type': 'text', 'body': 'Lagrange theorem about groups'}])
+        self.question = Question.objects.create(question_text='What is the order of a group?')
+
+    def test_ranked_hits_of_every_kind(self):
+        response = self.client.get(reverse('api:search'), {'q': 'groups'})
+        self.assertEqual(response.status_code, 200)
+        hits = [(hit['kind'], hit['id']) for hit in response.data['results']]
+        # The title match outranks the match in the lesson steps
+        self.assertLess(hits.index(('topic', self.groups.id)), hits.index(('topic', self.lesson.id)))
+        self.assertIn(('subject', self.subject.id), hits)
+        self.assertIn(('question', self.question.id), hits)
+        self.assertEqual(response.data['count'], 4)
+
+    def test_highlights_and_type_filter(self):
+        response = self.client.get(reverse('api:search'), {'q': 'rings', 'type': 'subject,topic'})
+        self.assertEqual(response.data['results'], [{
+            'kind': 'subject', 'id': self.subject.id, 'rank': response.data['results'][0]['rank'],
+            'title': 'Algebra', 'headline': 'Groups and <mark>rings</mark>'}])
+
+    def test_vectors_follow_saves(self):
+        self.groups.title = 'Monoids'
+        self.groups.save()
+        hits = self.client.get(reverse('api:search'), {'q': 'monoid'}).data['results']
+        self.assertEqual([hit['id'] for hit in hits], [self.groups.id])
+        # The keys of lesson steps are not searchable
+        self.assertEqual(self.client.get(reverse('api:search'), {'q': 'body'}).data['count'], 0)
+
+    def test_query_is_required(self):
+        self.assertEqual(self.client.get(reverse('api:search')).status_code, 400)
+        self.assertEqual(self.client.get(reverse('api:search'), {'q': 'x', 'type': 'path'}).status_code, 400)
+
+
+class TopicSuggestTests(APITestCase):
+
+    def setUp(self):
+        self.algebra = Subject.objects.create(name='Algebra')
+        self.groups = Topic.objects.create(title='Algebraic groups')
+        self.rings = Topic.objects.create(title='Rings')
+        self.fields = Topic.objects.create(title='Algebraic fields')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.fields.requires.add(self.groups)
+
+    def suggest(self, **params):
+        response = self.client.get(reverse('api:topicSuggest'), params)
+        self.assertEqual(response.status_code, 200)
+        return [(hit['kind'], hit['id']) for hit in response.data]
+
+    def test_topics_and_subjects(self):
+        self.assertEqual(set(self.suggest(q='alg')), {
+            ('subject', self.algebra.id), ('topic', self.groups.id), ('topic', self.fields.id)})
+        self.assertEqual(len(self.suggest(q='alg', k=2)), 2)
+        self.assertEqual(self.suggest(q='ri', type='topic'), [('topic', self.rings.id)])
+
+    def test_excludes_topics_that_would_make_a_loop(self):
+        # fields requires groups, so neither fields nor groups itself can become a requirement of groups
+        self.assertEqual(self.suggest(q='alg', type='topic', exclude_cycles_for=self.groups.id), [])
+        self.assertEqual(self.suggest(q='alg', type='topic', exclude_cycles_for=self.fields.id), [('topic', self.groups.id)])
+
+    def test_fuzzy_matches(self):
+        if not trigram_installed():
+            self.skipTest("pg_trgm is not available")
+        self.assertEqual(self.suggest(q='algebraik', type='topic')[:2], [('topic', self.fields.id), ('topic', self.groups.id)])
+
+    def test_bad_parameters(self):
+        self.assertEqual(self.client.get(reverse('api:topicSuggest')).status_code, 400)
+        self.assertEqual(self.client.get(reverse('api:topicSuggest'), {'q': 'a', 'k': 'x'}).status_code, 400)
+
+
+class QuizTests(APITestCase):
+
+    def setUp(self):
+        self.topic = Topic.objects.create(title='Sets')
+        self.questions = []
+        for i in range(6):
+            question = Question.objects.create(question_text='Question %d' % i, difficulty='easy' if i % 2 else 'hard')
+            Option.objects.create(question=question, option='Yes', correct=True)
+            Option.objects.create(question=question, option='No', correct=False)
+            self.questions.append(question)
+        for question in self.questions[:4]:
+            question.topics.add(self.topic)
+
+    def draw(self, **params):
+        response = self.client.get(reverse('api:quiz'), params)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_distinct_questions_with_options(self):
+        quiz = self.draw(n=5)
+        self.assertEqual(len(quiz), 5)
+        self.assertEqual(len({question['id'] for question in quiz}), 5)
+        self.assertEqual([option['option'] for option in quiz[0]['options']], ['Yes', 'No'])
+
+    def test_filters(self):
+        ids = {question.id for question in self.questions[:4]}
+        self.assertEqual({question['id'] for question in self.draw(topic=self.topic.id, n=50)}, ids)
+        self.assertEqual({question['id'] for question in self.draw(topic=self.topic.id, difficulty='easy')},
+                         {self.questions[1].id, self.questions[3].id})
+
+    def test_unknown_difficulty(self):
+        response = self.client.get(reverse('api:quiz'), {'difficulty': 'impossible'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_constant_number_of_queries(self):
+        self.draw(n=2)
+        with self.assertNumQueries(2):
+            self.draw(n=6)
+
+    def test_new_questions_are_drawn(self):
+        self.draw(topic=self.topic.id)
+        question = Question.objects.create(question_text='New')
+        question.topics.add(self.topic)
+        self.assertIn(question.id, [question['id'] for question in self.draw(topic=self.topic.id, n=50)])
+
+
+class QuestionImportApiTests(APITestCase):
+
+    def setUp(self):
+        self.admin = CaptainUser.objects.create_superuser('admin@example.com', 'Admin', '123456789')
+
+    def upload(self, name, content):
+        return self.client.post(reverse('api:questionImport'), {'file': SimpleUploadedFile(name, content)}, format='multipart')
+
+    def test_upload(self):
+        self.assertEqual(self.upload('paper.jsonl', b'{"question_text": "Q"}\n').status_code, 401)
+        self.client.force_authenticate(self.admin)
+        response = self.upload('paper.csv', b'question_text,options,correct\nWhich?,A|B,1\n')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data, {'questions': 1, 'options': 2})
+        self.assertEqual(Question.objects.get().author, self.admin)
+
+    def test_bad_file(self):
+        self.client.force_authenticate(self.admin)
+        self.assertEqual(self.upload('paper.txt', b'').status_code, 400)
+        response = self.upload('paper.jsonl', b'{"question_text": "Q"}\nnot json\n')
+        self.assertEqual((response.data['line'], response.data['imported']), (2, 0))
+
+
+class ExportTests(APITestCase):
+
+    def test_staff_only_stream(self):
+        Topic.objects.create(title='Sets')
+        url = reverse('api:export')
+        self.assertEqual(self.client.get(url).status_code, 401)
+        self.client.force_authenticate(CaptainUser.objects.create_superuser('admin@example.com', 'Admin', '123456789'))
+        response = self.client.get(url)
+        self.assertTrue(response.streaming)
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertIn('"title": "Sets"', lines[1])
+
+
+class AsgiExportTests(APITransactionTestCase):
+
+    def setUp(self):
+        Topic.objects.create(title='Sets')
+        admin = CaptainUser.objects.create_superuser('admin@example.com', 'Admin', '123456789')
+        self.scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'scheme': 'http',
+            'method': 'GET', 'path': reverse('api:export'), 'query_string': b'',
+            'headers': [(b'host', b'testserver'), (b'authorization', b'JWT %s' % str(AccessToken.for_user(admin)).encode())],
+            'server': ('testserver', 80), 'client': ('127.0.0.1', 50000),
+        }
+
+    async def export(self, sent):
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            sent.append(message)
+
+        await asgi.application(self.scope, receive, send)
+
+    def lines(self, sent):
+        self.assertEqual(sent[0]['status'], 200)
+        return b''.join(message.get('body', b'') for message in sent[1:]).decode().splitlines()
+
+    def test_stream_through_the_asgi_application(self):
+        # The database can't be read from the event loop
+        sent = []
+        async_to_sync(self.export)(sent)
+        lines = self.lines(sent)
+        self.assertEqual(len(lines), 2)
+        self.assertIn('"title": "Sets"', lines[1])
+
+    def test_event_loop_stays_free_while_the_export_is_read(self):
+        def slow_export_lines(include_progress=False):
+            for title in Topic.objects.values_list('title', flat=True):
+                time.sleep(0.1)
+                yield title + '\n'
+
+        async def run(sent):
+            # Counts the turns the loop takes while the export is sent
+            ticks = 0
+            export = asyncio.ensure_future(self.export(sent))
+            while not export.done():
+                await asyncio.sleep(0.005)
+                ticks += 1
+            await export
+            return ticks
+
+        sent = []
+        with mock.patch('api.views.export_lines', slow_export_lines):
+            ticks = async_to_sync(run)(sent)
+        self.assertEqual(self.lines(sent), ['Sets'])
+        self.assertGreater(ticks, 5)
+
+
+class DatabasePoolTests(APITestCase):
+
+    def setUp(self):
+        # Runs last, after the wrappers have handed their connections back
+        self.addCleanup(close_pools)
+
+    def pooled(self, size=1, timeout=0.1, max_idle=60):
+        # A pooled wrapper of the test database. Its connections are named
+        # after the test, which gives it a pool of its own.
+        wrapper = PooledDatabaseWrapper({
+            **connection.settings_dict,
+            'OPTIONS': {**connection.settings_dict['OPTIONS'], 'application_name': self._testMethodName},
+            'POOL': {'SIZE': size, 'TIMEOUT': timeout, 'MAX_IDLE': max_idle}})
+        self.addCleanup(wrapper.close)
+        return wrapper
+
+    def stats(self, wrapper):
+        return wrapper.connection_pool().stats()
+
+    def test_reuses_connections(self):
+        wrapper = self.pooled()
+        wrapper.ensure_connection()
+        first = wrapper.connection
+        wrapper.close()
+        with wrapper.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        self.assertIs(wrapper.connection, first)
+        self.assertEqual(wrapper.get_autocommit(), True)
+        stats = self.stats(wrapper)
+        self.assertEqual((stats['checkouts'], stats['opened'], stats['in_use']), (2, 1, 1))
+
+    def test_rolls_back_on_checkin(self):
+        wrapper = self.pooled()
+        wrapper.ensure_connection()
+        wrapper.set_autocommit(False)
+        with wrapper.cursor() as cursor:
+            cursor.execute("CREATE TEMPORARY TABLE pooled (id int)")
+        wrapper.close()
+        with wrapper.cursor() as cursor:
+            cursor.execute("SELECT count(*) FROM pg_tables WHERE tablename = 'pooled'")
+            self.assertEqual(cursor.fetchone(), (0,))
+
+    def test_resets_the_session_on_checkin(self):
+        wrapper = self.pooled()
+        with wrapper.cursor() as cursor:
+            cursor.execute("SET statement_timeout = 1234")
+            cursor.execute("SELECT pg_advisory_lock(1)")
+        first = wrapper.connection
+        wrapper.close()
+        # Back to the settings Django connects with, without setting them again
+        self.assertEqual((first.get_parameter_status('TimeZone'), first.get_parameter_status('client_encoding')),
+                         (wrapper.timezone_name, 'UTF8'))
+        with wrapper.cursor() as cursor:
+            self.assertIs(wrapper.connection, first)
+            cursor.execute("SHOW statement_timeout")
+            self.assertEqual(cursor.fetchone(), ('0',))
+            cursor.execute("SELECT count(*) FROM pg_locks WHERE locktype = 'advisory' AND pid = pg_backend_pid()")
+            self.assertEqual(cursor.fetchone(), (0,))
+
+    def test_health_check_replaces_dead_connections(self):
+        wrapper = self.pooled()
+        wrapper.ensure_connection()
+        pid = wrapper.connection.get_backend_pid()
+        wrapper.close()
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_terminate_backend(%s)", [pid])
+        wrapper.ensure_connection()
+        self.assertNotEqual(wrapper.connection.get_backend_pid(), pid)
+        stats = self.stats(wrapper)
+        self.assertEqual((stats['opened'], stats['discarded']), (2, 1))
+
+    def test_recycles_idle_connections(self):
+        wrapper = self.pooled(max_idle=0)
+        wrapper.ensure_connection()
+        wrapper.close()
+        wrapper.ensure_connection()
+        stats = self.stats(wrapper)
+        self.assertEqual((stats['opened'], stats['recycled']), (2, 1))
+
+    def test_recycles_idle_connections_on_checkin(self):
+        first, second = self.pooled(size=2, max_idle=0.05), self.pooled(size=2, max_idle=0.05)
+        first.ensure_connection()
+        second.ensure_connection()
+        first.close()
+        time.sleep(0.1)
+        second.close()
+        stats = self.stats(first)
+        self.assertEqual((stats['idle'], stats['recycled']), (1, 1))
+
+    def test_waits_then_times_out_when_saturated(self):
+        first, second = self.pooled(), self.pooled()
+        first.ensure_connection()
+        with self.assertRaises(OperationalError):
+            second.ensure_connection()
+        stats = self.stats(first)
+        self.assertEqual((stats['saturation'], stats['waits'] > 0, stats['timeouts']), (1.0, True, 1))
+        self.assertGreaterEqual(stats['wait_ms']['max'], 100)
+        first.close()
+        second.ensure_connection()
+        self.assertEqual(self.stats(first)['opened'], 1)
+
+    def test_staff_only_stats(self):
+        wrapper = self.pooled()
+        wrapper.ensure_connection()
+        url = reverse('api:databasePool')
+        self.assertEqual(self.client.get(url).status_code, 401)
+        self.client.force_authenticate(CaptainUser.objects.create_superuser('admin@example.com', 'Admin', '123456789'))
+        [stats] = [stats for stats in self.client.get(url).data if stats['size'] == 1 and stats['in_use']]
+        self.assertEqual((stats['alias'], stats['database']), ('default', connection.settings_dict['NAME']))
+
+
+class SubjectMoveTests(APITestCase):
+
+    def setUp(self):
+        self.maths = Subject.objects.create(name='Maths')
+        self.algebra = Subject.objects.create(name='Algebra', parent=self.maths)
+        self.groups = Subject.objects.create(name='Groups', parent=self.algebra)
+        self.geometry = Subject.objects.create(name='Geometry', parent=self.maths)
+        self.physics = Subject.objects.create(name='Physics')
+        self.mechanics = Subject.objects.create(name='Mechanics', parent=self.physics)
+        self.client.force_authenticate(CaptainUser.objects.create_superuser('admin@example.com', 'Admin', '123456789'))
+
+    def move(self, moves):
+        return self.client.patch(reverse('api:subjectsMove'), moves, format='json')
+
+    def names(self, subject, descendants=False):
+        subject = Subject.objects.get(pk=subject.pk)
+        nodes = subject.get_descendants() if descendants else subject.get_children()
+        return list(nodes.values_list('name', flat=True))
+
+    def test_moves_in_one_go(self):
+        with self.assertNumQueries(5):
+            response = self.move([
+                {'id': self.algebra.id, 'targetId': self.physics.id, 'position': 'last-child'},
+                {'id': self.mechanics.id, 'targetId': self.maths.id, 'position': 'first-child'},
+                {'id': self.geometry.id, 'targetId': self.algebra.id, 'position': 'left'},
+            ])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.names(self.maths), ['Mechanics'])
+        self.assertEqual(self.names(self.physics), ['Geometry', 'Algebra'])
+        # lft / rght agree with the parent links
+        self.assertEqual(self.names(self.physics, descendants=True), ['Geometry', 'Algebra', 'Groups'])
+        self.assertEqual(Subject.objects.get(pk=self.groups.pk).level, 2)
+        self.assertEqual(self.names(self.maths, descendants=True), ['Mechanics'])
+
+    def test_move_to_and_from_the_root_subject(self):
+        physics = Subject.objects.filter(pk=self.physics.pk).values().get()
+        response = self.move([
+            {'id': self.algebra.id, 'targetId': ROOT_SUBJECT_ID, 'position': 'last-child'},
+            {'id': self.mechanics.id, 'targetId': ROOT_SUBJECT_ID, 'position': 'first-child'},
+        ])
+        self.assertEqual(response.status_code, 200)
+        # Both became trees of their own, and the other trees were not touched
+        algebra = Subject.objects.get(pk=self.algebra.pk)
+        self.assertEqual((algebra.parent_id, algebra.lft, algebra.rght, algebra.level), (None, 1, 4, 0))
+        self.assertEqual(self.names(algebra, descendants=True), ['Groups'])
+        self.assertEqual(Subject.objects.get(pk=self.mechanics.pk).parent_id, None)
+        self.assertEqual(len(set(Subject.objects.filter(parent=None).values_list('tree_id', flat=True))), 4)
+        self.assertEqual(self.names(self.maths), ['Geometry'])
+        self.assertEqual(Subject.objects.filter(pk=self.physics.pk).values().get(), dict(physics, rght=2))
+
+        response = self.move([{'id': self.algebra.id, 'targetId': self.physics.id}])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.names(self.physics, descendants=True), ['Algebra', 'Groups'])
+
+    def test_no_moves_relative_to_itself(self):
+        for position in MOVE_POSITIONS:
+            response = self.move([{'id': self.algebra.id, 'targetId': self.algebra.id, 'position': position}])
+            self.assertEqual(response.status_code, 400, position)
+            self.assertEqual(response.data['index'], 0)
+        response = self.client.patch(reverse('api:subjectDetail', kwargs={'pk': self.geometry.id}),
+                                     {'targetId': self.geometry.id, 'position': 'left'}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_no_moves_next_to_a_top_level_subject(self):
+        # Top-level subjects are listed by name, so the move would not show
+        for position in ('left', 'right'):
+            response = self.move([{'id': self.algebra.id, 'targetId': self.physics.id, 'position': position}])
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.data['index'], 0)
+        self.assertEqual(Subject.objects.get(pk=self.algebra.pk).parent_id, self.maths.id)
+
+    def test_top_level_names_are_unique(self):
+        Subject.objects.create(name='Algebra')
+        response = self.move([{'id': self.algebra.id, 'targetId': ROOT_SUBJECT_ID}])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Subject.objects.get(pk=self.algebra.pk).parent_id, self.maths.id)
+
+    def test_invalid_batch_changes_nothing(self):
+        before = list(Subject.objects.order_by('id').values())
+        response = self.move([
+            {'id': self.geometry.id, 'targetId': self.physics.id},
+            {'id': self.maths.id, 'targetId': self.groups.id},
+        ])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['index'], 1)
+        self.assertEqual(list(Subject.objects.order_by('id').values()), before)
+
+    def test_staff_only(self):
+        self.client.force_authenticate(CaptainUser.objects.create_user('learner@example.com', 'Learner', '123456789'))
+        self.assertEqual(self.move([]).status_code, 403)
+
+
+class RootSubjectTests(APITestCase):
+
+    def setUp(self):
+        self.maths = Subject.objects.create(name='Maths')
+        self.algebra = Subject.objects.create(name='Algebra', parent=self.maths)
+        self.physics = Subject.objects.create(name='Physics')
+        self.client.force_authenticate(CaptainUser.objects.create_superuser('admin@example.com', 'Admin', '123456789'))
+        self.root = [{'id': ROOT_SUBJECT_ID, 'name': 'root'}]
+
+    def test_top_level_subjects_are_children_of_the_root(self):
+        for url in (reverse('api:subjectsList'), reverse('api:subjectChildren', kwargs={'pk': ROOT_SUBJECT_ID})):
+            response = self.client.get(url)
+            self.assertEqual([subject['name'] for subject in response.data], ['Maths', 'Physics'])
+            self.assertEqual(response.data[0]['parent'], ROOT_SUBJECT_ID)
+            self.assertEqual(response.data[0]['breadcrumbs'], self.root + [{'id': self.maths.id, 'name': 'Maths'}])
+            self.assertTrue(response.data[0]['hasChildren'])
+
+    def test_root_subject_detail(self):
+        url = reverse('api:subjectDetail', kwargs={'pk': ROOT_SUBJECT_ID})
+        response = self.client.get(url)
+        self.assertEqual(response.data, {'id': ROOT_SUBJECT_ID, 'name': 'root', 'about': '', 'topics': [], 'breadcrumbs': self.root})
+        self.assertEqual(self.client.delete(url).status_code, 404)
+
+    def test_create_top_level_subject(self):
+        trees = dict(Subject.objects.values_list('id', 'tree_id'))
+        response = self.client.post(reverse('api:subjectsList'), {'name': 'Biology', 'parent': ROOT_SUBJECT_ID}, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['parent'], ROOT_SUBJECT_ID)
+        biology = Subject.objects.get(name='Biology')
+        self.assertIsNone(biology.parent_id)
+        # A tree of its own after the others, which keep their tree ids
+        self.assertEqual(biology.tree_id, max(trees.values()) + 1)
+        self.assertEqual(dict(Subject.objects.exclude(pk=biology.pk).values_list('id', 'tree_id')), trees)
+
+        response = self.client.post(reverse('api:subjectsList'), {'name': 'Biology', 'parent': ROOT_SUBJECT_ID}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_move_topic_to_root(self):
+        topic = Topic.objects.create(title='Sets', subject=self.algebra)
+        response = self.client.patch(reverse('api:topicDetail', kwargs={'pk': topic.id}), {
+            'subjectId': ROOT_SUBJECT_ID, 'selectedSubjectId': ROOT_SUBJECT_ID}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['id'], ROOT_SUBJECT_ID)
+        topic.refresh_from_db()
+        self.assertIsNone(topic.subject_id)
+        # Listed as a topic of the root subject, and not as an orphan
+        response = self.client.get(reverse('api:subjectDetail', kwargs={'pk': ROOT_SUBJECT_ID}))
+        self.assertEqual([topic['id'] for topic in response.data['topics']], [topic.id])
+        self.assertEqual(response.data['topics'][0]['subject'], ROOT_SUBJECT_ID)
+        self.assertEqual(self.client.get(reverse('api:orphanTopics')).data, [])
+
+    def test_topics_filed_under_the_root_keep_their_output(self):
+        # As laid out before migration 0010, with the root subject a row
+        Subject.objects.all().delete()
+        root = Subject.objects.create(id=ROOT_SUBJECT_ID, name='root')
+        maths = Subject.objects.create(name='Maths', parent=root)
+        filed = Topic.objects.create(title='Sets', subject=root)
+        orphan = Topic.objects.create(title='Logic')
+        under_maths = Topic.objects.create(title='Algebra', subject=maths)
+        serialized = lambda topic: dict(TopicDetailSerializer(Topic.objects.get(pk=topic.pk)).data, breadcrumbs=None)
+        before = {topic.pk: serialized(topic) for topic in (filed, orphan, under_maths)}
+        orphans = self.client.get(reverse('api:orphanTopics')).data
+
+        migration = import_module('knowledge.migrations.0010_top_level_subject_trees')
+        with connection.schema_editor() as schema_editor:
+            migration.split_root_tree(apps, schema_editor)
+        cache.clear()
+
+        self.assertEqual({topic.pk: serialized(topic) for topic in (filed, orphan, under_maths)}, before)
+        self.assertEqual(before[filed.pk]['subject'], ROOT_SUBJECT_ID)
+        self.assertEqual(Topic.objects.get(pk=filed.pk).breadcrumbs(), self.root)
+        self.assertEqual(Topic.objects.get(pk=orphan.pk).breadcrumbs(), [])
+        self.assertEqual(self.client.get(reverse('api:orphanTopics')).data, orphans)
+        self.assertEqual([topic['id'] for topic in orphans], [orphan.id])
+        response = self.client.get(reverse('api:subjectDetail', kwargs={'pk': ROOT_SUBJECT_ID}))
+        self.assertEqual([topic['id'] for topic in response.data['topics']], [filed.id])
+
+    def test_put_keeps_a_topic_under_the_root(self):
+        topic = Topic.objects.create(title='Sets', at_root=True)
+        response = self.client.put(reverse('api:topicDetail', kwargs={'pk': topic.id}), {
+            'title': 'Set theory', 'about': '', 'subject': ROOT_SUBJECT_ID, 'steps': [], 'assessor': {}, 'requires': []},
+            format='json')
+        self.assertEqual((response.status_code, response.data['subject']), (200, ROOT_SUBJECT_ID))
+        response = self.client.put(reverse('api:topicDetail', kwargs={'pk': topic.id}), {
+            'title': 'Set theory', 'about': '', 'subject': None, 'steps': [], 'assessor': {}, 'requires': []},
+            format='json')
+        self.assertEqual((response.status_code, response.data['subject']), (200, None))
+        self.assertFalse(Topic.objects.get(pk=topic.pk).at_root)
+
+
+class AsyncReadViewsTests(APITestCase):
+
+    def setUp(self):
+        self.user = CaptainUser.objects.create_user('learner@example.com', 'Learner', '123456789')
+        self.maths = Subject.objects.create(name='Maths')
+        self.algebra = Subject.objects.create(name='Algebra', parent=self.maths)
+        self.sets = Topic.objects.create(title='Sets', subject=self.algebra, steps=[{'body': 'lesson'}])
+        self.logic = Topic.objects.create(title='Logic', subject=self.maths)
+        self.sets.requires.add(self.logic)
+        self.path = Path.objects.create(title='Start here', published=True)
+        PathTopicSequence.objects.create(path=self.path, topic=self.sets, order=1)
+        TopicProgress.objects.create(student=self.user, topic=self.sets, completed=True)
+        self.auth = {'HTTP_AUTHORIZATION': 'JWT ' + str(AccessToken.for_user(self.user))}
+
+    def call(self, view, method='get', params=None, **kwargs):
+        # The async view on its own, as the URLs would route it with ASYNC_API.
+        # Its own path keeps it clear of what the sync views cached.
+        request = getattr(RequestFactory(), method)('/async/%s/' % view, params, **self.auth)
+        request.user = self.user
+        return async_to_sync(getattr(async_views, view))(request, **kwargs)
+
+    def test_same_responses_as_the_sync_views(self):
+        for view, url_name, kwargs, params in (
+                ('subjects', 'subjectsList', {}, None),
+                ('subjectChildren', 'subjectChildren', {'pk': self.maths.id}, None),
+                ('subjectChildren', 'subjectChildren', {'pk': ROOT_SUBJECT_ID}, {'fields': 'id,name'}),
+                ('topic', 'topicDetail', {'pk': self.sets.id}, None),
+                ('pathDetail', 'pathDetail', {'pk': self.path.id}, {'fields': 'title,topic_sequence'}),
+                ('publishedPaths', 'publishedPathsList', {}, None),
+                ('Progresses', 'progresses', {}, {'since': '2000-01-01T00:00:00Z'})):
+            self.client.force_login(self.user)
+            expected = self.client.get(reverse('api:' + url_name, kwargs=kwargs), params, **self.auth)
+            response = self.call(view, params=params, **kwargs)
+            self.assertEqual(response.status_code, 200, view)
+            self.assertJSONEqual(response.content, expected.content.decode())
+            self.assertEqual(response.get('ETag'), expected.get('ETag'), view)
+
+    def test_errors(self):
+        self.assertEqual(self.call('topic', pk=self.sets.id + 100).status_code, 404)
+        self.auth = {'HTTP_AUTHORIZATION': 'JWT not-a-token'}
+        response = self.call('pathDetail', pk=self.path.id)
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response['WWW-Authenticate'], 'JWT realm="api"')
+        self.auth = {}
+        response = self.call('publishedPaths', params={'author': 'me'})
+        self.assertEqual(response.status_code, 400)
+        self.assertJSONEqual(response.content, {'author': "Invalid value 'me'."})
+
+    def test_writes_and_pages_go_to_the_sync_views(self):
+        response = self.call('subjects', method='post', params={'name': 'Physics', 'parent': ROOT_SUBJECT_ID})
+        self.assertEqual(response.status_code, 403)
+        response = self.call('publishedPaths', params={'page_size': 1})
+        self.assertEqual(response.render().data['results'][0]['title'], 'Start here')
+
+
+class ReplicaRoutingTests(APITransactionTestCase):
+    # Needs DB_REPLICA_HOSTS; the replica then mirrors the test database, and
+    # the rows are committed so that its own connection sees them
+    databases = '__all__'
+
+    def setUp(self):
+        if not settings.DATABASE_REPLICAS:
+            self.skipTest("No read replica configured (DB_REPLICA_HOSTS)")
+        cache.clear()
+        self.replica = settings.DATABASE_REPLICAS[0]
+        override = override_settings(DATABASE_REPLICAS=[self.replica], REPLICA_READS=True)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.user = CaptainUser.objects.create_user('learner@example.com', 'Learner', '123456789')
+        self.topic = Topic.objects.create(title='Sets', author=self.user)
+        self.path = Path.objects.create(title='Start here', published=True)
+        self.auth = {'HTTP_AUTHORIZATION': 'JWT %s' % AccessToken.for_user(self.user)}
+
+    def get(self, url, **auth):
+        # Returns the response and whether the replica, and the default
+        # database, were queried
+        with CaptureQueriesContext(connections[self.replica]) as replica, CaptureQueriesContext(connection) as primary:
+            response = self.client.get(url, **auth)
+        self.assertEqual(response.status_code, 200, url)
+        return response, bool(replica.captured_queries), bool(primary.captured_queries)
+
+    def test_learner_reads_go_to_the_replica(self):
+        for url in (reverse('api:topics'), reverse('api:topicDetail', kwargs={'pk': self.topic.id}),
+                    reverse('api:pathDetail', kwargs={'pk': self.path.id}), reverse('api:publishedPathsList'),
+                    reverse('api:progresses')):
+            _, replica, primary = self.get(url, **self.auth)
+            self.assertEqual((replica, primary), (True, False), url)
+
+    def test_other_requests_stay_on_the_primary(self):
+        _, replica, primary = self.get(reverse('api:subjectsList'))
+        self.assertEqual((replica, primary), (False, True))
+        with CaptureQueriesContext(connections[self.replica]) as replica:
+            self.client.post(reverse('api:progressBatch'), [{'topic': self.topic.id, 'completed': True, 'verifiable': False}],
+                             format='json', **self.auth)
+        self.assertFalse(replica.captured_queries)
+
+    def test_writers_read_their_writes_from_the_primary(self):
+        url = reverse('api:topicDetail', kwargs={'pk': self.topic.id})
+        response = self.client.put(url, {
+            'title': 'Set theory', 'about': '', 'author': self.user.id, 'subject': None,
+            'steps': [], 'assessor': {}, 'requires': []}, format='json', **self.auth)
+        self.assertEqual(response.status_code, 200)
+        response, replica, _ = self.get(url, **self.auth)
+        self.assertEqual((response.data['title'], replica), ('Set theory', False))
+        # Only the writer is pinned
+        self.client = APIClient()
+        _, replica, _ = self.get(reverse('api:pathDetail', kwargs={'pk': self.path.id}), **self.auth)
+        self.assertTrue(replica)
+
+    def test_writes_without_a_user_pin_too(self):
+        # A client that keeps no cookies sends the pin back as a header
+        response = self.client.post(reverse('token_obtain_pair'), {'email': 'learner@example.com', 'password': '123456789'})
+        self.assertEqual(response.status_code, 200)
+        self.client = APIClient()
+        url = reverse('api:pathDetail', kwargs={'pk': self.path.id})
+        _, replica, _ = self.get(url, HTTP_X_REPLICA_PIN=response[PIN_HEADER])
+        self.assertFalse(replica)
+        _, replica, _ = self.get(url, HTTP_X_REPLICA_PIN='forged')
+        self.assertTrue(replica)
+
+    def test_replica_reads_are_not_cached(self):
+        # The replica lags: its connection keeps reading from a snapshot
+        # taken before the write
+        url = reverse('api:topicDetail', kwargs={'pk': self.topic.id})
+        with transaction.atomic(using=self.replica):
+            with connections[self.replica].cursor() as cursor:
+                cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+                cursor.execute("SELECT count(*) FROM knowledge_topic")
+            writer = APIClient()
+            response = writer.put(url, {
+                'title': 'Set theory', 'about': '', 'author': self.user.id, 'subject': None,
+                'steps': [], 'assessor': {}, 'requires': []}, format='json', **self.auth)
+            self.assertEqual(response.status_code, 200)
+            # Someone else reads in between, from the replica
+            response, replica, _ = self.get(url)
+            self.assertEqual((response.data['title'], replica), ('Sets', True))
+        response = writer.get(url, **self.auth)
+        self.assertEqual(response.data['title'], 'Set theory')
+
+    def test_pin_lasts_for_the_window(self):
+        entries = [{'topic': self.topic.id, 'completed': True, 'verifiable': False}]
+        with override_settings(REPLICA_PIN_SECONDS=0):
+            self.client.post(reverse('api:progressBatch'), entries, format='json', **self.auth)
+        _, replica, _ = self.get(reverse('api:progresses'), **self.auth)
+        self.assertTrue(replica)
+        self.client.post(reverse('api:progressBatch'), entries, format='json', **self.auth)
+        _, replica, _ = self.get(reverse('api:progresses'), **self.auth)
+        self.assertFalse(replica)
+
+
+class StartupProfileTests(APITransactionTestCase):
+    # The profile runs in a child process, which only sees committed rows
+
+    def setUp(self):
+        Subject.objects.create(name='Maths')
+
+    def test_command(self):
+        # Nothing the profiled start imports is left in this process
+        import_module('api.management.commands.startup_profile')
+        modules, environ = set(sys.modules), dict(os.environ)
+        out = io.StringIO()
+        with mock.patch.dict(os.environ, {'DB_NAME': connection.settings_dict['NAME']}):
+            call_command('startup_profile', '/api/subjects/', '--top', '3', stdout=out)
+        self.assertEqual(set(sys.modules), modules)
+        self.assertEqual(dict(os.environ), environ)
+
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0], 'Boot')
+        self.assertEqual([line.split()[0] for line in lines[1:4]], ['django.setup()', 'URL', 'of'])
+        self.assertEqual(lines[4], 'Import time by package')
+        self.assertEqual(lines[8], 'First requests (first / second)')
+        self.assertRegex(lines[9], r'^  /api/subjects/ +\d+ms / \d+ms  \[200\]$')
+        packages = [line.split()[0] for line in lines[5:8]]
+        self.assertIn('django', packages)
+        self.assertTrue(all(line.endswith('ms') for line in lines[1:4] + lines[5:8]))
+
+    def test_failure(self):
+        with mock.patch.dict(os.environ, {'DJANGO_SETTINGS_MODULE': 'captain.missing'}):
+            with self.assertRaisesMessage(CommandError, 'Profiling failed'):
+                call_command('startup_profile', stdout=io.StringIO())
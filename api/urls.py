@@ -1,19 +1,26 @@
 from django.urls import path
-from .views import DataInfo, Progresses, subjects, subject, topics, topic, topicRequirement, orphanTopics, subjectChildren, paths, pathDetail, publishedPaths
-from rest_framework_swagger.views import get_swagger_view
+from .views import DataInfo, Progresses, databasePool, export, schema, progressBatch, subjects, subject, topics, topic, topicPrerequisites, topicRequirement, topicSuggest, orphanTopics, questionImport, quiz, search, subjectChildren, subjectTree, subjectsMove, paths, pathDetail, pathsProgress, publishedPaths
+from django.conf import settings
 
-
-schema_view = get_swagger_view(title='Captain API')
+if settings.ASYNC_API:
+    from .async_views import Progresses, pathDetail, publishedPaths, subjectChildren, subjects, topic
 
 app_name = 'api'
 
 urlpatterns = [
-    path('', schema_view),
+    # GET: API docs (swagger)
+    path('', schema, name='schema'),
 
     # GET: Get all root level subjects
     # POST: create subject
     path('subjects/', subjects, name='subjectsList'),
 
+    # GET: Get the whole subject tree, nested (supports ETag / If-None-Match)
+    path('subjects/tree/', subjectTree, name='subjectTree'),
+
+    # PATCH: Move many subjects at once, in one transaction ([{id, targetId, position}, ...])
+    path('subjects/move/', subjectsMove, name='subjectsMove'),
+
     # GET: Get subject in detail
     # PUT: Update subject in detail
     # PATCH: Change subject's parent subject (reparent subject)
@@ -34,6 +41,10 @@ urlpatterns = [
     # DELETE: Delete topic
     path('topics/<int:pk>/', topic, name='topicDetail'),
 
+    # GET: Get all topics this topic transitively requires, in the order they
+    # should be learnt, with the requesting user's progress (optional ?depth=N)
+    path('topics/<int:pk>/prerequisites/', topicPrerequisites, name='topicPrerequisites'),
+
     # POST: Check if safe to add requirement
     # PATCH: Add requirement
     # DELETE: Delete requirement
@@ -42,12 +53,37 @@ urlpatterns = [
     # GET: Get those topics which don't have any subject assigned to them
     path('topics/orphans/', orphanTopics, name='orphanTopics'),
 
+    # GET: Suggest topics / subjects for what has been typed (?q=, optional ?k=, ?type=topic,
+    # ?exclude_cycles_for=<topic id> to leave out topics that can't become its requirements)
+    path('topics/suggest/', topicSuggest, name='topicSuggest'),
+
     path('datainfo/', DataInfo.as_view(), name='dataInfo'),
 
+    # GET: Get the database connection pool figures of the worker that answers (staff only)
+    path('dbpool/', databasePool, name='databasePool'),
+
     path('paths/', paths, name='paths'),
     path('paths/<int:pk>/', pathDetail, name='pathDetail'),
     path('paths/published/', publishedPaths, name='publishedPathsList'),
 
+    # GET: Get completed / verifiable / total topic counts of every published path for the requesting user
+    path('paths/progress/', pathsProgress, name='pathsProgress'),
+
     # path('progresses/', ProgressList.as_view(), name='progresses'),
     path('progresses/', Progresses, name='progresses'),
+
+    # POST: Save many (topic, completed, verifiable) progress entries of the requesting user at once
+    path('progresses/batch/', progressBatch, name='progressBatch'),
+
+    # GET: Search topics, subjects, questions and concepts (?q=, optional ?type=topic,question)
+    path('search/', search, name='search'),
+
+    # GET: Get a quiz of random questions with their options (?n=, optional ?topic=, ?concept=, ?difficulty=)
+    path('quiz/', quiz, name='quiz'),
+
+    # POST: Import a JSONL / CSV file of questions with their options and links (staff only)
+    path('questions/import/', questionImport, name='questionImport'),
+
+    # GET: Download a snapshot of subjects, topics, requirements and paths as NDJSON (?progress=true to include progress, staff only)
+    path('export/', export, name='export'),
 ]
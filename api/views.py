@@ -1,17 +1,46 @@
 from django.db.models.query import Prefetch
 from django.db.models.query_utils import Q
+from django.db.models import Count, FilteredRelation, Max
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.views import APIView
-from django.http.response import JsonResponse
-from django.db import connection
+from django.core.handlers.asgi import ASGIRequest
+from django.http.response import JsonResponse, StreamingHttpResponse
+from django.db import connection, transaction
 from rest_framework import generics, status
 from rest_framework.exceptions import PermissionDenied
 from rest_framework.response import Response
-from knowledge.models import Subject, Topic, Path, TopicProgress
-from .serializers import PathDetailRetrieveSerializer, PathDetailSerializer, PathListSerializer, PathTopicSequenceSerializer, SubjectDetailSerializer, SubjectSerializer, TopicListSerializer, TopicDetailSerializer, TopicProgressMinSerializer, TopicProgressSerializer
+from knowledge.models import Subject, Topic, Path, TopicProgress, TopicRequirementClosure
+from .pagination import RankedPagination, filter_queryset, paginated_response
+from .serializers import requested_fields, QuizQuestionSerializer, SubjectMoveSerializer, PathDetailRetrieveSerializer, PathDetailSerializer, PathListSerializer, PathTopicSequenceSerializer, SubjectDetailSerializer, SubjectSerializer, TopicListSerializer, TopicDetailSerializer, TopicListProgressSerializer, TopicPrerequisiteSerializer, TopicProgressEntrySerializer, TopicProgressMinSerializer, TopicProgressSerializer, TopicProgressSyncSerializer
 from rest_framework.permissions import BasePermission, IsAdminUser, IsAuthenticated, IsAuthenticatedOrReadOnly, SAFE_METHODS
 from time import sleep
+from datetime import timedelta
+import io
+import os
 from django.views.decorators.csrf import csrf_exempt
+from django.utils.dateparse import parse_datetime
+from django.utils.http import parse_etags, quote_etag
+from django.utils import timezone
+from django.utils.timezone import is_naive, make_aware
+from knowledge.graph import requirement_graph
+from knowledge.importer import FORMATS, QuestionImportError, import_questions, read_records
+from knowledge.quiz import difficulties, draw_quiz
+from knowledge.snapshot import export_lines
+from knowledge.search import SEARCHABLE, SUGGESTABLE, highlight, search_query, suggest, search as search_hits
+from knowledge.tree import ROOT_SUBJECT_ID, SubjectMoveError, get_subject_tree, move_subjects, virtual_root
+from knowledge.versions import PATH, SUBJECT, TOPIC, TOPIC_PROGRESS, bump_version_on_commit
+from captain.pooled_postgres.pool import pools
+from .cache import cache_response, conditional
+from .streaming import ThreadedIterator, ThreadedStreamingHttpResponse
+
+
+# How many suggestions topicSuggest returns by default, and at most
+SUGGEST_K = 10
+MAX_SUGGEST_K = 50
+
+# How many questions a quiz has by default, and at most
+QUIZ_LENGTH = 10
+MAX_QUIZ_LENGTH = 100
 
 
 # Custom Permissions
@@ -22,16 +51,14 @@ class IsSuperUser(BasePermission):
         return bool(request.user and request.user.is_superuser)
 
 @api_view(['GET', 'POST'])
+@cache_response(SUBJECT)
 def subjects(request):
     # To get list of subjects (who are children of root)
     if request.method == 'GET':
-        try:
-            queryset = Subject.objects.get(id=1).get_children()
-        except:
-            r = Subject(id=1, name='root')
-            r.save()
-            queryset = Subject.objects.get(id=1).get_children()
-        serializer = SubjectSerializer(queryset, many=True)
+        queryset = TopLevelSubjects()
+        fields = requested_fields(request)
+        queryset = SubjectSerializer.project(queryset, fields).prefetch_related(SubjectChildIds())
+        serializer = SubjectSerializer(queryset, many=True, fields=fields)
         return Response(serializer.data)
 
     # To create a subject with provided name and parentId
@@ -51,25 +78,68 @@ def subjects(request):
 def subjectChildren(request, pk):
     if request.method == 'GET':
         try:
-            queryset = Subject.objects.get(id=pk).get_children()
+            queryset = TopLevelSubjects() if pk == ROOT_SUBJECT_ID else Subject.objects.get(id=pk).get_children()
         except Subject.DoesNotExist:
             return Response(status=status.HTTP_404_NOT_FOUND)
 
-        serializer = SubjectSerializer(queryset, many=True)
+        fields = requested_fields(request)
+        queryset = SubjectSerializer.project(queryset, fields).prefetch_related(SubjectChildIds())
+        serializer = SubjectSerializer(queryset, many=True, fields=fields)
         return Response(serializer.data)
 
 
+@api_view(['GET'])
+def subjectTree(request):
+    # To get the whole subject hierarchy in one response
+    if request.method == 'GET':
+        version, tree = get_subject_tree()
+        etag = quote_etag('subject-tree-%s' % version)
+        if etag in parse_etags(request.headers.get('If-None-Match', '')):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+        return Response(tree, headers={'ETag': etag})
+
+
+@api_view(['PATCH'])
+def subjectsMove(request):
+    # To reparent many subjects at once: a list of {id, targetId, position}
+    # moves, applied in order, all or nothing
+    if request.method == 'PATCH':
+        # Only allow staff to move subjects
+        if not request.user.is_staff:
+            raise PermissionDenied()
+
+        serializer = SubjectMoveSerializer(data=request.data, many=True)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            moved = move_subjects([(move['id'], move['targetId'], move['position']) for move in serializer.validated_data])
+        except SubjectMoveError as error:
+            return Response({'error': str(error), 'index': error.index}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({'moved': moved}, status=status.HTTP_200_OK)
+
+
 @api_view(['GET', 'PATCH', 'PUT', 'DELETE'])
+@cache_response(SUBJECT, TOPIC)
+@conditional(lambda request, pk: SubjectValidators(pk))
 def subject(request, pk):
 
+    queryset = Subject.objects.all()
+    # When reading, only load the columns the requested fields need
+    if request.method == 'GET':
+        fields = requested_fields(request)
+        queryset = SubjectDetailSerializer.project(queryset, fields).prefetch_related(Prefetch(
+            'topics', queryset=TopicListSerializer.project(Topic.objects.prefetch_related(TopicRequirementIds()))))
     try:
-        thisSubject = Subject.objects.get(id=pk)
+        thisSubject = queryset.get(id=pk)
     except Subject.DoesNotExist:
-        return Response(status=status.HTTP_404_NOT_FOUND)
+        # The root subject can be read, but it has no row to change
+        if pk != ROOT_SUBJECT_ID or request.method != 'GET':
+            return Response(status=status.HTTP_404_NOT_FOUND)
+        thisSubject = virtual_root()
 
     # To get detail of a particular subject
     if request.method == 'GET':
-        serializer = SubjectDetailSerializer(thisSubject)
+        serializer = SubjectDetailSerializer(thisSubject, fields=fields)
         return Response(serializer.data)
 
     # To update detail of a particular subject
@@ -90,10 +160,11 @@ def subject(request, pk):
         if not request.user.is_staff:
             raise PermissionDenied()
 
-        target = Subject.objects.get(id=request.data['targetId'])
-        new_pos = request.data['position']
-        # Execute move operation
-        thisSubject.move_to(target, position=new_pos)
+        # Execute move operation, only the trees involved are renumbered
+        try:
+            move_subjects([(thisSubject.id, int(request.data['targetId']), request.data['position'])])
+        except SubjectMoveError as error:
+            return Response({'error': str(error)}, status=status.HTTP_400_BAD_REQUEST)
         return Response(status=status.HTTP_200_OK)
 
     # To delete the subject
@@ -103,7 +174,6 @@ def subject(request, pk):
             raise PermissionDenied()
 
         thisSubject.delete()
-        Subject.objects.rebuild()
         return Response(status=status.HTTP_200_OK)
 
 
@@ -111,9 +181,11 @@ def subject(request, pk):
 def topics(request):
     # To get list of all topics
     if request.method == 'GET':
-        queryset = Topic.objects.all()
-        serializer = TopicListSerializer(queryset, many=True)
-        return Response(serializer.data)
+        fields = requested_fields(request)
+        queryset = filter_queryset(request, Topic.objects.all(), {
+            'subject': ('subject_id', int), 'author': ('author_id', int)})
+        queryset = TopicListSerializer.project(queryset, fields).prefetch_related(TopicRequirementIds())
+        return paginated_response(request, queryset, TopicListSerializer, fields=fields)
 
     # To create a topic with provided data
     elif request.method == 'POST':
@@ -134,22 +206,55 @@ def topics(request):
 def orphanTopics(request):
     # To get list of topics who don't have any subjects
     if request.method == 'GET':
-        queryset = Topic.objects.filter(subject=None)
-        serializer = TopicListSerializer(queryset, many=True)
-        return Response(serializer.data)
+        fields = requested_fields(request)
+        queryset = filter_queryset(request, Topic.objects.filter(subject=None, at_root=False), {
+            'author': ('author_id', int)})
+        queryset = TopicListSerializer.project(queryset, fields).prefetch_related(TopicRequirementIds())
+        return paginated_response(request, queryset, TopicListSerializer, fields=fields)
+
+
+@api_view(['GET'])
+def topicSuggest(request):
+    # To get the k topics / subjects best matching what has been typed so far,
+    # e.g. ?q=alg&k=10&type=topic&exclude_cycles_for=12
+    if request.method == 'GET':
+        text = request.query_params.get('q', '').strip()
+        if not text:
+            return Response({'q': "This query parameter is required."}, status=status.HTTP_400_BAD_REQUEST)
+        kinds = request.query_params.get('type')
+        kinds = kinds.split(',') if kinds else list(SUGGESTABLE)
+        unknown = [kind for kind in kinds if kind not in SUGGESTABLE]
+        if unknown:
+            return Response({'type': "Unknown type '" + unknown[0] + "'."}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            k = min(int(request.query_params.get('k', SUGGEST_K)), MAX_SUGGEST_K)
+            excludeCyclesFor = request.query_params.get('exclude_cycles_for')
+            excludeCyclesFor = None if excludeCyclesFor is None else int(excludeCyclesFor)
+        except ValueError:
+            return Response(data="k and exclude_cycles_for must be integers.", status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(suggest(text, max(k, 1), kinds, excludeCyclesFor))
 
 
 @api_view(['GET', 'PATCH', 'PUT', 'DELETE'])
+@cache_response(SUBJECT, TOPIC, TOPIC_PROGRESS)
+@conditional(lambda request, pk: TopicValidators(pk))
 def topic(request, pk):
 
+    queryset = Topic.objects.all()
+    # When reading, only load the columns the requested fields need, and none
+    # of the lesson content of the required topics
+    if request.method == 'GET':
+        fields = requested_fields(request)
+        queryset = TopicDetailQuery(fields)
     try:
-        thisTopic = Topic.objects.get(id=pk)
+        thisTopic = queryset.get(id=pk)
     except Topic.DoesNotExist:
         return Response(status=status.HTTP_404_NOT_FOUND)
 
     # To get detail of a particular topic
     if request.method == 'GET':
-        serializer = TopicDetailSerializer(thisTopic)
+        serializer = TopicDetailSerializer(thisTopic, fields=fields)
         return Response(serializer.data)
 
     # To update detail of a particular topic
@@ -171,28 +276,31 @@ def topic(request, pk):
         # if not request.user.is_staff:
         #     raise PermissionDenied()
 
-        # Clear the requirements because we will fill them again, can this result in lost update if rest requirements make cycle?
-        thisTopic.requires.clear()
-        # Do a loop to save the "requires" dependencies, if they don't result in cycles
-        for oneRequirement in request.data['requires']:
-            try:
-                requiredTopic = Topic.objects.get(id=oneRequirement['id'])
-                # If adding this dependency doesn't create a cycle, add this, otherwise return bad_request
-                if WillMakeCycle(pk, oneRequirement['id']):
-                    return Response(data="Adding "+oneRequirement['title']+" as a requirement will result in a requirement loop, which is not allowed.", status=status.HTTP_400_BAD_REQUEST)
-                else:
-                    # Add this reference successfully
-                    thisTopic.requires.add(requiredTopic)
-
-            except Topic.DoesNotExist:
+        requiredTitles = {int(oneRequirement['id']): oneRequirement.get('title') for oneRequirement in request.data['requires']}
+        requiredIds = set(requiredTitles)
+        # Validate the whole proposed requirement set and apply it in one
+        # transaction under the requirements lock, so that two concurrent
+        # edits can't each pass the loop check and close a loop together
+        with transaction.atomic():
+            TopicRequirementClosure.objects.lock()
+            if Topic.objects.filter(id__in=requiredIds).count() != len(requiredIds):
                 return Response(data="One or more of the added required topics do not exist on the server.", status=status.HTTP_400_BAD_REQUEST)
-
-        # This will save rest of the properties of the topic
-        serializer = TopicDetailSerializer(
-            thisTopic, data=request.data)
-        if serializer.is_valid():
-            serializer.save()
-            return Response(serializer.data)
+            loopId = TopicRequirementClosure.objects.find_cycle(pk, requiredIds)
+            if loopId is not None:
+                return Response(data="Adding "+str(requiredTitles[loopId])+" as a requirement will result in a requirement loop, which is not allowed.", status=status.HTTP_400_BAD_REQUEST)
+
+            # This will save rest of the properties of the topic
+            serializer = TopicDetailSerializer(
+                thisTopic, data=request.data)
+            if serializer.is_valid():
+                # Apply only the difference to the requirements, along with the rest, all or nothing
+                currentIds = set(thisTopic.requires.values_list('id', flat=True))
+                if currentIds - requiredIds:
+                    thisTopic.requires.remove(*(currentIds - requiredIds))
+                if requiredIds - currentIds:
+                    thisTopic.requires.add(*(requiredIds - currentIds))
+                serializer.save()
+                return Response(serializer.data)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
     # To reparent a topic (update the subject only)
@@ -201,11 +309,14 @@ def topic(request, pk):
         if not request.user.is_staff:
             raise PermissionDenied()
 
-        subject = Subject.objects.get(id=request.data['subjectId'])
-        thisTopic.subject = subject
+        # A topic moved to the root subject has no subject, but is filed there
+        subjectId = int(request.data['subjectId'])
+        thisTopic.subject = None if subjectId == ROOT_SUBJECT_ID else Subject.objects.get(id=subjectId)
+        thisTopic.at_root = subjectId == ROOT_SUBJECT_ID
         thisTopic.save()
-        selectedSubject = Subject.objects.get(
-            id=request.data['selectedSubjectId'])
+        selectedSubjectId = int(request.data['selectedSubjectId'])
+        selectedSubject = virtual_root() if selectedSubjectId == ROOT_SUBJECT_ID else Subject.objects.get(
+            id=selectedSubjectId)
         serializer = SubjectDetailSerializer(selectedSubject)
         return Response(serializer.data, status=status.HTTP_200_OK)
 
@@ -229,6 +340,35 @@ def topic(request, pk):
         return Response(status=status.HTTP_200_OK)
 
 
+@api_view(['GET'])
+def topicPrerequisites(request, pk):
+    # To get everything a topic transitively requires, prerequisites first,
+    # with the requesting user's progress on each
+    if request.method == 'GET':
+        if not Topic.objects.filter(id=pk).exists():
+            return Response(status=status.HTTP_404_NOT_FOUND)
+
+        depth = request.query_params.get('depth')
+        if depth is not None:
+            try:
+                depth = int(depth)
+                if depth < 1:
+                    raise ValueError
+            except ValueError:
+                return Response(data="depth must be a positive whole number.", status=status.HTTP_400_BAD_REQUEST)
+
+        ordered = requirement_graph.prerequisites(pk, depth)
+        topics = Topic.objects.filter(id__in=[id for id, _ in ordered]).defer('steps', 'assessor').prefetch_related(TopicRequirementIds(), Prefetch(
+            'progress', queryset=TopicProgress.objects.filter(student=request.user.id), to_attr='filtered_progress')).in_bulk()
+        queryset = []
+        for id, distance in ordered:
+            if id in topics:
+                topics[id].depth = distance
+                queryset.append(topics[id])
+        serializer = TopicPrerequisiteSerializer(queryset, many=True)
+        return Response(serializer.data)
+
+
 @api_view(['POST', 'PATCH', 'DELETE'])
 @permission_classes([IsAdminUser])
 def topicRequirement(request, pk, rTopicId):
@@ -254,14 +394,16 @@ def topicRequirement(request, pk, rTopicId):
 
     # To add the requirement to this topic
     elif request.method == 'PATCH':
-        # If adding this dependency doesn't create a cycle, add this, otherwise return bad_request
-        if WillMakeCycle(pk, rTopicId):
-            return Response(data="Adding '"+requiredTopic.title + "' as a requirement for '" + thisTopic.title + "' will result in a requirement loop, which is not allowed.", status=status.HTTP_400_BAD_REQUEST)
-        else:
+        # If adding this dependency doesn't create a cycle, add this, otherwise return bad_request.
+        # Checked and added under the requirements lock, like topic PUT.
+        with transaction.atomic():
+            TopicRequirementClosure.objects.lock()
+            if WillMakeCycle(pk, rTopicId):
+                return Response(data="Adding '"+requiredTopic.title + "' as a requirement for '" + thisTopic.title + "' will result in a requirement loop, which is not allowed.", status=status.HTTP_400_BAD_REQUEST)
             # Add this reference successfully
             thisTopic.requires.add(requiredTopic)
             thisTopic.save()
-            return Response(TopicProgressMinSerializer(thisTopic.requires.all(), many=True).data, status=status.HTTP_200_OK)
+        return Response(TopicProgressMinSerializer(thisTopic.requires.all(), many=True).data, status=status.HTTP_200_OK)
 
     # To remove this topic from requirements
     elif request.method == 'DELETE':
@@ -280,8 +422,11 @@ def paths(request):
         else:
             queryset = Path.publishedPaths.all()
 
-        serializer = PathListSerializer(queryset, many=True)
-        return Response(serializer.data)
+        fields = requested_fields(request)
+        queryset = filter_queryset(request, queryset, {
+            'author': ('author_id', int), 'published': ('published', bool)})
+        queryset = PathListSerializer.project(queryset, fields)
+        return paginated_response(request, queryset, PathListSerializer, fields=fields)
 
     # To create a path with provided title, about and published(bool)
     elif request.method == 'POST':
@@ -299,6 +444,7 @@ def paths(request):
 
 
 @api_view(['GET', 'PUT', 'DELETE'])
+@conditional(lambda request, pk: PathValidators(pk, request.user))
 def pathDetail(request, pk):
 
     try:
@@ -312,11 +458,11 @@ def pathDetail(request, pk):
         if (not thisPath.published and not request.user.is_staff):
             raise PermissionDenied()
             
-        queryset = Path.objects.prefetch_related(Prefetch('topic_sequence__topic__progress', queryset=TopicProgress.objects.filter(
-            student=request.user.id), to_attr='filtered_progress')).get(id=pk)
+        fields = requested_fields(request)
+        queryset = PathDetailQuery(fields, request.user).get(id=pk)
         print("Path get request by "+str(request.user))
         print("Requesting user's id is "+str(request.user.id))
-        serializer = PathDetailRetrieveSerializer(queryset)
+        serializer = PathDetailRetrieveSerializer(queryset, fields=fields)
         return Response(serializer.data)
 
     # To update detail of a particular path
@@ -365,12 +511,111 @@ def pathDetail(request, pk):
         return Response(status=status.HTTP_200_OK)
 
 @api_view(['GET'])
+@cache_response(PATH)
 def publishedPaths(request):
     # To get list of paths
     if request.method == 'GET':
-        queryset = Path.publishedPaths.all()
-        serializer = PathListSerializer(queryset, many=True)
-        return Response(serializer.data)
+        fields = requested_fields(request)
+        queryset = PublishedPathsQuery(request, fields)
+        return paginated_response(request, queryset, PathListSerializer, fields=fields)
+
+@api_view(['GET'])
+def pathsProgress(request):
+    # To get, for every published path, how many of its topics the requesting
+    # user has completed / can verify, all in one aggregate query
+    if request.method == 'GET':
+        queryset = Path.publishedPaths.annotate(
+            myProgress=FilteredRelation('topic_sequence__topic__progress', condition=Q(
+                topic_sequence__topic__progress__student=request.user.id)),
+        ).annotate(
+            total=Count('topic_sequence'),
+            completed=Count('topic_sequence', filter=Q(myProgress__completed=True)),
+            verifiable=Count('topic_sequence', filter=Q(myProgress__verifiable=True)),
+        ).order_by('id').values('id', 'title', 'completed', 'verifiable', 'total')
+        return Response(list(queryset))
+
+@api_view(['GET'])
+def search(request):
+    # To search topics, subjects, questions and concepts, best match first,
+    # e.g. ?q=set theory&type=topic,subject
+    if request.method == 'GET':
+        text = request.query_params.get('q', '').strip()
+        if not text:
+            return Response({'q': "This query parameter is required."}, status=status.HTTP_400_BAD_REQUEST)
+        kinds = request.query_params.get('type')
+        kinds = kinds.split(',') if kinds else list(SEARCHABLE)
+        unknown = [kind for kind in kinds if kind not in SEARCHABLE]
+        if unknown:
+            return Response({'type': "Unknown type '" + unknown[0] + "'."}, status=status.HTTP_400_BAD_REQUEST)
+
+        query = search_query(text)
+        paginator = RankedPagination()
+        page = paginator.paginate_queryset(search_hits(query, kinds), request)
+        return paginator.get_paginated_response(highlight(page, query))
+
+@api_view(['GET'])
+def quiz(request):
+    # To get n random questions (with their options) on a topic, concept
+    # and/or difficulty, e.g. ?topic=3&difficulty=easy&n=20
+    if request.method == 'GET':
+        try:
+            n = min(int(request.query_params.get('n', QUIZ_LENGTH)), MAX_QUIZ_LENGTH)
+            topic = request.query_params.get('topic')
+            topic = None if topic is None else int(topic)
+            concept = request.query_params.get('concept')
+            concept = None if concept is None else int(concept)
+        except ValueError:
+            return Response(data="n, topic and concept must be integers.", status=status.HTTP_400_BAD_REQUEST)
+        difficulty = request.query_params.get('difficulty')
+        if difficulty is not None and difficulty not in difficulties():
+            return Response(data="Unknown difficulty '%s'." % difficulty, status=status.HTTP_400_BAD_REQUEST)
+        questions = draw_quiz(max(n, 0), topic=topic, concept=concept, difficulty=difficulty)
+        return Response(QuizQuestionSerializer(questions, many=True).data)
+
+@api_view(['POST'])
+@permission_classes([IsAdminUser])
+def questionImport(request):
+    # To import a JSONL or CSV file of questions (multipart field "file", format
+    # taken from its extension unless ?format= is given), see knowledge.importer
+    if request.method == 'POST':
+        upload = request.FILES.get('file')
+        if upload is None:
+            return Response({'file': "No file was uploaded."}, status=status.HTTP_400_BAD_REQUEST)
+        format = request.query_params.get('format') or os.path.splitext(upload.name)[1].lstrip('.').lower()
+        if format not in FORMATS:
+            return Response({'format': "Use one of " + ', '.join(FORMATS) + "."}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Read the upload line by line rather than into memory
+        lines = io.TextIOWrapper(upload.file, encoding='utf-8', newline='')
+        try:
+            questions, options = import_questions(read_records(lines, format), author=request.user)
+        except QuestionImportError as error:
+            return Response({'error': str(error), 'line': error.line, 'imported': error.imported}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({'questions': questions, 'options': options}, status=status.HTTP_201_CREATED)
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def export(request):
+    # To download a snapshot of the knowledge graph as NDJSON (add
+    # ?progress=true for everyone's progress), streamed as it is read
+    if request.method == 'GET':
+        includeProgress = request.query_params.get('progress', '').lower() in ('true', '1')
+        lines = export_lines(include_progress=includeProgress)
+        # Under ASGI the body is read off the event loop (see api/streaming.py)
+        if isinstance(request._request, ASGIRequest):
+            response = ThreadedStreamingHttpResponse(ThreadedIterator(lines), content_type='application/x-ndjson')
+        else:
+            response = StreamingHttpResponse(lines, content_type='application/x-ndjson')
+        response['Content-Disposition'] = 'attachment; filename="knowledge.ndjson"'
+        return response
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def databasePool(request):
+    # To see how busy the database connection pools of the worker that
+    # answers are: size, connections in use and idle, checkout wait times
+    if request.method == 'GET':
+        return Response([dict(alias=alias, database=database, **pool.stats()) for alias, database, pool in pools()])
 
 @csrf_exempt
 def Progresses(request):
@@ -378,8 +623,63 @@ def Progresses(request):
     if request.method == 'GET':
         print("Requesting user is "+str(request.user))
         progresses = TopicProgress.objects.filter(student=request.user.id)
+        # Before reading anything: what to send as ?since= next time
+        watermark = SyncWatermark()
+        # With ?since=<timestamp>, only send the rows that changed after it
+        since = request.GET.get('since')
+        if since is not None:
+            try:
+                since = parse_datetime(since)
+            except ValueError:
+                since = None
+            if since is None:
+                return JsonResponse({'since': "Invalid timestamp."}, status=status.HTTP_400_BAD_REQUEST)
+            if is_naive(since):
+                since = make_aware(since)
+            progresses = progresses.filter(updated_at__gt=since)
+            serializer = TopicProgressSyncSerializer(progresses, many=True)
+            return JsonResponse(serializer.data, safe=False, headers={SYNC_WATERMARK_HEADER: watermark})
         serializer = TopicProgressSerializer(progresses, many=True)
-        return JsonResponse(serializer.data, safe=False)
+        return JsonResponse(serializer.data, safe=False, headers={SYNC_WATERMARK_HEADER: watermark})
+
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def progressBatch(request):
+    # To save many progress entries at once (e.g. queued up by an offline
+    # client) with a single INSERT ... ON CONFLICT (student, topic) DO UPDATE
+    if request.method == 'POST':
+        serializer = TopicProgressEntrySerializer(data=request.data, many=True)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        # Later entries for the same topic win
+        entries = {entry['topic']: entry for entry in serializer.validated_data}
+        if Topic.objects.filter(id__in=entries).count() != len(entries):
+            return Response(data="One or more of the topics do not exist on the server.", status=status.HTTP_400_BAD_REQUEST)
+
+        TopicProgress.objects.bulk_create([
+            TopicProgress(student=request.user, topic_id=topicId, completed=entry['completed'], verifiable=entry['verifiable'])
+            for topicId, entry in entries.items()],
+            update_conflicts=True, unique_fields=['student', 'topic'], update_fields=['completed', 'verifiable', 'updated_at'])
+        # bulk_create sends no post_save
+        bump_version_on_commit(TOPIC_PROGRESS)
+        progresses = TopicProgress.objects.filter(student=request.user, topic_id__in=entries)
+        return Response(TopicProgressSyncSerializer(progresses, many=True).data)
+
+
+# The API docs view, made on first use: rest_framework_swagger and
+# openapi_codec are then only imported by a worker that serves the docs, not
+# at boot by every one
+_schemaView = None
+
+@csrf_exempt
+def schema(request, *args, **kwargs):
+    global _schemaView
+    if _schemaView is None:
+        from rest_framework_swagger.views import get_swagger_view
+        _schemaView = get_swagger_view(title='Captain API')
+    return _schemaView(request, *args, **kwargs)
 
 
 class DataInfo(APIView):
@@ -393,15 +693,93 @@ class DataInfo(APIView):
 
 # Helper functions (not views)
 
+# Progress rows get their updated_at before their transaction commits, so a
+# row can become visible with an updated_at older than a read that missed
+# it. Clients get the ?since= of their next delta read in this header; it
+# lags behind the time of the read by SYNC_MARGIN, more than any progress
+# write takes to commit, and rows already sent may come again.
+SYNC_WATERMARK_HEADER = 'X-Sync-Watermark'
+SYNC_MARGIN = timedelta(minutes=1)
+
+def TopicRequirementIds():
+    # Prefetch for serializing Topic.requires as a list of ids
+    return Prefetch('requires', queryset=Topic.objects.only('id'))
+
+def TopLevelSubjects():
+    # The children of the root subject, each the root of its own tree
+    return Subject.objects.root_nodes().order_by('name')
+
+# The read queries of views that have an async version in async_views
+
+def TopicDetailQuery(fields):
+    return TopicDetailSerializer.project(Topic.objects.all(), fields).prefetch_related(Prefetch(
+        'requires', queryset=Topic.objects.only('id', 'title').prefetch_related(TopicRequirementIds(), 'progress')))
+
+def PathDetailQuery(fields, user):
+    # With the given user's progress on each topic
+    return PathDetailRetrieveSerializer.project(Path.objects.all(), fields).prefetch_related(
+        Prefetch('topic_sequence__topic', queryset=TopicListProgressSerializer.project(Topic.objects.all())),
+        Prefetch('topic_sequence__topic__requires', queryset=Topic.objects.only('id')),
+        Prefetch('topic_sequence__topic__progress', queryset=TopicProgress.objects.filter(
+            student=user.id), to_attr='filtered_progress'))
+
+def PublishedPathsQuery(request, fields):
+    queryset = filter_queryset(request, Path.publishedPaths.all(), {
+        'author': ('author_id', int)})
+    return PathListSerializer.project(queryset, fields)
+
+def SyncWatermark():
+    return (timezone.now() - SYNC_MARGIN).isoformat()
+
+def SubjectChildIds():
+    # Prefetch for serializing Subject.children as a list of ids
+    return Prefetch('children', queryset=Subject.objects.only('id', 'parent'))
+
 def WillMakeCycle(current_topic_id, referenced_topic_id):
-    if current_topic_id == referenced_topic_id:
-        return True
-    else:
-        reference = Topic.objects.get(id=referenced_topic_id)
-        for furtherReference in reference.requires.all():
-            if WillMakeCycle(current_topic_id, furtherReference.id):
-                return True
-        return False
+    # One indexed lookup in the requirement closure table
+    return TopicRequirementClosure.objects.find_cycle(int(current_topic_id), [int(referenced_topic_id)]) is not None
+
+# Conditional GET validators of the detail views: one aggregate query over the
+# rows a response is built from (their counts catch deletions, their
+# updated_at everything else), plus the version counters of what is shown from
+# elsewhere (breadcrumbs come from the subject tree).
+
+def TopicValidators(pk):
+    # The topic and the topics it requires, with their progress
+    row = Topic.objects.filter(Q(id=pk) | Q(required_for=pk)).aggregate(
+        found=Count('id', filter=Q(id=pk), distinct=True),
+        topicCount=Count('id', distinct=True),
+        topicsModified=Max('updated_at'),
+        progressCount=Count('progress', distinct=True),
+        progressModified=Max('progress__updated_at'))
+    if not row['found']:
+        return None
+    return row, (SUBJECT,)
+
+def SubjectValidators(pk):
+    # The subject and its topics
+    row = Subject.objects.filter(id=pk).aggregate(
+        found=Count('id', distinct=True),
+        topicCount=Count('topics', distinct=True),
+        topicsModified=Max('topics__updated_at'))
+    if not row['found']:
+        return None
+    return row, (SUBJECT,)
+
+def PathValidators(pk, user):
+    # The path, the topics in it and the requesting user's progress on them
+    row = Path.objects.filter(id=pk).annotate(
+        myProgress=FilteredRelation('topic_sequence__topic__progress', condition=Q(
+            topic_sequence__topic__progress__student=user.id)),
+    ).values('published', 'updated_at').annotate(
+        topicCount=Count('topic_sequence', distinct=True),
+        topicsModified=Max('topic_sequence__topic__updated_at'),
+        progressCount=Count('myProgress', distinct=True),
+        progressModified=Max('myProgress__updated_at')).first()
+    # Unpublished paths are left to the view to refuse
+    if row is None or not (row['published'] or user.is_staff):
+        return None
+    return row, (SUBJECT,)
 
 # Old Code
 # class ProgressList(generics.ListCreateAPIView):
@@ -9,8 +9,14 @@ https://docs.djangoproject.com/en/4.1/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'captain.settings')
 
-application = get_asgi_application()
+# What get_asgi_application() does, with a handler that sends streamed
+# database reads without blocking the event loop (see api/streaming.py)
+django.setup(set_prefix=False)
+
+from api.streaming import StreamingASGIHandler
+
+application = StreamingASGIHandler()
@@ -0,0 +1,60 @@
+from functools import partial
+from django.db.backends.base.base import NO_DB_ALIAS
+from django.db.backends.postgresql import base, creation
+from .pool import close_pools, get_pool
+
+# The PostgreSQL backend, with connections taken from a pool of this process
+# (see pool.py) rather than opened for each request, and handed back to it
+# rather than closed. Set up by DATABASES[alias]['POOL']:
+#   'SIZE': connections open at most, per process
+#   'TIMEOUT': seconds to wait for a connection when they are all in use
+#   'MAX_IDLE': seconds a connection may sit unused before it is closed
+
+
+class DatabaseCreation(creation.DatabaseCreation):
+    def _destroy_test_db(self, test_database_name, verbosity):
+        # Idle connections to the test database would keep it from being dropped
+        close_pools()
+        super()._destroy_test_db(test_database_name, verbosity)
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    creation_class = DatabaseCreation
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool = None
+
+    def get_new_connection(self, conn_params):
+        # Connections made to reach the 'postgres' database, when the test
+        # database is created or dropped, are not pooled
+        if self.alias == NO_DB_ALIAS:
+            return super().get_new_connection(conn_params)
+        # The client encoding and time zone Django sets on every connection
+        # are made the session defaults, so that the DISCARD ALL on checkin
+        # goes back to them rather than leaving them to be set again
+        conn_params = dict(conn_params, client_encoding='UTF8')
+        if self.timezone_name:
+            conn_params['options'] = ('%s -c TimeZone=%s' % (conn_params.get('options', ''), self.timezone_name)).strip()
+        self.pool = self.connection_pool()
+        connection = self.pool.checkout(partial(super().get_new_connection, conn_params))
+        # As a new connection would have set it
+        self.isolation_level = self.settings_dict['OPTIONS'].get('isolation_level', connection.isolation_level)
+        return connection
+
+    def connection_pool(self):
+        # The pool of this process for the database this wrapper connects to
+        options = self.settings_dict.get('POOL', {})
+        return get_pool(self.alias, self.get_connection_params(), options.get('SIZE', 10),
+                        options.get('TIMEOUT', 10), options.get('MAX_IDLE', 300))
+
+    def _close(self):
+        if self.pool is None or self.connection is None:
+            return super()._close()
+        pool, self.pool = self.pool, None
+        # Closed inside atomic(), the wrapper keeps the connection until the
+        # block ends, so it can't go to another thread
+        if self.in_atomic_block:
+            pool.discard(self.connection)
+        else:
+            pool.checkin(self.connection)
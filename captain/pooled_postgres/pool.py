@@ -0,0 +1,212 @@
+import os
+import threading
+import time
+from collections import deque
+from psycopg2 import Error as DatabaseError
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_UNKNOWN
+from django.db.utils import OperationalError
+
+# A pool of open connections to one database, shared by the threads of one
+# process. Connections are handed out most recently returned first, so that
+# when traffic drops the ones left over sit idle until they are recycled.
+
+# Checkout wait times kept for the percentiles in stats()
+WAIT_SAMPLES = 1000
+
+
+class ConnectionPool:
+    def __init__(self, size, timeout, max_idle):
+        # Connections open at most, seconds to wait for one when they are all
+        # in use, and seconds a connection may sit idle before it is closed
+        self.size = size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.idle = []  # (connection, returned at), oldest first
+        self.in_use = 0
+        self.condition = threading.Condition()
+        self.peak_in_use = 0
+        self.checkouts = self.waits = self.timeouts = 0
+        self.opened = self.discarded = self.recycled = 0
+        self.wait_times = deque(maxlen=WAIT_SAMPLES)
+        self.max_wait = 0.0
+
+    def checkout(self, connect):
+        # Returns an idle connection that still answers, or one made by
+        # connect() if there is none and the pool has room. Waits for a
+        # connection to come back when all of them are in use.
+        started = time.monotonic()
+        with self.condition:
+            stale = self._take_stale(started)
+            while not self.idle and self.in_use >= self.size:
+                remaining = started + self.timeout - time.monotonic()
+                if remaining <= 0:
+                    self.timeouts += 1
+                    self._record_wait(time.monotonic() - started)
+                    self._close_all(stale)
+                    raise OperationalError("No database connection came free within %gs (pool size %d)."
+                                           % (self.timeout, self.size))
+                self.waits += 1
+                self.condition.wait(remaining)
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+            self.checkouts += 1
+            self._record_wait(time.monotonic() - started)
+            found = self.idle.pop() if self.idle else None
+        self._close_all(stale)
+
+        try:
+            while found is not None:
+                if self._usable(found[0]):
+                    return found[0]
+                with self.condition:
+                    self.discarded += 1
+                    found = self.idle.pop() if self.idle else None
+            connection = connect()
+            with self.condition:
+                self.opened += 1
+            return connection
+        except BaseException:
+            self._release(None)
+            raise
+
+    def checkin(self, connection):
+        # Takes a connection back, rolled back and with its session reset by
+        # DISCARD ALL (settings, temporary tables, prepared statements,
+        # advisory locks), which has to run outside of a transaction; one
+        # that can't be is closed instead
+        reset = False
+        try:
+            if not connection.closed and connection.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                connection.rollback()
+            if not connection.closed:
+                connection.autocommit = True
+                with connection.cursor() as cursor:
+                    cursor.execute("DISCARD ALL")
+                reset = True
+        except DatabaseError:
+            pass
+        if not reset or connection.get_transaction_status() == TRANSACTION_STATUS_UNKNOWN:
+            with self.condition:
+                self.discarded += 1
+            self._close_all([connection])
+            connection = None
+        self._release(connection)
+
+    def discard(self, connection):
+        # Takes back a connection that must not be used again
+        self._close_all([connection])
+        with self.condition:
+            self.discarded += 1
+        self._release(None)
+
+    def close(self):
+        # Closes the idle connections; the ones in use are kept when they
+        # come back
+        with self.condition:
+            idle, self.idle = self.idle, []
+        self._close_all([connection for connection, _ in idle])
+
+    def stats(self):
+        with self.condition:
+            wait_times = sorted(self.wait_times)
+            return {
+                'size': self.size,
+                'in_use': self.in_use,
+                'idle': len(self.idle),
+                'peak_in_use': self.peak_in_use,
+                # Share of the pool in use now, and at the busiest moment
+                'saturation': self.in_use / self.size,
+                'peak_saturation': self.peak_in_use / self.size,
+                'checkouts': self.checkouts,
+                # Times a checkout had to wait, and ran out of time waiting
+                'waits': self.waits,
+                'timeouts': self.timeouts,
+                'wait_ms': {
+                    'p50': _percentile(wait_times, 0.5) * 1000,
+                    'p95': _percentile(wait_times, 0.95) * 1000,
+                    'max': self.max_wait * 1000,
+                },
+                'opened': self.opened,
+                # Closed for failing the health check, and for sitting idle
+                'discarded': self.discarded,
+                'recycled': self.recycled,
+            }
+
+    def _take_stale(self, now):
+        stale = []
+        while self.idle and now - self.idle[0][1] > self.max_idle:
+            stale.append(self.idle.pop(0)[0])
+        self.recycled += len(stale)
+        return stale
+
+    def _record_wait(self, waited):
+        self.wait_times.append(waited)
+        self.max_wait = max(self.max_wait, waited)
+
+    def _release(self, connection):
+        # Idle connections are recycled here as well as on checkout, so that
+        # they go once traffic drops even if no checkout follows
+        now = time.monotonic()
+        with self.condition:
+            self.in_use -= 1
+            if connection is not None:
+                self.idle.append((connection, now))
+            stale = self._take_stale(now)
+            self.condition.notify()
+        self._close_all(stale)
+
+    @staticmethod
+    def _usable(connection):
+        if connection.closed:
+            return False
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            return True
+        except DatabaseError:
+            ConnectionPool._close_all([connection])
+            return False
+
+    @staticmethod
+    def _close_all(connections):
+        for connection in connections:
+            try:
+                connection.close()
+            except DatabaseError:
+                pass
+
+
+def _percentile(values, fraction):
+    return values[min(int(len(values) * fraction), len(values) - 1)] if values else 0.0
+
+
+# The pools of this process by (alias, connection parameters). A worker
+# forked from a process that had pools starts without any: the parent's
+# connections are not its own to use.
+_pools = {}
+_pools_pid = None
+_pools_lock = threading.Lock()
+
+
+def get_pool(alias, conn_params, size, timeout, max_idle):
+    global _pools, _pools_pid
+    key = (alias, tuple(sorted(conn_params.items())))
+    with _pools_lock:
+        if _pools_pid != os.getpid():
+            _pools, _pools_pid = {}, os.getpid()
+        if key not in _pools:
+            _pools[key] = ConnectionPool(size, timeout, max_idle)
+        return _pools[key]
+
+
+def pools():
+    # [(alias, database name, pool)] of this process
+    with _pools_lock:
+        if _pools_pid != os.getpid():
+            return []
+        return [(alias, dict(params).get('database'), pool) for (alias, params), pool in _pools.items()]
+
+
+def close_pools():
+    for _, _, pool in pools():
+        pool.close()
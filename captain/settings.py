@@ -2,7 +2,9 @@ from pathlib import Path
 import os
 import mimetypes
 from datetime import timedelta
+from corsheaders.defaults import default_headers
 from decouple import config, Csv
+from django.core.exceptions import ImproperlyConfigured
 
 mimetypes.add_type("text/css", ".css", True)
 
@@ -21,6 +23,11 @@ CSRF_TRUSTED_ORIGINS = config('CSRF_TRUSTED_ORIGINS', cast=Csv())
 
 CORS_ALLOWED_ORIGINS = config('CORS_ALLOWED_ORIGINS', cast=Csv())
 
+# Response headers that browser clients may read (see api.views.Progresses
+# and api.replicas), and the extra request header they may send back
+CORS_EXPOSE_HEADERS = ['X-Sync-Watermark', 'X-Replica-Pin']
+CORS_ALLOW_HEADERS = [*default_headers, 'x-replica-pin']
+
 
 # Application definition
 INSTALLED_APPS = [
@@ -31,6 +38,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'knowledge',
     'api',
     'website',
@@ -52,6 +60,7 @@ MIDDLEWARE = [
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
+    'api.replicas.ReplicaMiddleware',
 ]
 
 ROOT_URLCONF = 'captain.urls'
@@ -77,6 +86,11 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'captain.wsgi.application'
 
+# Serve the hot read endpoints with the async views in api.async_views. Meant
+# for running under ASGI (captain.asgi with uvicorn workers, see
+# gunicorn.conf.py); under WSGI they work but gain nothing.
+ASYNC_API = config('ASYNC_API', default=False, cast=bool)
+
 
 # Database
 # https://docs.djangoproject.com/en/4.1/ref/settings/#databases
@@ -88,6 +102,86 @@ DATABASES = {
         'PASSWORD': config('DB_PASSWORD'),
         'HOST': config('DB_HOST'),
         'PORT': config('DB_PORT'),
+        # Seconds a request's connection is kept open for the next request
+        # of its thread; 0 closes it at the end of every request
+        'CONN_MAX_AGE': config('DB_CONN_MAX_AGE', default=0, cast=int),
+    }
+}
+
+# Connection pooling: with DB_POOL_SIZE set, each process keeps up to that many
+# connections to the database open and hands them to requests in turn, checking
+# that one still answers before handing it out (see captain/pooled_postgres).
+# Leave DB_CONN_MAX_AGE at 0 with it, so that connections go back to the pool
+# after each request. Workers x DB_POOL_SIZE should stay below the server's
+# max_connections; GET /api/dbpool/ shows how busy a worker's pool is.
+DB_POOL_SIZE = config('DB_POOL_SIZE', default=0, cast=int)
+if DB_POOL_SIZE:
+    DATABASES['default']['ENGINE'] = 'captain.pooled_postgres'
+    DATABASES['default']['POOL'] = {
+        'SIZE': DB_POOL_SIZE,
+        # Seconds to wait for a connection when they are all in use
+        'TIMEOUT': config('DB_POOL_TIMEOUT', default=10, cast=float),
+        # Seconds a connection may sit unused before it is closed
+        'MAX_IDLE': config('DB_POOL_MAX_IDLE', default=300, cast=float),
+    }
+
+# Read replicas: DB_REPLICA_HOSTS lists their hosts (host or host:port), which
+# become the databases replica1, replica2, ... with the default database's
+# settings otherwise, and DB_REPLICA_NAME the database name on them if it is
+# not DB_NAME. With DB_REPLICA_READS on, the reads of learner-facing GET
+# requests then go to one of them, and a client that has just written reads
+# from the default database for DB_REPLICA_PIN_SECONDS (see api/replicas.py).
+# In tests the replicas mirror the default database, and only the replica
+# tests turn REPLICA_READS on.
+DATABASE_REPLICAS = []
+for number, host in enumerate(config('DB_REPLICA_HOSTS', default='', cast=Csv()), 1):
+    host, _, port = host.partition(':')
+    alias = 'replica%d' % number
+    DATABASES[alias] = {
+        **DATABASES['default'],
+        'NAME': config('DB_REPLICA_NAME', default=DATABASES['default']['NAME']),
+        'HOST': host,
+        'PORT': port or DATABASES['default']['PORT'],
+        'TEST': {'MIRROR': 'default'},
+    }
+    DATABASE_REPLICAS.append(alias)
+REPLICA_READS = config('DB_REPLICA_READS', default=False, cast=bool)
+REPLICA_PIN_SECONDS = config('DB_REPLICA_PIN_SECONDS', default=10, cast=int)
+if DATABASE_REPLICAS:
+    DATABASE_ROUTERS = ['api.replicas.ReplicaRouter']
+
+# For benchmarks only: holds every query up by this many milliseconds, to see
+# how each way of serving copes with a slow database (see api/benchmark.py)
+DB_QUERY_DELAY = config('DB_QUERY_DELAY', default=0, cast=float)
+
+
+# Cache
+# https://docs.djangoproject.com/en/4.1/topics/cache/
+# CACHE_BACKEND picks one of the backends below (or takes a dotted path).
+# The version counters every cached response and in-memory index is keyed by
+# live in the cache, so all workers must share it: the local memory cache is
+# private to each process, and can't be used with more than one worker
+# (WEB_CONCURRENCY, as gunicorn reads it). The default is the file cache then.
+# The database cache needs `manage.py createcachetable`.
+CACHE_BACKENDS = {
+    'locmem': 'django.core.cache.backends.locmem.LocMemCache',
+    'file': 'django.core.cache.backends.filebased.FileBasedCache',
+    'db': 'django.core.cache.backends.db.DatabaseCache',
+    'redis': 'django.core.cache.backends.redis.RedisCache',
+}
+WEB_CONCURRENCY = config('WEB_CONCURRENCY', default=1, cast=int)
+CACHE_BACKEND = config('CACHE_BACKEND', default='locmem' if WEB_CONCURRENCY == 1 else 'file')
+if WEB_CONCURRENCY > 1 and CACHE_BACKENDS.get(CACHE_BACKEND, CACHE_BACKEND) == CACHE_BACKENDS['locmem']:
+    raise ImproperlyConfigured(
+        "CACHE_BACKEND=locmem is private to each process; with WEB_CONCURRENCY=%d workers "
+        "edits would not reach the others. Use file, db or redis." % WEB_CONCURRENCY)
+
+CACHES = {
+    'default': {
+        'BACKEND': CACHE_BACKENDS.get(CACHE_BACKEND, CACHE_BACKEND),
+        # Cache name for locmem, directory for file, table name for db, URL for redis
+        'LOCATION': config('CACHE_LOCATION', default='captain_cache'),
+        'TIMEOUT': config('CACHE_TIMEOUT', default=3600, cast=int),
     }
 }
 
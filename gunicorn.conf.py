@@ -0,0 +1,18 @@
+# Gunicorn reads this from the working directory. The number of workers comes
+# from WEB_CONCURRENCY, which gunicorn reads itself.
+# Every name defined here is read as a setting, so decouple's config is not
+# imported by name (config is a gunicorn setting too)
+import decouple
+
+if decouple.config('ASYNC_API', default=False, cast=bool):
+    # ASGI with uvicorn workers: the async read views (see api/async_views.py)
+    # wait on the database without holding up the worker
+    wsgi_app = 'captain.asgi:application'
+    worker_class = 'uvicorn.workers.UvicornWorker'
+else:
+    wsgi_app = 'captain.wsgi:application'
+
+# Import the app once in the master process, before forking the workers:
+# workers then start serving straight away and share the imported code.
+# Nothing opens a database connection while importing, so none is shared.
+preload_app = True
@@ -0,0 +1,125 @@
+import heapq
+import threading
+from collections import deque
+from django.db import transaction
+from .models import Topic
+from .versions import REQUIREMENTS, bump_version, get_version
+
+
+class AdjacencyArrays:
+    # Every topic that takes part in a requirement gets a slot, and
+    # requires[slot] lists the slots of the topics it directly requires.
+
+    def __init__(self, edges=()):
+        self.slots = {}
+        self.ids = []
+        self.requires = []
+        for from_id, to_id in edges:
+            self.add(from_id, to_id)
+
+    def slot(self, topic_id):
+        slot = self.slots.get(topic_id)
+        if slot is None:
+            slot = self.slots[topic_id] = len(self.ids)
+            self.ids.append(topic_id)
+            self.requires.append([])
+        return slot
+
+    def add(self, from_id, to_id):
+        requires, slot = self.requires[self.slot(from_id)], self.slot(to_id)
+        if slot not in requires:
+            requires.append(slot)
+
+    def remove(self, from_id, to_id):
+        requires, slot = self.requires[self.slot(from_id)], self.slot(to_id)
+        if slot in requires:
+            requires.remove(slot)
+
+
+class RequirementGraph:
+    # The Topic.requires relation held in memory for the whole process. It is
+    # loaded in one query and kept current by the m2m_changed handler, so
+    # reachability questions are answered with a single traversal and no
+    # database access.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._arrays = AdjacencyArrays()
+
+    def _current(self):
+        version = get_version(REQUIREMENTS)
+        if version is None or version != self._version:
+            with self._lock:
+                if version is None or version != self._version:
+                    self._arrays = AdjacencyArrays(Topic.requires.through.objects.values_list(
+                        'from_topic_id', 'to_topic_id'))
+                    self._version = version
+        return self._arrays
+
+    def apply(self, edges, added):
+        # Apply committed edge changes made by this process. Only when nobody
+        # else has changed the requirements since the graph was loaded can it
+        # be patched in place, otherwise it is reloaded on next use.
+        with self._lock:
+            current = self._version
+            version = bump_version(REQUIREMENTS)
+            if current is None or version != current + 1:
+                return
+            for from_id, to_id in edges:
+                if added:
+                    self._arrays.add(from_id, to_id)
+                else:
+                    self._arrays.remove(from_id, to_id)
+            self._version = version
+
+    def apply_on_commit(self, edges, added):
+        edges = list(edges)
+        transaction.on_commit(lambda: self.apply(edges, added))
+
+    def invalidate_on_commit(self):
+        transaction.on_commit(lambda: bump_version(REQUIREMENTS))
+
+    def prerequisites(self, topic_id, depth=None):
+        # Everything topic_id transitively requires, up to depth steps away,
+        # as (id, distance) pairs in topological order: every topic comes
+        # after all of its own requirements that are in the list.
+        arrays = self._current()
+        start = arrays.slots.get(topic_id)
+        if start is None:
+            return []
+        distances = {start: 0}
+        queue = deque([start])
+        while queue:
+            slot = queue.popleft()
+            if depth is not None and distances[slot] >= depth:
+                continue
+            for next_slot in arrays.requires[slot]:
+                if next_slot not in distances:
+                    distances[next_slot] = distances[slot] + 1
+                    queue.append(next_slot)
+        del distances[start]
+
+        # Kahn's algorithm over the collected subgraph, ties broken by id
+        ids = arrays.ids
+        pending = {}
+        required_for = {slot: [] for slot in distances}
+        for slot in distances:
+            inside = [next_slot for next_slot in arrays.requires[slot] if next_slot in distances]
+            pending[slot] = len(inside)
+            for next_slot in inside:
+                required_for[next_slot].append(slot)
+        ready = [(ids[slot], slot) for slot, count in pending.items() if count == 0]
+        heapq.heapify(ready)
+        ordered = []
+        while ready:
+            id, slot = heapq.heappop(ready)
+            ordered.append((id, distances[slot]))
+            for dependent in required_for[slot]:
+                pending[dependent] -= 1
+                if pending[dependent] == 0:
+                    heapq.heappush(ready, (ids[dependent], dependent))
+        return ordered
+
+
+requirement_graph = RequirementGraph()
@@ -0,0 +1,139 @@
+import csv
+import json
+from itertools import islice
+from django.db import transaction
+from .models import Concept, Exam, Option, Question, Topic
+from .search import update_search_vectors
+from .versions import QUESTION, bump_version_on_commit
+
+# Questions are written this many at a time, each batch in its own transaction
+BATCH_SIZE = 500
+
+# Question fields that are linked through a many-to-many table, and the model
+# their ids refer to
+LINKS = {'topics': Topic, 'concepts': Concept, 'exams': Exam}
+
+# A JSONL line holds one question:
+#   {"question_text": "...", "explanation": "...", "difficulty": "easy",
+#    "options": [{"option": "...", "correct": true}, ...],
+#    "topics": [1, 2], "concepts": [], "exams": [4]}
+# A CSV file has the columns question_text, explanation, difficulty,
+# options (texts separated by "|"), correct (1-based positions of the correct
+# options separated by ";") and topics, concepts, exams (ids separated by ";").
+FORMATS = ('jsonl', 'csv')
+
+
+class QuestionImportError(ValueError):
+    def __init__(self, line, message):
+        super().__init__("Line %d: %s" % (line, message))
+        self.line = line
+        # Questions of the batches before this line, which were imported
+        self.imported = 0
+
+
+def _ids(value):
+    return [int(id) for id in value.split(';') if id.strip()]
+
+
+def _from_csv_row(row):
+    options = row.get('options') or ''
+    correct = set(_ids(row.get('correct') or ''))
+    record = {
+        'question_text': row.get('question_text'),
+        'explanation': row.get('explanation') or '',
+        'difficulty': row.get('difficulty') or '',
+        'options': [{'option': option, 'correct': position in correct}
+                    for position, option in enumerate(options.split('|') if options else [], 1)],
+    }
+    for field in LINKS:
+        record[field] = _ids(row.get(field) or '')
+    return record
+
+
+def read_records(lines, format):
+    # Yields (line number, record) from an iterable of text lines without
+    # reading ahead, so any size of file is read in constant memory
+    if format == 'jsonl':
+        for number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                yield number, json.loads(line)
+            except ValueError as error:
+                raise QuestionImportError(number, "Invalid JSON (%s)." % error)
+    elif format == 'csv':
+        # Line 1 is the header
+        for number, row in enumerate(csv.DictReader(lines), 2):
+            try:
+                yield number, _from_csv_row(row)
+            except ValueError:
+                raise QuestionImportError(number, "Ids and correct positions must be integers.")
+    else:
+        raise ValueError("Unknown format '%s', use one of %s." % (format, ', '.join(FORMATS)))
+
+
+def _check_batch(batch):
+    for number, record in batch:
+        if not isinstance(record, dict) or not record.get('question_text'):
+            raise QuestionImportError(number, "question_text is required.")
+        if not isinstance(record.get('options') or [], list):
+            raise QuestionImportError(number, "options must be a list.")
+        if not all(isinstance(option, dict) and option.get('option') for option in record.get('options') or ()):
+            raise QuestionImportError(number, "Every option needs an option text.")
+        for field in LINKS:
+            if not isinstance(record.get(field) or [], list):
+                raise QuestionImportError(number, "%s must be a list of ids." % field)
+        if not all(isinstance(id, int) for field in LINKS for id in record.get(field) or ()):
+            raise QuestionImportError(number, "Ids must be integers.")
+    # One query per linked model for the whole batch
+    for field, model in LINKS.items():
+        wanted = {id for _, record in batch for id in record.get(field) or ()}
+        existing = set(model.objects.filter(id__in=wanted).values_list('id', flat=True))
+        for number, record in batch:
+            missing = set(record.get(field) or ()) - existing
+            if missing:
+                raise QuestionImportError(number, "No %s with id %s." % (field[:-1], min(missing)))
+
+
+def _write_batch(batch, author):
+    questions = Question.objects.bulk_create([Question(
+        question_text=record['question_text'],
+        explanation=record.get('explanation') or '',
+        difficulty=record.get('difficulty') or '',
+        author=author) for _, record in batch])
+    options = Option.objects.bulk_create([
+        Option(question=question, option=option['option'], correct=bool(option.get('correct')))
+        for question, (_, record) in zip(questions, batch) for option in record.get('options') or ()])
+    # Straight into the through tables, rather than one add() per question
+    for field in LINKS:
+        m2m = getattr(Question, field).field
+        through = m2m.remote_field.through
+        through.objects.bulk_create([
+            through(**{m2m.m2m_column_name(): question.id, m2m.m2m_reverse_name(): id})
+            for question, (_, record) in zip(questions, batch) for id in set(record.get(field) or ())])
+    # bulk_create sends no post_save, so do what the signals would have done
+    update_search_vectors(Question, [question.id for question in questions])
+    bump_version_on_commit(QUESTION)
+    return len(questions), len(options)
+
+
+def import_questions(records, author=None, batch_size=BATCH_SIZE):
+    # Writes (line number, record) pairs from read_records() in batches of
+    # batch_size. Each batch is all or nothing; when a record is invalid the
+    # batches before it stay imported and QuestionImportError says where to
+    # resume. Returns the number of questions and options written.
+    questions = options = 0
+    records = iter(records)
+    while True:
+        try:
+            batch = list(islice(records, batch_size))
+            if not batch:
+                return questions, options
+            _check_batch(batch)
+        except QuestionImportError as error:
+            error.imported = questions
+            raise
+        with transaction.atomic():
+            written = _write_batch(batch, author)
+        questions += written[0]
+        options += written[1]
@@ -0,0 +1,19 @@
+import sys
+from django.core.management.base import BaseCommand
+from knowledge.snapshot import export_lines
+
+
+class Command(BaseCommand):
+    help = "Writes subjects, topics, requirements and paths (optionally progress) as an NDJSON snapshot"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', '-o', help="File to write to (default: standard output)")
+        parser.add_argument('--progress', action='store_true', help="Include every user's topic progress")
+
+    def handle(self, *args, **options):
+        out = open(options['output'], 'w', encoding='utf-8') if options['output'] else sys.stdout
+        try:
+            out.writelines(export_lines(include_progress=options['progress']))
+        finally:
+            if out is not sys.stdout:
+                out.close()
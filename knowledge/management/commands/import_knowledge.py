@@ -0,0 +1,22 @@
+import sys
+from django.core.management.base import BaseCommand, CommandError
+from knowledge.snapshot import SnapshotError, import_lines
+
+
+class Command(BaseCommand):
+    help = "Loads an NDJSON snapshot written by export_knowledge into an empty database"
+
+    def add_arguments(self, parser):
+        parser.add_argument('file', help="Path of the snapshot, or - to read standard input")
+
+    def handle(self, *args, **options):
+        lines = sys.stdin if options['file'] == '-' else open(options['file'], encoding='utf-8')
+        try:
+            counts = import_lines(lines)
+        except SnapshotError as error:
+            raise CommandError(str(error))
+        finally:
+            if lines is not sys.stdin:
+                lines.close()
+        self.stdout.write(self.style.SUCCESS("Imported " + ", ".join(
+            "%d %s rows" % (count, name) for name, count in counts.items()) + "."))
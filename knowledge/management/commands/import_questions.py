@@ -0,0 +1,34 @@
+import os
+import sys
+from django.core.management.base import BaseCommand, CommandError
+from knowledge.importer import BATCH_SIZE, FORMATS, QuestionImportError, import_questions, read_records
+
+
+class Command(BaseCommand):
+    help = "Imports questions with their options and topic / concept / exam links from a JSONL or CSV file"
+
+    def add_arguments(self, parser):
+        parser.add_argument('file', help="Path of the file to import, or - to read standard input")
+        parser.add_argument('--format', choices=FORMATS,
+                            help="Format of the file (default: taken from the file extension)")
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                            help="Questions written per transaction (default: %d)" % BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        format = options['format'] or os.path.splitext(options['file'])[1].lstrip('.').lower()
+        if format not in FORMATS:
+            raise CommandError("Can't tell the format of %s, pass --format." % options['file'])
+        if options['file'] == '-':
+            lines = sys.stdin
+        else:
+            lines = open(options['file'], encoding='utf-8', newline='')
+        try:
+            questions, optionCount = import_questions(
+                read_records(lines, format), batch_size=options['batch_size'])
+        except QuestionImportError as error:
+            raise CommandError("%s %d questions before it were imported." % (error, error.imported))
+        finally:
+            if lines is not sys.stdin:
+                lines.close()
+        self.stdout.write(self.style.SUCCESS(
+            "Imported %d questions with %d options." % (questions, optionCount)))
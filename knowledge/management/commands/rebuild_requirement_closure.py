@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from knowledge.models import TopicRequirementClosure
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the topic requirement closure table from Topic.requires"
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            TopicRequirementClosure.objects.rebuild()
+        self.stdout.write(self.style.SUCCESS(
+            "Rebuilt %d requirement closure rows." % TopicRequirementClosure.objects.count()))
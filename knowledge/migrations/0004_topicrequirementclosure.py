@@ -0,0 +1,37 @@
+# Generated by Django 4.1.4 on 2026-10-18 08:29
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('knowledge', '0003_path_author_topic_author'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TopicRequirementClosure',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depth', models.PositiveIntegerField()),
+                ('ancestor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='requirement_closure', to='knowledge.topic')),
+                ('descendant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='dependent_closure', to='knowledge.topic')),
+            ],
+            options={
+                'unique_together': {('ancestor', 'descendant')},
+            },
+        ),
+        # Fill the table from the existing requirements
+        migrations.RunSQL(
+            "WITH RECURSIVE walk (ancestor_id, descendant_id, depth) AS ("
+            "SELECT id, id, 0 FROM knowledge_topic "
+            "UNION SELECT w.ancestor_id, r.to_topic_id, w.depth + 1 "
+            "FROM walk w JOIN knowledge_topic_requires r ON r.from_topic_id = w.descendant_id) "
+            "INSERT INTO knowledge_topicrequirementclosure (ancestor_id, descendant_id, depth) "
+            "SELECT ancestor_id, descendant_id, MIN(depth) FROM walk "
+            "GROUP BY ancestor_id, descendant_id",
+            migrations.RunSQL.noop,
+        ),
+    ]
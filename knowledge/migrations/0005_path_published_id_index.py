@@ -0,0 +1,17 @@
+# Generated by Django 4.1.4 on 2026-10-18 08:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('knowledge', '0004_topicrequirementclosure'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='path',
+            index=models.Index(fields=['published', 'id'], name='knowledge_p_publish_ea2c2d_idx'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 4.1.4 on 2026-10-18 09:02
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('knowledge', '0005_path_published_id_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='topicprogress',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.AddIndex(
+            model_name='topicprogress',
+            index=models.Index(fields=['student', 'updated_at'], name='knowledge_t_student_650207_idx'),
+        ),
+    ]
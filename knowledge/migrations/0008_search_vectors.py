@@ -0,0 +1,71 @@
+# Generated by Django 4.1.4 on 2026-10-18 08:39
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('knowledge', '0007_path_updated_at_topic_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='concept',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='question',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='subject',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='topic',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='concept',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='knowledge_c_search__d10b8b_gin'),
+        ),
+        migrations.AddIndex(
+            model_name='question',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='knowledge_q_search__f3a6c5_gin'),
+        ),
+        migrations.AddIndex(
+            model_name='subject',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='knowledge_s_search__3cb493_gin'),
+        ),
+        migrations.AddIndex(
+            model_name='topic',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='knowledge_t_search__42af0b_gin'),
+        ),
+        # Vectors of the rows that already exist; from now on they are
+        # updated on save (see knowledge.search)
+        migrations.RunSQL(
+            sql="""
+                UPDATE knowledge_topic SET search_vector =
+                    setweight(to_tsvector('english', COALESCE(title, '')), 'A') ||
+                    setweight(to_tsvector('english', COALESCE(about, '')), 'B') ||
+                    setweight(to_tsvector('english'::regconfig, COALESCE(steps, '[]'::jsonb)), 'C');
+                UPDATE knowledge_subject SET search_vector =
+                    setweight(to_tsvector('english', COALESCE(name, '')), 'A') ||
+                    setweight(to_tsvector('english', COALESCE(about, '')), 'B');
+                UPDATE knowledge_question SET search_vector =
+                    setweight(to_tsvector('english', COALESCE(question_text, '')), 'A') ||
+                    setweight(to_tsvector('english', COALESCE(explanation, '')), 'C');
+                UPDATE knowledge_concept SET search_vector =
+                    setweight(to_tsvector('english', COALESCE(name, '')), 'A') ||
+                    setweight(to_tsvector('english', COALESCE(explanation, '')), 'B');
+            """,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 4.1.4 on 2026-10-18 12:25
+
+import django.contrib.postgres.indexes
+from django.db import migrations
+
+SUBJECT_NAME_TRGM = django.contrib.postgres.indexes.GinIndex(
+    fields=['name'], name='subject_name_trgm', opclasses=['gin_trgm_ops'])
+TOPIC_TITLE_TRGM = django.contrib.postgres.indexes.GinIndex(
+    fields=['title'], name='topic_title_trgm', opclasses=['gin_trgm_ops'])
+
+
+# pg_trgm is part of PostgreSQL's contrib package. Where it is not available
+# (some local setups) the indexes are left out and suggestions match prefixes
+# instead; see knowledge.search.suggest.
+def create_trigram_indexes(apps, schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'")
+        if cursor.fetchone() is None:
+            return
+    schema_editor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    schema_editor.add_index(apps.get_model('knowledge', 'Subject'), SUBJECT_NAME_TRGM)
+    schema_editor.add_index(apps.get_model('knowledge', 'Topic'), TOPIC_TITLE_TRGM)
+
+
+def drop_trigram_indexes(apps, schema_editor):
+    schema_editor.execute("DROP INDEX IF EXISTS subject_name_trgm")
+    schema_editor.execute("DROP INDEX IF EXISTS topic_title_trgm")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('knowledge', '0008_search_vectors'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AddIndex(model_name='subject', index=SUBJECT_NAME_TRGM),
+                migrations.AddIndex(model_name='topic', index=TOPIC_TITLE_TRGM),
+            ],
+            database_operations=[
+                migrations.RunPython(create_trigram_indexes, drop_trigram_indexes),
+            ],
+        ),
+    ]
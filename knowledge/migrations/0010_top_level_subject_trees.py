@@ -0,0 +1,71 @@
+# Generated by Django 4.1.4 on 2026-10-18 14:02
+
+from django.db import migrations, models
+from django.db.models import F, Max
+
+# The subject row every subject used to hang under; from here on the API
+# shows it without a row (see knowledge.tree)
+ROOT_SUBJECT_ID = 1
+
+
+def split_root_tree(apps, schema_editor):
+    # Each child of the root subject becomes the root of a tree of its own,
+    # keeping its lft/rght numbering relative to its old left edge. The trees
+    # are numbered in the order the children had under the root.
+    Subject = apps.get_model('knowledge', 'Subject')
+    Topic = apps.get_model('knowledge', 'Topic')
+    root = Subject.objects.filter(id=ROOT_SUBJECT_ID, parent=None).values('tree_id').first()
+    if root is not None:
+        next_tree_id = Subject.objects.aggregate(Max('tree_id'))['tree_id__max'] + 1
+        children = Subject.objects.filter(parent_id=ROOT_SUBJECT_ID).order_by('lft').values_list('lft', 'rght')
+        for lft, rght in children:
+            Subject.objects.filter(tree_id=root['tree_id'], lft__gte=lft, rght__lte=rght).update(
+                tree_id=next_tree_id, lft=F('lft') - (lft - 1), rght=F('rght') - (lft - 1), level=F('level') - 1)
+            next_tree_id += 1
+        Subject.objects.filter(parent_id=ROOT_SUBJECT_ID).update(parent=None)
+        # Topics right under the root subject are left without one, marked
+        # so as to tell them from topics that never had one
+        Topic.objects.filter(subject_id=ROOT_SUBJECT_ID).update(subject=None, at_root=True)
+        Subject.objects.filter(id=ROOT_SUBJECT_ID).delete()
+
+    # Never hand out the root subject's id to a real subject
+    sequence = "pg_get_serial_sequence('%s', 'id')" % Subject._meta.db_table
+    schema_editor.execute("SELECT setval(%s, GREATEST(nextval(%s), %d))" % (sequence, sequence, ROOT_SUBJECT_ID))
+
+
+def join_root_tree(apps, schema_editor):
+    # Puts a root subject back above every top-level subject, in name order,
+    # and the topics filed under it back
+    Subject = apps.get_model('knowledge', 'Subject')
+    Topic = apps.get_model('knowledge', 'Topic')
+    if Subject.objects.filter(id=ROOT_SUBJECT_ID).exists():
+        return
+    tree_id = (Subject.objects.aggregate(Max('tree_id'))['tree_id__max'] or 0) + 1
+    right = 1
+    for old_tree_id, rght in Subject.objects.filter(parent=None).order_by('name').values_list('tree_id', 'rght'):
+        Subject.objects.filter(tree_id=old_tree_id).update(
+            tree_id=tree_id, lft=F('lft') + right, rght=F('rght') + right, level=F('level') + 1)
+        right += rght
+    Subject.objects.create(id=ROOT_SUBJECT_ID, name='root', about='', tree_id=tree_id, lft=1, rght=right + 1, level=0)
+    Subject.objects.filter(tree_id=tree_id, level=1).update(parent_id=ROOT_SUBJECT_ID)
+    Topic.objects.filter(at_root=True).update(subject_id=ROOT_SUBJECT_ID)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('knowledge', '0009_trigram_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='topic',
+            name='at_root',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.RunPython(split_root_tree, join_root_tree),
+        migrations.AddConstraint(
+            model_name='subject',
+            constraint=models.UniqueConstraint(condition=models.Q(('parent', None)), fields=('name',), name='unique_top_level_subject_name'),
+        ),
+    ]
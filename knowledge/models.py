@@ -1,6 +1,10 @@
 from os import stat
-from django.db import models
+from django.db import connection, models, transaction
+from django.db.models import Case, F, Q, Value, When
 from django.conf import settings
+from django.utils import timezone
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 from mptt.models import MPTTModel, TreeForeignKey
 from slugger import AutoSlugField
 import calendar
@@ -11,6 +15,15 @@ import calendar
 class Subject(MPTTModel):
     class Meta:
         unique_together = (('name', 'parent', ), )
+        constraints = [
+            # unique_together doesn't cover top-level subjects, whose parent is NULL
+            models.UniqueConstraint(fields=['name'], condition=Q(parent=None), name='unique_top_level_subject_name'),
+        ]
+        indexes = [
+            GinIndex(fields=['search_vector']),
+            # For suggestions (needs the pg_trgm extension, see migration 0009)
+            GinIndex(fields=['name'], name='subject_name_trgm', opclasses=['gin_trgm_ops']),
+        ]
 
     class MPTTMeta:
         order_insertion_by = ['name']
@@ -19,53 +32,214 @@ class Subject(MPTTModel):
                             related_name='children', null=True, blank=True)
     display_name = models.CharField(max_length=250, blank=True, null=True)
     about = models.CharField(max_length=500, blank=True)
+    # Kept up to date by knowledge.search
+    search_vector = SearchVectorField(null=True, editable=False)
 
     def __str__(self):
         return self.name
 
     def breadcrumbs(self):
-        ex = []
-        for sub in self.get_ancestors(include_self=True):
-            ex.append({"id": sub.id, "name": sub.name})
-        return ex
+        from .tree import breadcrumb_index
+        return breadcrumb_index.breadcrumbs(self.id)
+
+    def save(self, *args, **kwargs):
+        # Every top-level subject is the root of its own tree. They are listed
+        # by name, so the order of the trees doesn't matter: a new one is
+        # added as the last tree, and one that stays top-level is saved where
+        # it is, rather than shifting the tree id of every tree after it as
+        # MPTT does to keep roots in name order when one is renamed.
+        if self.parent_id is None:
+            if self._state.adding and not self.lft:
+                self.insert_at(None, 'last-child', allow_existing_pk=True)
+            elif not self._state.adding and self.level == 0:
+                # Its numbering may have changed since it was loaded (a child
+                # added, say), so that is not written
+                if kwargs.get('update_fields') is None:
+                    kwargs['update_fields'] = [field.attname for field in self._meta.concrete_fields if not field.primary_key
+                                               and field.attname not in ('tree_id', 'lft', 'rght', 'level')]
+                return models.Model.save(self, *args, **kwargs)
+        return super().save(*args, **kwargs)
 
     def delete(self, *args, **kwargs):
-        # Move all its children to parent
-        for child in self.get_children():
-            child.move_to(self.parent, position="last-child")
-            child.save()
-        # Move all its topics to parent subject
-        for topic in self.topics.all():
-            if self.parent.id == 1:
-                topic.subject = None
-            else:
-                topic.subject = self.parent
-            topic.save()
-        return super().delete(*args, **kwargs)
+        from .versions import TOPIC, bump_version_on_commit
+        if self.parent_id is None:
+            with transaction.atomic():
+                # Its topics go to the root subject, its children become
+                # trees of their own
+                Topic.objects.filter(subject_id=self.pk).update(subject=None, at_root=True, updated_at=timezone.now())
+                bump_version_on_commit(TOPIC)
+                for child in self.get_children():
+                    child.move_to(None)
+                return super().delete(*args, **kwargs)
+
+        with transaction.atomic():
+            # The tree fields as they are now, not as they were when loaded
+            node = Subject._base_manager.select_for_update().values(
+                'lft', 'rght', 'tree_id', 'parent_id').get(pk=self.pk)
+            # Move all its topics to parent subject, in one statement
+            Topic.objects.filter(subject_id=self.pk).update(subject_id=node['parent_id'], updated_at=timezone.now())
+            bump_version_on_commit(TOPIC)
+            # Its children take its place under its parent. That is one range
+            # shift over the rows from its left edge onwards within its own
+            # tree: its descendants move up a level and 1 to the left, what
+            # comes after it 2 to the left, and nothing else is touched.
+            lft, rght = node['lft'], node['rght']
+            inside = Q(lft__gt=lft, lft__lt=rght)
+            number = models.PositiveIntegerField()
+            Subject._base_manager.filter(tree_id=node['tree_id'], rght__gt=lft).exclude(pk=self.pk).update(
+                parent_id=Case(When(parent_id=self.pk, then=Value(node['parent_id'])), default=F('parent_id'),
+                               output_field=Subject._meta.get_field('parent').target_field),
+                level=Case(When(inside, then=F('level') - 1), default=F('level'), output_field=number),
+                lft=Case(When(inside, then=F('lft') - 1), When(lft__gt=rght, then=F('lft') - 2), default=F('lft'),
+                         output_field=number),
+                rght=Case(When(rght__lt=rght, then=F('rght') - 1), When(rght__gt=rght, then=F('rght') - 2), default=F('rght'),
+                          output_field=number))
+            # The tree is already closed up, so skip MPTTModel.delete
+            return models.Model.delete(self, *args, **kwargs)
 
 
 class Topic(models.Model):
+    class TopicObjects(models.Manager):
+        # The search vector covers all of steps, so it is only loaded on request
+        def get_queryset(self):
+            return super().get_queryset().defer('search_vector')
     slug = AutoSlugField(populate_from='title')
     title = models.CharField(max_length=250, blank=True, null=True)
     about = models.CharField(max_length=500, blank=True)
     subject = TreeForeignKey(
         Subject, on_delete=models.SET_NULL, related_name="topics", blank=True, null=True)
+    # Filed under the root subject, which has no row (see knowledge.tree): such
+    # a topic has no subject either, but unlike an orphan it shows the root's
+    at_root = models.BooleanField(default=False)
     requires = models.ManyToManyField(
         'self', symmetrical=False, related_name="required_for", blank=True)
     steps = models.JSONField(default=list, blank=True)
     assessor = models.JSONField(default=dict, blank=True)
     author = models.ForeignKey(
         settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, related_name='topics', null=True)
+    # Also moved forward when the topic's requirements change
+    updated_at = models.DateTimeField(auto_now=True)
+    # Kept up to date by knowledge.search
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    objects = TopicObjects()
+
+    class Meta:
+        indexes = [
+            GinIndex(fields=['search_vector']),
+            # For suggestions (needs the pg_trgm extension, see migration 0009)
+            GinIndex(fields=['title'], name='topic_title_trgm', opclasses=['gin_trgm_ops']),
+        ]
 
     def __str__(self):
         return self.title
 
+    def save(self, *args, **kwargs):
+        if self.subject_id is not None:
+            self.at_root = False
+        return super().save(*args, **kwargs)
+
     def breadcrumbs(self):
-        ex = []
-        if self.subject != None:
-            for sub in self.subject.get_ancestors(include_self=True):
-                ex.append({"id": sub.id, "name": sub.name})
-        return ex
+        # Use subject_id, going through self.subject would cost a query per topic
+        from .tree import ROOT_SUBJECT_ID, breadcrumb_index
+        return breadcrumb_index.breadcrumbs(ROOT_SUBJECT_ID if self.at_root else self.subject_id)
+
+
+# Key of the transaction-level advisory lock that changes to the requirements
+# take (see TopicRequirementClosure.objects.lock)
+REQUIREMENTS_LOCK = 7305183
+
+# Every (ancestor, descendant) pair of topics where the ancestor transitively
+# requires the descendant, with the length of the shortest requirement chain
+# between them. Each topic is also paired with itself at depth 0.
+class TopicRequirementClosure(models.Model):
+    class ClosureManager(models.Manager):
+        def lock(self):
+            # Serializes changes to the requirements until the end of the
+            # transaction. Each closure update reads the rows the others
+            # write, so under READ COMMITTED two of them running side by side
+            # would leave pairs out; a loop check and the change it allows
+            # must also see no other change in between.
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_xact_lock(%s)", [REQUIREMENTS_LOCK])
+
+        def add_edges(self, edges):
+            # Join everything above each new edge with everything below it
+            from_ids, to_ids = [list(ids) for ids in zip(*edges)] or ([], [])
+            if not from_ids:
+                return
+            self.lock()
+            table = self.model._meta.db_table
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "INSERT INTO " + table + " (ancestor_id, descendant_id, depth) "
+                    "SELECT id, id, 0 FROM unnest(%s::bigint[]) AS id "
+                    "ON CONFLICT (ancestor_id, descendant_id) DO NOTHING", [from_ids + to_ids])
+                cursor.execute(
+                    "INSERT INTO " + table + " AS c (ancestor_id, descendant_id, depth) "
+                    "SELECT a.ancestor_id, d.descendant_id, MIN(a.depth + 1 + d.depth) "
+                    "FROM unnest(%s::bigint[], %s::bigint[]) AS e (from_id, to_id) "
+                    "JOIN " + table + " a ON a.descendant_id = e.from_id "
+                    "JOIN " + table + " d ON d.ancestor_id = e.to_id "
+                    "GROUP BY a.ancestor_id, d.descendant_id "
+                    "ON CONFLICT (ancestor_id, descendant_id) DO UPDATE SET depth = LEAST(c.depth, EXCLUDED.depth)",
+                    [from_ids, to_ids])
+
+        def refresh(self, ancestor_ids=None):
+            # Recompute the rows of the given ancestors (all topics when None)
+            # from the requirement edges. Removing an edge can only change the
+            # rows of topics that required its start, so that is all it redoes.
+            table = self.model._meta.db_table
+            topics = Topic._meta.db_table
+            requires = Topic.requires.through._meta.db_table
+            if ancestor_ids is None:
+                self.lock()
+                self.all().delete()
+                anchor, params = "", []
+            else:
+                ancestor_ids = list(ancestor_ids)
+                if not ancestor_ids:
+                    return
+                self.lock()
+                self.filter(ancestor_id__in=ancestor_ids).delete()
+                anchor, params = " WHERE id = ANY(%s::bigint[])", [ancestor_ids]
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "WITH RECURSIVE walk (ancestor_id, descendant_id, depth) AS ("
+                    "SELECT id, id, 0 FROM " + topics + anchor + " "
+                    "UNION SELECT w.ancestor_id, r.to_topic_id, w.depth + 1 "
+                    "FROM walk w JOIN " + requires + " r ON r.from_topic_id = w.descendant_id) "
+                    "INSERT INTO " + table + " (ancestor_id, descendant_id, depth) "
+                    "SELECT ancestor_id, descendant_id, MIN(depth) FROM walk "
+                    "GROUP BY ancestor_id, descendant_id", params)
+
+        def rebuild(self):
+            self.refresh()
+
+        def ancestor_ids(self, topic_ids):
+            return set(self.filter(descendant_id__in=topic_ids).values_list('ancestor_id', flat=True))
+
+        def find_cycle(self, topic_id, required_ids):
+            # Which of required_ids, if any, would close a loop when made a
+            # requirement of topic_id? One indexed lookup for the whole set.
+            if topic_id in required_ids:
+                return topic_id
+            return self.filter(ancestor_id__in=required_ids, descendant_id=topic_id).values_list(
+                'ancestor_id', flat=True).first()
+
+    ancestor = models.ForeignKey(
+        Topic, on_delete=models.CASCADE, related_name='requirement_closure')
+    descendant = models.ForeignKey(
+        Topic, on_delete=models.CASCADE, related_name='dependent_closure')
+    depth = models.PositiveIntegerField()
+
+    objects = ClosureManager()
+
+    class Meta:
+        unique_together = ['ancestor', 'descendant']
+
+    def __str__(self):
+        return str(self.ancestor_id) + " requires " + str(self.descendant_id) + " (" + str(self.depth) + ")"
 
 
 class Path(models.Model):
@@ -84,12 +258,18 @@ class Path(models.Model):
     published = models.BooleanField(default=False)
     author = models.ForeignKey(
         settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, related_name='paths', null=True)
+    # Also moved forward when the path's topic sequence changes
+    updated_at = models.DateTimeField(auto_now=True)
     # status = models.CharField(
     #     max_length=10, choices=options, default='draft')
 
     objects = models.Manager()  # default manager
     publishedPaths = PublishedPaths()  # custom manager
 
+    class Meta:
+        # Published paths are listed in id order for keyset pagination
+        indexes = [models.Index(fields=['published', 'id'])]
+
     def __str__(self):
         return self.title
 
@@ -143,9 +323,12 @@ class TopicProgress(models.Model):
         settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='topics_progress')
     topic = models.ForeignKey(
         Topic, on_delete=models.CASCADE, related_name="progress")
+    updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
         unique_together = ['student', 'topic']
+        # For fetching what changed for a student since their last sync
+        indexes = [models.Index(fields=['student', 'updated_at'])]
 
     def __str__(self):
         return self.student.display_name + " - " + self.topic.title
@@ -187,6 +370,11 @@ class Concept(models.Model):
     display_name = models.CharField(max_length=250, blank=True, null=True)
     about = models.CharField(max_length=500, blank=True)
     explanation = models.TextField(blank=True)
+    # Kept up to date by knowledge.search
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    class Meta:
+        indexes = [GinIndex(fields=['search_vector'])]
 
     def __str__(self):
         return self.name
@@ -222,6 +410,11 @@ class Question(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
     author = models.ForeignKey(
         settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, related_name='questions', null=True)
+    # Kept up to date by knowledge.search
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    class Meta:
+        indexes = [GinIndex(fields=['search_vector'])]
 
     def __str__(self):
         return self.question_text[:20]+"..."
@@ -0,0 +1,54 @@
+import random
+from django.core.cache import cache
+from django.db.models import Prefetch
+from .models import Option, Question
+from .versions import QUESTION, get_version
+
+
+# Seconds an id list stays cached at most, on top of going stale with the
+# question version
+IDS_TIMEOUT = 3600
+
+
+def difficulties():
+    # The difficulties questions have, which are the only ones worth a filter
+    key = 'quiz-difficulties:%s' % get_version(QUESTION)
+    values = cache.get(key)
+    if values is None:
+        values = set(Question.objects.order_by().values_list('difficulty', flat=True).distinct())
+        cache.set(key, values, IDS_TIMEOUT)
+    return values
+
+
+def question_ids(topic=None, concept=None, difficulty=None):
+    # The ids of every question matching a filter, kept in the cache until a
+    # question (or what it is linked to) changes. Drawing a quiz from this list
+    # avoids ORDER BY random(), which sorts the whole table on every request.
+    # Filters come from the query string, so empty lists (such as for topics
+    # that don't exist) are not kept: there are only as many entries as
+    # filters that match questions.
+    key = 'quiz-ids:%s:%s:%s:%s' % (get_version(QUESTION), topic, concept, difficulty)
+    ids = cache.get(key)
+    if ids is None:
+        queryset = Question.objects.all()
+        if topic is not None:
+            queryset = queryset.filter(topics=topic)
+        if concept is not None:
+            queryset = queryset.filter(concepts=concept)
+        if difficulty is not None:
+            queryset = queryset.filter(difficulty=difficulty)
+        ids = list(queryset.order_by('id').values_list('id', flat=True).distinct())
+        if ids:
+            cache.set(key, ids, IDS_TIMEOUT)
+    return ids
+
+
+def draw_quiz(n, **filters):
+    # Up to n distinct questions matching the filters, in random order, with
+    # their options: at most three queries however many questions there are
+    ids = question_ids(**filters)
+    drawn = random.sample(ids, min(n, len(ids)))
+    questions = Question.objects.filter(id__in=drawn).select_related('question_group').prefetch_related(
+        Prefetch('option_set', queryset=Option.objects.order_by('id'))).in_bulk()
+    # Questions deleted since the id list was cached are just left out
+    return [questions[id] for id in drawn if id in questions]
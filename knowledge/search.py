@@ -0,0 +1,141 @@
+from collections import namedtuple
+from django.contrib.postgres.search import SearchHeadline, SearchQuery, SearchRank, SearchVector, SearchVectorCombinable, SearchVectorField, TrigramWordSimilarity
+from django.db import connection
+from django.db.models import CharField, F, FloatField, Func, Value
+from .models import Concept, Question, Subject, Topic, TopicRequirementClosure
+
+# Text search configuration used for the stored vectors and for queries alike
+SEARCH_CONFIG = 'english'
+
+
+class JSONSearchVector(SearchVectorCombinable, Func):
+    # to_tsvector(jsonb) picks up only the string values of a JSON document,
+    # so the keys of lesson steps don't end up in the vector
+    template = "setweight(to_tsvector('%(config)s'::regconfig, COALESCE(%(expressions)s, '[]'::jsonb)), '%(weight)s')"
+    output_field = SearchVectorField()
+
+    def __init__(self, expression, weight):
+        super().__init__(expression)
+        self.weight = weight
+
+    def as_sql(self, compiler, connection, **extra_context):
+        return super().as_sql(compiler, connection, config=SEARCH_CONFIG, weight=self.weight, **extra_context)
+
+
+# What goes into the search vector of each kind of result, with its weight,
+# and which fields a hit shows as its title and highlighted text
+Searchable = namedtuple('Searchable', 'model weights title body')
+
+SEARCHABLE = {
+    'topic': Searchable(Topic, (('title', 'A'), ('about', 'B'), ('steps', 'C')), 'title', 'about'),
+    'subject': Searchable(Subject, (('name', 'A'), ('about', 'B')), 'name', 'about'),
+    'question': Searchable(Question, (('question_text', 'A'), ('explanation', 'C')), 'question_text', 'explanation'),
+    'concept': Searchable(Concept, (('name', 'A'), ('explanation', 'B')), 'name', 'explanation'),
+}
+
+SEARCHABLE_MODELS = {searchable.model: searchable for searchable in SEARCHABLE.values()}
+
+
+def search_vector(weights):
+    vector = None
+    for field, weight in weights:
+        if field == 'steps':
+            part = JSONSearchVector(F(field), weight)
+        else:
+            part = SearchVector(field, weight=weight, config=SEARCH_CONFIG)
+        vector = part if vector is None else vector + part
+    return vector
+
+
+def update_search_vectors(model, pks):
+    # One UPDATE for any number of rows; used on save and after bulk writes,
+    # neither of which should compute vectors in Python
+    searchable = SEARCHABLE_MODELS[model]
+    model._base_manager.filter(pk__in=pks).update(search_vector=search_vector(searchable.weights))
+
+
+def search_query(text):
+    # Accepts what people type into search boxes: "quoted phrases", or, -word
+    return SearchQuery(text, config=SEARCH_CONFIG, search_type='websearch')
+
+
+def search(query, kinds=None):
+    # Every hit of every kind, best first, as {'kind', 'id', 'rank'} rows. This
+    # is one query that only touches the indexed vectors, so it can be
+    # paginated cheaply; highlight() then fills in one page.
+    hits = None
+    for kind in kinds or SEARCHABLE:
+        queryset = SEARCHABLE[kind].model._base_manager.filter(search_vector=query).annotate(
+            kind=Value(kind, output_field=CharField()),
+            rank=SearchRank(F('search_vector'), query),
+        ).values('kind', 'id', 'rank')
+        hits = queryset if hits is None else hits.union(queryset, all=True)
+    return hits.order_by('-rank', 'kind', 'id')
+
+
+def highlight(hits, query):
+    # Adds the title and a highlighted extract to each hit, with one query per
+    # kind of result on the page
+    ids = {}
+    for hit in hits:
+        ids.setdefault(hit['kind'], []).append(hit['id'])
+    found = {}
+    for kind, kind_ids in ids.items():
+        searchable = SEARCHABLE[kind]
+        rows = searchable.model._base_manager.filter(pk__in=kind_ids).annotate(
+            headline=SearchHeadline(searchable.body, query, config=SEARCH_CONFIG,
+                                    start_sel='<mark>', stop_sel='</mark>', max_fragments=2),
+        ).values_list('id', searchable.title, 'headline')
+        for id, title, headline in rows:
+            found[kind, id] = {'title': title, 'headline': headline}
+    return [dict(hit, **found[hit['kind'], hit['id']]) for hit in hits if (hit['kind'], hit['id']) in found]
+
+
+# Autocomplete over topic titles and subject names, with the field each kind
+# is matched on
+SUGGESTABLE = {
+    'topic': (Topic, 'title'),
+    'subject': (Subject, 'name'),
+}
+
+# Shorter input has too few trigrams to match on, it is matched as a prefix
+MIN_TRIGRAM_LENGTH = 3
+
+_trigram_installed = None
+
+
+def trigram_installed():
+    # pg_trgm ships with PostgreSQL's contrib package, which not every
+    # development database has; without it suggestions fall back to prefixes
+    global _trigram_installed
+    if _trigram_installed is None:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+            _trigram_installed = cursor.fetchone() is not None
+    return _trigram_installed
+
+
+def suggest(text, k, kinds=None, exclude_cycles_for=None):
+    # The k best {'kind', 'id', 'label', 'score'} matches for what has been
+    # typed so far, from one query. With exclude_cycles_for, topics that
+    # (transitively) require that topic are left out, as adding any of them
+    # as one of its requirements would make a loop.
+    fuzzy = len(text) >= MIN_TRIGRAM_LENGTH and trigram_installed()
+    matches = None
+    for kind in kinds or SUGGESTABLE:
+        model, field = SUGGESTABLE[kind]
+        if fuzzy:
+            queryset = model._base_manager.filter(**{field + '__trigram_word_similar': text}).annotate(
+                score=TrigramWordSimilarity(text, field))
+        else:
+            queryset = model._base_manager.filter(**{field + '__istartswith': text}).annotate(
+                score=Value(1.0, output_field=FloatField()))
+        if kind == 'topic' and exclude_cycles_for is not None:
+            queryset = queryset.exclude(id__in=TopicRequirementClosure.objects.filter(
+                descendant_id=exclude_cycles_for).values('ancestor_id'))
+        queryset = queryset.annotate(
+            kind=Value(kind, output_field=CharField()),
+            label=F(field),
+        ).values('kind', 'id', 'label', 'score')
+        matches = queryset if matches is None else matches.union(queryset, all=True)
+    return list(matches.order_by('-score', 'label', 'kind', 'id')[:k])
@@ -0,0 +1,121 @@
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from django.utils import timezone
+from mptt.signals import node_moved
+from .graph import requirement_graph
+from .models import Path, PathTopicSequence, Question, Subject, Topic, TopicProgress, TopicRequirementClosure
+from .search import SEARCHABLE_MODELS, update_search_vectors
+from .versions import PATH, PATH_TOPIC_SEQUENCE, QUESTION, SUBJECT, TOPIC, TOPIC_PROGRESS, bump_version_on_commit
+
+# The version counter of each model. Anything cached from a model's rows is
+# keyed by its counter, so any save or delete makes it stale.
+MODEL_VERSIONS = {
+    Subject: SUBJECT,
+    Topic: TOPIC,
+    Path: PATH,
+    PathTopicSequence: PATH_TOPIC_SEQUENCE,
+    TopicProgress: TOPIC_PROGRESS,
+    Question: QUESTION,
+}
+
+
+def model_changed(sender, **kwargs):
+    bump_version_on_commit(MODEL_VERSIONS[sender])
+
+
+for model in MODEL_VERSIONS:
+    post_save.connect(model_changed, sender=model, dispatch_uid='version-save-' + model.__name__)
+    post_delete.connect(model_changed, sender=model, dispatch_uid='version-delete-' + model.__name__)
+node_moved.connect(model_changed, sender=Subject, dispatch_uid='version-move-Subject')
+
+
+# The question ids of each quiz filter (knowledge.quiz) depend on these too
+@receiver(m2m_changed, sender=Question.topics.through)
+@receiver(m2m_changed, sender=Question.concepts.through)
+def question_links_changed(sender, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        bump_version_on_commit(QUESTION)
+
+
+def searchable_saved(sender, instance, update_fields=None, **kwargs):
+    searchable = SEARCHABLE_MODELS[sender]
+    if update_fields is not None and not {field for field, _ in searchable.weights} & set(update_fields):
+        return
+    update_search_vectors(sender, [instance.pk])
+
+
+for model in SEARCHABLE_MODELS:
+    post_save.connect(searchable_saved, sender=model, dispatch_uid='search-save-' + model.__name__)
+
+
+# Topic.updated_at and Path.updated_at also cover what their detail responses
+# show from other tables (requirements, topic sequence), so the ETag of a
+# single object can be worked out from its own row.
+def touch(model, ids):
+    model.objects.filter(pk__in=ids).update(updated_at=timezone.now())
+
+
+@receiver(post_save, sender=PathTopicSequence)
+@receiver(post_delete, sender=PathTopicSequence)
+def path_step_changed(sender, instance, **kwargs):
+    touch(Path, [instance.path_id])
+
+
+# Adding topics to a path through Path.topics rather than PathTopicSequence
+@receiver(m2m_changed, sender=Path.topics.through)
+def path_topics_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        bump_version_on_commit(PATH_TOPIC_SEQUENCE)
+        touch(Path, (pk_set or ()) if reverse else [instance.pk])
+
+
+@receiver(post_save, sender=Topic)
+def topic_saved(sender, instance, created, **kwargs):
+    if created:
+        TopicRequirementClosure.objects.bulk_create([TopicRequirementClosure(
+            ancestor=instance, descendant=instance, depth=0)], ignore_conflicts=True)
+
+
+# Keep the requirement closure table and the in-memory requirement graph in
+# step with Topic.requires
+@receiver(m2m_changed, sender=Topic.requires.through)
+def requirements_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        bump_version_on_commit(TOPIC)
+        touch(Topic, (pk_set or ()) if reverse else [instance.pk])
+    if action in ('post_add', 'post_remove', 'pre_clear'):
+        # Before the closure rows the update starts from are read
+        TopicRequirementClosure.objects.lock()
+    if action in ('post_add', 'post_remove'):
+        if reverse:
+            edges = [(pk, instance.pk) for pk in pk_set]
+        else:
+            edges = [(instance.pk, pk) for pk in pk_set]
+        if not edges:
+            return
+        if action == 'post_add':
+            TopicRequirementClosure.objects.add_edges(edges)
+        else:
+            # The closure still describes the old edges at this point
+            TopicRequirementClosure.objects.refresh(
+                TopicRequirementClosure.objects.ancestor_ids([from_id for from_id, _ in edges]))
+        requirement_graph.apply_on_commit(edges, added=(action == 'post_add'))
+    elif action == 'pre_clear':
+        instance._closure_ancestors = TopicRequirementClosure.objects.ancestor_ids([instance.pk])
+    elif action == 'post_clear':
+        TopicRequirementClosure.objects.refresh(instance._closure_ancestors)
+        requirement_graph.invalidate_on_commit()
+
+
+# Deleting a topic drops its requirement rows without any m2m_changed
+@receiver(pre_delete, sender=Topic)
+def topic_deleting(sender, instance, **kwargs):
+    TopicRequirementClosure.objects.lock()
+    instance._closure_ancestors = TopicRequirementClosure.objects.ancestor_ids([instance.pk]) - {instance.pk}
+    touch(Topic, instance.required_for.values('pk'))
+
+
+@receiver(post_delete, sender=Topic)
+def topic_deleted(sender, instance, **kwargs):
+    TopicRequirementClosure.objects.refresh(getattr(instance, '_closure_ancestors', ()))
+    requirement_graph.invalidate_on_commit()
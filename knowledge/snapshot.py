@@ -0,0 +1,126 @@
+import json
+from collections import namedtuple
+from itertools import groupby, islice
+from django.contrib.auth import get_user_model
+from django.core.management.color import no_style
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, transaction
+from .graph import requirement_graph
+from .models import Path, PathTopicSequence, Subject, Topic, TopicProgress, TopicRequirementClosure
+from .search import update_search_vectors
+from .versions import PATH, PATH_TOPIC_SEQUENCE, SUBJECT, TOPIC, TOPIC_PROGRESS, bump_version_on_commit
+
+# A snapshot is NDJSON: a header line, then one line per row,
+# {"type": "<section>", <field>: <value>, ...}, section after section in the
+# order below, so that rows only ever refer to rows above them. Subjects are
+# written in tree order with their MPTT fields, so loading them needs no
+# tree rebuild. Version 2 snapshots have every top-level subject in a tree
+# of its own, without the root subject row of version 1.
+FORMAT = 'captain-knowledge'
+FORMAT_VERSION = 2
+
+Section = namedtuple('Section', 'name model fields ordering')
+
+SECTIONS = (
+    Section('subject', Subject, ('id', 'name', 'parent_id', 'display_name', 'about', 'lft', 'rght', 'tree_id', 'level'), ('tree_id', 'lft')),
+    Section('topic', Topic, ('id', 'slug', 'title', 'about', 'subject_id', 'at_root', 'steps', 'assessor', 'author_id'), ('id',)),
+    Section('requirement', Topic.requires.through, ('from_topic_id', 'to_topic_id'), ('id',)),
+    Section('path', Path, ('id', 'slug', 'title', 'about', 'published', 'author_id'), ('id',)),
+    Section('pathtopicsequence', PathTopicSequence, ('id', 'path_id', 'topic_id', 'order'), ('id',)),
+    # Only with include_progress
+    Section('topicprogress', TopicProgress, ('id', 'student_id', 'topic_id', 'completed', 'verifiable'), ('id',)),
+)
+
+SECTIONS_BY_NAME = {section.name: section for section in SECTIONS}
+
+# Rows read from the database, and rows written to it, per round trip
+BATCH_SIZE = 2000
+
+
+class SnapshotError(ValueError):
+    pass
+
+
+def export_lines(include_progress=False):
+    # Yields the snapshot line by line. Every table is read through a
+    # server-side cursor, so memory use doesn't grow with the data; all of
+    # them are read in one repeatable-read transaction so that they agree.
+    outermost = not connection.in_atomic_block
+    with transaction.atomic():
+        if outermost:
+            with connection.cursor() as cursor:
+                cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        yield json.dumps({'format': FORMAT, 'version': FORMAT_VERSION}) + '\n'
+        for section in SECTIONS:
+            if section.name == 'topicprogress' and not include_progress:
+                continue
+            rows = section.model._base_manager.order_by(*section.ordering).values(*section.fields)
+            for row in rows.iterator(chunk_size=BATCH_SIZE):
+                yield json.dumps(dict(type=section.name, **row), cls=DjangoJSONEncoder) + '\n'
+
+
+def _records(lines):
+    lines = iter(lines)
+    try:
+        header = json.loads(next(lines))
+    except (StopIteration, ValueError):
+        raise SnapshotError("Not a knowledge snapshot.")
+    if header.get('format') != FORMAT or header.get('version') != FORMAT_VERSION:
+        raise SnapshotError("Not a version %d knowledge snapshot." % FORMAT_VERSION)
+    for number, line in enumerate(lines, 2):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+            section = SECTIONS_BY_NAME[record.pop('type')]
+        except (ValueError, KeyError, AttributeError):
+            raise SnapshotError("Line %d is not a snapshot row." % number)
+        yield section, record
+
+
+def _load_batch(section, records):
+    # Users are not part of snapshots: authorship of users this database
+    # doesn't have is dropped, and so is their progress
+    users = {id for record in records for id in (record.get('author_id'), record.get('student_id')) if id is not None}
+    if users:
+        users = set(get_user_model().objects.filter(id__in=users).values_list('id', flat=True))
+        for record in records:
+            if record.get('author_id') not in users:
+                record['author_id'] = None
+        records = [record for record in records if 'student_id' not in record or record['student_id'] in users]
+    # Fields a row leaves out, as snapshots made before they were added do,
+    # take their default
+    defaults = {field: section.model._meta.get_field(field).get_default() for field in section.fields}
+    section.model._base_manager.bulk_create([
+        section.model(**{field: record.get(field, defaults[field]) for field in section.fields}) for record in records])
+    return len(records)
+
+
+def import_lines(lines):
+    # Loads a snapshot into a database that has no subjects, topics or paths
+    # yet, all in one transaction, and returns the number of rows per section.
+    # Rows keep their ids, so afterwards the id sequences are moved past them,
+    # and what signals would normally keep up to date is rebuilt once.
+    counts = {}
+    with transaction.atomic():
+        if Subject.objects.exists() or Topic.objects.exists() or Path.objects.exists():
+            raise SnapshotError("The database already has subjects, topics or paths.")
+        for section, records in groupby(_records(lines), key=lambda pair: pair[0]):
+            records = (record for _, record in records)
+            while True:
+                batch = list(islice(records, BATCH_SIZE))
+                if not batch:
+                    break
+                counts[section.name] = counts.get(section.name, 0) + _load_batch(section, batch)
+
+        models = [section.model for section in SECTIONS]
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(no_style(), models):
+                cursor.execute(sql)
+        TopicRequirementClosure.objects.rebuild()
+        for model in (Subject, Topic):
+            update_search_vectors(model, model._base_manager.values('pk'))
+        for name in (SUBJECT, TOPIC, PATH, PATH_TOPIC_SEQUENCE, TOPIC_PROGRESS):
+            bump_version_on_commit(name)
+        requirement_graph.invalidate_on_commit()
+    return counts
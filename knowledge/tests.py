@@ -1,3 +1,316 @@
+import io
+import tempfile
+from importlib import import_module
+from django.apps import apps
+from django.core.management import call_command
+from django.db import connection
 from django.test import TestCase
+from .graph import requirement_graph
+from .importer import QuestionImportError, import_questions, read_records
+from .models import Concept, Path, PathTopicSequence, Question, Subject, Topic, TopicRequirementClosure
+from .snapshot import SnapshotError, export_lines, import_lines
+from .tree import ROOT_SUBJECT_ID, build_subject_tree
 
-# Create your tests here.
+
+class BreadcrumbIndexTests(TestCase):
+
+    def setUp(self):
+        self.maths = Subject.objects.create(name='Maths')
+        self.algebra = Subject.objects.create(name='Algebra', parent=self.maths)
+        self.topics = [Topic.objects.create(title='Topic %d' % i, subject=self.algebra)
+                       for i in range(5)]
+
+    def test_breadcrumbs_take_a_fixed_number_of_queries(self):
+        topics = list(Topic.objects.all())
+        with self.assertNumQueries(1):
+            for topic in topics:
+                self.assertEqual(topic.breadcrumbs(), [
+                    {"id": ROOT_SUBJECT_ID, "name": "root"},
+                    {"id": self.maths.id, "name": "Maths"},
+                    {"id": self.algebra.id, "name": "Algebra"},
+                ])
+
+    def test_index_follows_renames_and_moves(self):
+        self.algebra.name = 'Linear Algebra'
+        self.algebra.save()
+        self.assertEqual(self.topics[0].breadcrumbs()[-1]["name"], 'Linear Algebra')
+
+        self.algebra.move_to(None)
+        self.assertEqual(self.algebra.breadcrumbs(), [
+            {"id": ROOT_SUBJECT_ID, "name": "root"},
+            {"id": self.algebra.id, "name": "Linear Algebra"}])
+
+
+class RequirementGraphTests(TestCase):
+
+    def setUp(self):
+        # a requires b and c, both of which require d
+        self.a, self.b, self.c, self.d = [Topic.objects.create(title=t) for t in 'abcd']
+        with self.captureOnCommitCallbacks(execute=True):
+            self.a.requires.add(self.b, self.c)
+            self.b.requires.add(self.d)
+            self.d.required_for.add(self.c)
+
+    def test_prerequisites_need_no_queries_once_loaded(self):
+        requirement_graph.prerequisites(self.a.id)
+        with self.assertNumQueries(0):
+            self.assertEqual(requirement_graph.prerequisites(self.a.id),
+                             [(self.d.id, 2), (self.b.id, 1), (self.c.id, 1)])
+            self.assertEqual(requirement_graph.prerequisites(self.a.id, 1), [(self.b.id, 1), (self.c.id, 1)])
+            self.assertEqual(requirement_graph.prerequisites(self.d.id), [])
+
+    def test_graph_follows_edge_changes(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.b.requires.remove(self.d)
+            self.c.requires.clear()
+        self.assertEqual(requirement_graph.prerequisites(self.a.id), [(self.b.id, 1), (self.c.id, 1)])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.b.delete()
+        self.assertEqual(requirement_graph.prerequisites(self.a.id), [(self.c.id, 1)])
+
+
+class RequirementClosureTests(TestCase):
+
+    def setUp(self):
+        # a requires b and c, both of which require d, which requires e
+        self.a, self.b, self.c, self.d, self.e = [Topic.objects.create(title=t) for t in 'abcde']
+        self.a.requires.add(self.b, self.c)
+        self.b.requires.add(self.d)
+        self.d.required_for.add(self.c)
+        self.d.requires.add(self.e)
+
+    def rows(self):
+        return set(TopicRequirementClosure.objects.values_list('ancestor_id', 'descendant_id', 'depth'))
+
+    def descendants(self, topic):
+        return set(TopicRequirementClosure.objects.filter(
+            ancestor=topic, depth__gt=0).values_list('descendant_id', flat=True))
+
+    def assertMatchesRebuild(self):
+        rows = self.rows()
+        TopicRequirementClosure.objects.rebuild()
+        self.assertEqual(rows, self.rows())
+
+    def test_incremental_additions(self):
+        self.assertIn((self.a.id, self.e.id, 3), self.rows())
+        self.assertFalse(TopicRequirementClosure.objects.filter(ancestor=self.e, descendant=self.a).exists())
+        # A shorter chain lowers the depth
+        self.a.requires.add(self.e)
+        self.assertIn((self.a.id, self.e.id, 1), self.rows())
+        self.assertMatchesRebuild()
+
+    def test_incremental_removals(self):
+        self.b.requires.remove(self.d)
+        self.assertIn((self.a.id, self.d.id, 2), self.rows())
+        self.assertMatchesRebuild()
+        self.c.requires.clear()
+        self.assertNotIn(self.d.id, self.descendants(self.a))
+        self.assertMatchesRebuild()
+
+    def test_topic_deletion(self):
+        self.d.delete()
+        self.assertNotIn(self.e.id, self.descendants(self.a))
+        self.assertMatchesRebuild()
+
+    def test_find_cycle(self):
+        manager = TopicRequirementClosure.objects
+        self.assertEqual(manager.find_cycle(self.e.id, {self.c.id}), self.c.id)
+        self.assertIsNone(manager.find_cycle(self.a.id, {self.e.id}))
+
+
+class QuestionImportTests(TestCase):
+
+    def setUp(self):
+        self.topic = Topic.objects.create(title='Sets')
+        self.concept = Concept.objects.create(name='Union')
+
+    def test_jsonl_in_batches(self):
+        lines = io.StringIO(''.join(
+            '{"question_text": "Q%d", "options": [{"option": "A", "correct": true}, {"option": "B"}], "topics": [%d]}\n'
+            % (i, self.topic.id) for i in range(5)))
+        # 3 batches, each: topic check, savepoint, questions, options, topic
+        # links, search vectors, release (nothing for empty concepts / exams)
+        with self.assertNumQueries(3 * 7):
+            self.assertEqual(import_questions(read_records(lines, 'jsonl'), batch_size=2), (5, 10))
+        self.assertEqual(self.topic.question_set.count(), 5)
+        question = Question.objects.get(question_text='Q3')
+        self.assertEqual([option.correct for option in question.option_set.order_by('id')], [True, False])
+        self.assertTrue(Question.objects.filter(search_vector='q3').exists())
+
+    def test_csv(self):
+        lines = io.StringIO('question_text,options,correct,topics,concepts\n'
+                            'Which?,One|Two|Three,2;3,%d,%d\n' % (self.topic.id, self.concept.id))
+        self.assertEqual(import_questions(read_records(lines, 'csv')), (1, 3))
+        question = Question.objects.get()
+        self.assertEqual([option.correct for option in question.option_set.order_by('id')], [False, True, True])
+        self.assertEqual(list(question.concepts.all()), [self.concept])
+
+    def test_bad_record_keeps_earlier_batches(self):
+        lines = io.StringIO('{"question_text": "Q1"}\n{"question_text": "Q2", "topics": [999999]}\n')
+        with self.assertRaises(QuestionImportError) as raised:
+            import_questions(read_records(lines, 'jsonl'), batch_size=1)
+        self.assertEqual((raised.exception.line, raised.exception.imported), (2, 1))
+        self.assertEqual(list(Question.objects.values_list('question_text', flat=True)), ['Q1'])
+
+    def test_links_must_be_lists(self):
+        lines = io.StringIO('{"question_text": "Q1", "topics": %d}\n' % self.topic.id)
+        with self.assertRaises(QuestionImportError) as raised:
+            import_questions(read_records(lines, 'jsonl'))
+        self.assertEqual(raised.exception.line, 1)
+        self.assertIn('topics', str(raised.exception))
+
+    def test_command(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.jsonl') as file:
+            file.write('{"question_text": "Q1", "concepts": [%d]}\n' % self.concept.id)
+            file.flush()
+            out = io.StringIO()
+            call_command('import_questions', file.name, stdout=out)
+        self.assertIn('Imported 1 questions', out.getvalue())
+        self.assertEqual(self.concept.questions.count(), 1)
+
+
+class SnapshotTests(TestCase):
+
+    def setUp(self):
+        maths = Subject.objects.create(name='Maths')
+        algebra = Subject.objects.create(name='Algebra', parent=maths)
+        Subject.objects.create(name='Geometry', parent=maths)
+        sets = Topic.objects.create(title='Sets', subject=algebra, steps=[{'body': 'lesson'}])
+        groups = Topic.objects.create(title='Groups', subject=algebra)
+        rings = Topic.objects.create(title='Rings')
+        rings.requires.add(groups)
+        groups.requires.add(sets)
+        path = Path.objects.create(title='Algebra path', published=True)
+        PathTopicSequence.objects.create(path=path, topic=sets, order=0)
+
+    def test_round_trip(self):
+        subjects = list(Subject.objects.order_by('id').values())
+        topics = list(Topic.objects.order_by('id').values('id', 'slug', 'title', 'subject_id', 'steps'))
+        closure = set(TopicRequirementClosure.objects.values_list('ancestor_id', 'descendant_id', 'depth'))
+        lines = list(export_lines())
+        self.assertEqual(len(lines), 1 + 3 + 3 + 2 + 1 + 1)
+
+        Path.objects.all().delete()
+        Topic.objects.all().delete()
+        Subject.objects.all().delete()
+        self.assertEqual(import_lines(lines), {'subject': 3, 'topic': 3, 'requirement': 2, 'path': 1, 'pathtopicsequence': 1})
+
+        # The MPTT fields are as they were, and consistent
+        self.assertEqual(list(Subject.objects.order_by('id').values()), subjects)
+        self.assertEqual([subject.name for subject in Subject.objects.get(name='Maths').get_children()], ['Algebra', 'Geometry'])
+        self.assertEqual(list(Topic.objects.order_by('id').values('id', 'slug', 'title', 'subject_id', 'steps')), topics)
+        self.assertEqual(set(TopicRequirementClosure.objects.values_list('ancestor_id', 'descendant_id', 'depth')), closure)
+        self.assertTrue(Topic.objects.filter(search_vector='lesson').exists())
+        # New rows get ids past the imported ones
+        self.assertGreater(Topic.objects.create(title='New').id, max(topic['id'] for topic in topics))
+
+    def test_only_into_an_empty_database(self):
+        with self.assertRaises(SnapshotError):
+            import_lines(export_lines())
+        with self.assertRaises(SnapshotError):
+            import_lines(['{"format": "something else"}\n'])
+
+
+class SubjectDeleteTests(TestCase):
+
+    def setUp(self):
+        self.maths = Subject.objects.create(name='Maths')
+        self.algebra = Subject.objects.create(name='Algebra', parent=self.maths)
+        self.groups = Subject.objects.create(name='Groups', parent=self.algebra)
+        self.finite = Subject.objects.create(name='Finite groups', parent=self.groups)
+        self.rings = Subject.objects.create(name='Rings', parent=self.algebra)
+        self.geometry = Subject.objects.create(name='Geometry', parent=self.maths)
+        self.other = Subject.objects.create(name='Physics')
+        self.topic = Topic.objects.create(title='Sets', subject=self.algebra)
+
+    def assertValidTree(self, tree_id):
+        # Every node sits inside its parent, one level down, and the edges
+        # of the tree number 1..2n without gaps
+        nodes = {row['id']: row for row in Subject.objects.filter(tree_id=tree_id).values()}
+        for node in nodes.values():
+            parent = nodes.get(node['parent_id'])
+            if parent:
+                self.assertTrue(parent['lft'] < node['lft'] < node['rght'] < parent['rght'])
+                self.assertEqual(node['level'], parent['level'] + 1)
+        edges = sorted([node['lft'] for node in nodes.values()] + [node['rght'] for node in nodes.values()])
+        self.assertEqual(edges, list(range(1, 2 * len(nodes) + 1)))
+
+    def test_children_and_topics_move_up(self):
+        other = Subject.objects.filter(pk=self.other.pk).values().get()
+        algebra = Subject.objects.get(pk=self.algebra.pk)
+        # However big the subtree: lock, topics, shift, and the delete itself
+        with self.assertNumQueries(8):
+            algebra.delete()
+        self.assertValidTree(self.maths.tree_id)
+        self.assertEqual(Subject.objects.filter(pk=self.other.pk).values().get(), other)
+        self.assertEqual(set(self.maths.get_children().values_list('name', flat=True)), {'Groups', 'Rings', 'Geometry'})
+        self.assertEqual(list(Subject.objects.get(pk=self.groups.pk).get_children()), [self.finite])
+        self.topic.refresh_from_db()
+        self.assertEqual(self.topic.subject_id, self.maths.id)
+
+    def test_leaf(self):
+        Subject.objects.get(pk=self.finite.pk).delete()
+        self.assertValidTree(self.maths.tree_id)
+        self.assertFalse(Subject.objects.get(pk=self.groups.pk).get_children().exists())
+
+
+class TopLevelTreeTests(TestCase):
+
+    def test_renaming_a_top_level_subject_keeps_its_tree(self):
+        maths = Subject.objects.create(name='Maths')
+        physics = Subject.objects.create(name='Physics')
+        self.assertEqual(physics.tree_id, maths.tree_id + 1)
+        physics.name = 'Astronomy'
+        physics.save()
+        maths.refresh_from_db()
+        physics.refresh_from_db()
+        self.assertEqual(physics.tree_id, maths.tree_id + 1)
+        self.assertEqual([node['name'] for node in build_subject_tree()], ['Astronomy', 'Maths'])
+
+    def test_renaming_a_top_level_subject_keeps_its_tree_fields(self):
+        maths = Subject.objects.create(name='Maths')
+        # Loaded before a child was added, so its rght is out of date
+        Subject.objects.create(name='Algebra', parent=Subject.objects.get(pk=maths.pk))
+        maths.name = 'Mathematics'
+        maths.save()
+        self.assertEqual(Subject.objects.filter(pk=maths.pk).values_list('name', 'lft', 'rght').get(), ('Mathematics', 1, 4))
+
+    def test_deleting_a_top_level_subject_files_its_topics_under_the_root(self):
+        maths = Subject.objects.create(name='Maths')
+        algebra = Subject.objects.create(name='Algebra', parent=maths)
+        topic = Topic.objects.create(title='Sets', subject=maths)
+        maths.delete()
+        topic.refresh_from_db()
+        self.assertEqual((topic.subject_id, topic.at_root), (None, True))
+        self.assertEqual(topic.breadcrumbs(), [{"id": ROOT_SUBJECT_ID, "name": "root"}])
+        self.assertIsNone(Subject.objects.get(pk=algebra.pk).parent_id)
+
+    def test_migration_splits_the_root_subject(self):
+        # As laid out before migration 0010: every subject under one root row
+        root = Subject.objects.create(id=ROOT_SUBJECT_ID, name='root')
+        maths = Subject.objects.create(name='Maths', parent=root)
+        algebra = Subject.objects.create(name='Algebra', parent=maths)
+        physics = Subject.objects.create(name='Physics', parent=root)
+        topic = Topic.objects.create(title='Sets', subject=root)
+
+        migration = import_module('knowledge.migrations.0010_top_level_subject_trees')
+        with connection.schema_editor() as schema_editor:
+            migration.split_root_tree(apps, schema_editor)
+
+        self.assertFalse(Subject.objects.filter(id=ROOT_SUBJECT_ID).exists())
+        rows = {row['id']: row for row in Subject.objects.values('id', 'parent_id', 'tree_id', 'lft', 'rght', 'level')}
+        self.assertEqual([rows[id][field] for id in (maths.id, algebra.id, physics.id) for field in ('parent_id', 'lft', 'rght', 'level')],
+                         [None, 1, 4, 0, maths.id, 2, 3, 1, None, 1, 2, 0])
+        self.assertEqual(rows[algebra.id]['tree_id'], rows[maths.id]['tree_id'])
+        self.assertNotEqual(rows[physics.id]['tree_id'], rows[maths.id]['tree_id'])
+        topic.refresh_from_db()
+        self.assertEqual((topic.subject_id, topic.at_root), (None, True))
+        self.assertGreater(Subject.objects.create(name='Biology').id, ROOT_SUBJECT_ID)
+
+        with connection.schema_editor() as schema_editor:
+            migration.join_root_tree(apps, schema_editor)
+        self.assertEqual(list(Subject.objects.filter(parent_id=ROOT_SUBJECT_ID).order_by('lft').values_list('name', flat=True)),
+                         ['Biology', 'Maths', 'Physics'])
+        topic.refresh_from_db()
+        self.assertEqual(topic.subject_id, ROOT_SUBJECT_ID)
@@ -0,0 +1,205 @@
+import threading
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import Max
+from .models import Subject
+from .versions import SUBJECT, bump_version_on_commit, get_version
+
+# Top-level subjects are the roots of trees of their own, so that writes
+# to one subject don't renumber the others. The API still shows them as the
+# children of a root subject with this id, which has no row.
+ROOT_SUBJECT_ID = 1
+ROOT_SUBJECT_NAME = 'root'
+ROOT_CHAIN = ((ROOT_SUBJECT_ID, ROOT_SUBJECT_NAME),)
+
+
+def virtual_root():
+    # The root subject, for serializing; never save it
+    return Subject(id=ROOT_SUBJECT_ID, name=ROOT_SUBJECT_NAME, about='')
+
+
+def build_subject_tree():
+    # One ordered scan of the whole table; since rows come in lft order a
+    # parent is always seen before its children, so nesting is a single pass.
+    # Top-level subjects are listed by name, like the subjects view does.
+    # Read from the default database even in a request served from a read
+    # replica, which may not have caught up with the version it is cached as.
+    rows = Subject.objects.using(DEFAULT_DB_ALIAS).order_by('tree_id', 'lft').values(
+        'id', 'name', 'display_name', 'parent_id')
+    nodes = {}
+    tree = []
+    for row in rows:
+        node = {'id': row['id'], 'name': row['name'],
+                'display_name': row['display_name'], 'children': []}
+        nodes[row['id']] = node
+        parent = nodes.get(row['parent_id'])
+        if parent is None:
+            tree.append(node)
+        else:
+            parent['children'].append(node)
+    tree.sort(key=lambda node: node['name'])
+    return tree
+
+
+def get_subject_tree():
+    # Returns (version, tree), the tree being served from the cache when the
+    # subject table has not changed since it was last built.
+    version = get_version(SUBJECT)
+    key = 'subject-tree:%s' % version
+    tree = cache.get(key)
+    if tree is None:
+        tree = build_subject_tree()
+        cache.set(key, tree, None)
+    return version, tree
+
+
+class BreadcrumbIndex:
+    # Maps every subject id to its ancestor chain (the root subject first,
+    # the subject itself last). It is shared by the whole process and rebuilt in one scan
+    # of the table whenever the subject version moves on.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._chains = {}
+
+    def _build(self):
+        # From the default database, as build_subject_tree is
+        chains = {}
+        rows = Subject.objects.using(DEFAULT_DB_ALIAS).order_by('tree_id', 'lft').values_list(
+            'id', 'name', 'parent_id')
+        for id, name, parent_id in rows:
+            chains[id] = chains.get(parent_id, ROOT_CHAIN) + ((id, name),)
+        return chains
+
+    def chains(self):
+        version = get_version(SUBJECT)
+        if version is None or version != self._version:
+            with self._lock:
+                if version is None or version != self._version:
+                    self._chains = self._build()
+                    self._version = version
+        return self._chains
+
+    def breadcrumbs(self, subject_id):
+        if subject_id is None:
+            return []
+        if subject_id == ROOT_SUBJECT_ID:
+            return [{"id": id, "name": name} for id, name in ROOT_CHAIN]
+        return [{"id": id, "name": name} for id, name in self.chains().get(subject_id, ())]
+
+
+breadcrumb_index = BreadcrumbIndex()
+
+
+# Where a moved subject goes relative to its target, as in MPTTModel.move_to
+MOVE_POSITIONS = ('first-child', 'last-child', 'left', 'right')
+
+TREE_FIELDS = ('parent_id', 'tree_id', 'lft', 'rght', 'level')
+
+
+class SubjectMoveError(ValueError):
+    def __init__(self, index, message):
+        super().__init__("Move %d: %s" % (index, message))
+        self.index = index
+
+
+def move_subjects(moves):
+    # Applies a list of (id, target id, position) moves, in order, as one
+    # transaction. The trees involved are locked and read once, the moves are
+    # checked and carried out on an in-memory copy, and then every tree
+    # involved is renumbered once and only the rows that changed are written,
+    # rather than shifting lft/rght across the tree for each move. A subject
+    # moved into the root subject becomes the root of a new tree.
+    # Returns the number of rows written.
+    with transaction.atomic():
+        ids = {id for move in moves for id in move[:2]}
+        tree_ids = set(Subject.objects.filter(id__in=ids).values_list('tree_id', flat=True))
+        rows = {row['id']: row for row in Subject._base_manager.select_for_update().filter(
+            tree_id__in=tree_ids).order_by('tree_id', 'lft').values('id', 'name', *TREE_FIELDS)}
+
+        # Children of each node (None for the roots of each tree) in order
+        children = {None: []}
+        for row in rows.values():
+            children.setdefault(row['id'], [])
+            children.setdefault(row['parent_id'], []).append(row['id'])
+        parents = {id: row['parent_id'] for id, row in rows.items()}
+        trees = {id: row['tree_id'] for id, row in rows.items() if row['parent_id'] is None}
+        # Read when first needed: top-level names outside of the locked trees,
+        # and the tree id for the next subject to become top-level
+        top_level_names = None
+        next_tree_id = None
+
+        for index, (id, target_id, position) in enumerate(moves):
+            if id not in rows or (target_id not in rows and target_id != ROOT_SUBJECT_ID):
+                raise SubjectMoveError(index, "No subject with id %d." % (id if id not in rows else target_id))
+            if position not in MOVE_POSITIONS:
+                raise SubjectMoveError(index, "Position must be one of " + ", ".join(MOVE_POSITIONS) + ".")
+            if target_id == id:
+                raise SubjectMoveError(index, "A subject can't be moved relative to itself.")
+            if target_id == ROOT_SUBJECT_ID:
+                if not position.endswith('child'):
+                    raise SubjectMoveError(index, "Subjects can't be moved next to the root subject.")
+                parent_id = None
+            elif not position.endswith('child') and parents[target_id] is None:
+                raise SubjectMoveError(index, "Top-level subjects are listed by name, so they can't be moved "
+                                              "next to one; move into the root subject instead.")
+            else:
+                parent_id = target_id if position.endswith('child') else parents[target_id]
+            ancestor = parent_id
+            while ancestor is not None:
+                if ancestor == id:
+                    raise SubjectMoveError(index, "A subject can't be moved into itself.")
+                ancestor = parents[ancestor]
+            names = {rows[sibling]['name'] for sibling in children[parent_id] if sibling != id}
+            if parent_id is None:
+                if top_level_names is None:
+                    top_level_names = set(Subject.objects.filter(parent=None).exclude(
+                        id__in=rows).values_list('name', flat=True))
+                names |= top_level_names
+            if rows[id]['name'] in names:
+                raise SubjectMoveError(index, "There already is a subject named %s there." % rows[id]['name'])
+
+            if parents[id] is None:
+                tree_id = trees.pop(id)
+            elif parent_id is None:
+                if next_tree_id is None:
+                    next_tree_id = Subject._base_manager.aggregate(Max('tree_id'))['tree_id__max'] + 1
+                tree_id = next_tree_id
+                next_tree_id += 1
+            children[parents[id]].remove(id)
+            siblings = children[parent_id]
+            if position == 'first-child':
+                siblings.insert(0, id)
+            elif position == 'last-child':
+                siblings.append(id)
+            else:
+                siblings.insert(siblings.index(target_id) + (position == 'right'), id)
+            parents[id] = parent_id
+            if parent_id is None:
+                trees[id] = tree_id
+
+        # Renumber each tree depth first, without recursion
+        changed = []
+        for root_id, tree_id in trees.items():
+            number = 1
+            stack = [(root_id, 0, False)]
+            lefts = {}
+            while stack:
+                id, level, done = stack.pop()
+                if not done:
+                    lefts[id] = number
+                    number += 1
+                    stack.append((id, level, True))
+                    stack.extend((child, level + 1, False) for child in reversed(children[id]))
+                    continue
+                values = {'parent_id': parents[id], 'tree_id': tree_id, 'lft': lefts[id], 'rght': number, 'level': level}
+                number += 1
+                if any(rows[id][field] != value for field, value in values.items()):
+                    changed.append(Subject(id=id, **values))
+
+        Subject._base_manager.bulk_update(changed, TREE_FIELDS, batch_size=1000)
+        # bulk_update sends no signals
+        if changed:
+            bump_version_on_commit(SUBJECT)
+        return len(changed)
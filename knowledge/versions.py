@@ -0,0 +1,98 @@
+import time
+from asgiref.local import Local
+from django.core.cache import cache
+from django.core.signals import request_finished, request_started
+from django.db import transaction
+
+# Version counters live in the cache so that every process shares them.
+# A counter is bumped whenever the data it describes changes, and anything
+# that is derived from that data (cached responses, in-memory indexes, ETags)
+# is keyed by the current value, so it goes stale on its own.
+
+SUBJECT = 'subject'
+TOPIC = 'topic'
+PATH = 'path'
+PATH_TOPIC_SEQUENCE = 'pathtopicsequence'
+TOPIC_PROGRESS = 'topicprogress'
+QUESTION = 'question'
+REQUIREMENTS = 'requirements'
+
+
+# While a request is being served, each counter is read from the cache at
+# most once; per-row lookups in serializers then cost nothing.
+_local = Local()
+
+
+def _start_request(**kwargs):
+    _local.versions = {}
+
+
+def _finish_request(**kwargs):
+    _local.versions = None
+
+
+request_started.connect(_start_request)
+request_finished.connect(_finish_request)
+
+
+def _key(name):
+    return 'version:' + name
+
+
+def _changed_key(name):
+    return 'changed:' + name
+
+
+def _remember(name, version):
+    versions = getattr(_local, 'versions', None)
+    if versions is not None:
+        versions[name] = version
+    return version
+
+
+def get_version(name):
+    versions = getattr(_local, 'versions', None)
+    if versions and name in versions:
+        return versions[name]
+    key = _key(name)
+    version = cache.get(key)
+    if version is None:
+        _start_counter(key)
+        version = cache.get(key)
+    return _remember(name, version)
+
+
+def _start_counter(key):
+    # Start from the clock rather than from 1, so that a counter that was
+    # evicted never comes back with a value that an old entry still uses.
+    cache.add(key, int(time.time() * 1000), None)
+
+
+def bump_version(name):
+    key = _key(name)
+    try:
+        version = cache.incr(key)
+    except ValueError:
+        _start_counter(key)
+        version = cache.incr(key)
+    cache.set(_changed_key(name), time.time(), None)
+    return _remember(name, version)
+
+
+def get_changed_at(name):
+    # When the counter was last bumped, as a unix timestamp. If that has been
+    # evicted, count from now; a Last-Modified built on it can only move later.
+    key = _changed_key(name)
+    changed_at = cache.get(key)
+    if changed_at is None:
+        cache.add(key, time.time(), None)
+        changed_at = cache.get(key)
+    return changed_at
+
+
+def bump_version_on_commit(name):
+    # Bump straight away so this process stops serving the old data, and again
+    # once the transaction commits, so that whatever another process rebuilt
+    # from the not yet committed state in between is thrown away too.
+    bump_version(name)
+    transaction.on_commit(lambda: bump_version(name))
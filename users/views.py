@@ -11,6 +11,7 @@ from rest_framework.exceptions import PermissionDenied
 from rest_framework.decorators import api_view, permission_classes
 from users.models import CaptainUser
 from .serializers import CaptainUserSUSerializer, CaptainUserInfoSerializer
+from api.pagination import filter_queryset, paginated_response
 from rest_framework.permissions import BasePermission, IsAuthenticated, SAFE_METHODS
 
 
@@ -39,9 +40,9 @@ class UserInfoWritePermission(BasePermission):
 def allUsers(request):
     # To get list of subjects (who are children of root)
     if request.method == 'GET':
-        queryset = CaptainUser.objects.all()
-        serializer = CaptainUserSUSerializer(queryset, many=True)
-        return Response(serializer.data)
+        queryset = filter_queryset(request, CaptainUser.objects.all(), {
+            'is_staff': ('is_staff', bool), 'is_active': ('is_active', bool)})
+        return paginated_response(request, queryset, CaptainUserSUSerializer)
 
 
 @api_view(['GET', 'PUT', 'DELETE', 'PATCH'])